@@ -10,6 +10,7 @@ import torchvision
 import torchvision.transforms as transforms
 
 import os
+import time
 import argparse
 
 from cifar_utils import progress_bar
@@ -22,6 +23,10 @@ parser = argparse.ArgumentParser(description='PyTorch CIFAR10 Training')
 parser.add_argument('--lr', default=0.1, type=float, help='learning rate')
 parser.add_argument('--resume', '-r', action='store_true',
                     help='resume from checkpoint')
+parser.add_argument('--bf16', action='store_true',
+                    help='bfloat16 autocast for the forward pass (weights & the PAGNN state stay fp32)')
+parser.add_argument('--channels-last', action='store_true',
+                    help='channels_last memory format for the model & images')
 args = parser.parse_args()
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -61,6 +66,8 @@ net = p_resnet.p_resnet18()
 # net = models.resnet18()
 
 net = net.to(device)
+if args.channels_last:
+    net = net.to(memory_format=torch.channels_last)
 if device == 'cuda':
     net = torch.nn.DataParallel(net)
     cudnn.benchmark = True
@@ -80,6 +87,18 @@ optimizer = optim.SGD(net.parameters(), lr=args.lr,
 lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones=[150, 250], gamma=0.1)
 
 
+def prepare(inputs, targets):
+    inputs, targets = inputs.to(device), targets.to(device)
+    if args.channels_last:
+        inputs = inputs.contiguous(memory_format=torch.channels_last)
+    return inputs, targets
+
+
+def autocast():
+    # bf16 keeps fp32's range, so no loss scaling is needed
+    return torch.autocast(device, dtype=torch.bfloat16, enabled=args.bf16)
+
+
 # Training
 def train(epoch):
     print('\nEpoch: %d' % epoch)
@@ -87,12 +106,14 @@ def train(epoch):
     train_loss = 0
     correct = 0
     total = 0
+    start = time.time()
 
     for batch_idx, (inputs, targets) in enumerate(trainloader):
-        inputs, targets = inputs.to(device), targets.to(device)
+        inputs, targets = prepare(inputs, targets)
         optimizer.zero_grad()
-        outputs = net(inputs)
-        loss = criterion(outputs, targets)
+        with autocast():
+            outputs = net(inputs)
+            loss = criterion(outputs, targets)
         loss.backward()
         optimizer.step()
 
@@ -101,8 +122,8 @@ def train(epoch):
         total += targets.size(0)
         correct += predicted.eq(targets).sum().item()
 
-        progress_bar(batch_idx, len(trainloader), 'Loss: %.3f | Acc: %.3f%% (%d/%d)'
-                     % (train_loss/(batch_idx+1), 100.*correct/total, correct, total))
+        progress_bar(batch_idx, len(trainloader), 'Loss: %.3f | Acc: %.3f%% (%d/%d) | %.1f img/s'
+                     % (train_loss/(batch_idx+1), 100.*correct/total, correct, total, total/(time.time()-start)))
 
 
 def test(epoch):
@@ -113,9 +134,10 @@ def test(epoch):
     total = 0
     with torch.no_grad():
         for batch_idx, (inputs, targets) in enumerate(testloader):
-            inputs, targets = inputs.to(device), targets.to(device)
-            outputs = net(inputs)
-            loss = criterion(outputs, targets)
+            inputs, targets = prepare(inputs, targets)
+            with autocast():
+                outputs = net(inputs)
+                loss = criterion(outputs, targets)
 
             test_loss += loss.item()
             _, predicted = outputs.max(1)
@@ -0,0 +1,41 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+import pandas as pd
+from sklearn.utils import shuffle
+
+from pagnn.utils.comparisons import one_hot, get_dataloaders
+from pagnn.utils.sweep import sweep
+
+
+if __name__ == '__main__':
+    seed = 666
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+
+    # same data as iris_classification.py
+    df = shuffle(pd.read_csv('datasets/iris.csv').dropna(), random_state=seed)
+    df = one_hot(df, 'Species')
+    filter_col = [col for col in df if col.startswith('Species')]
+    T = torch.argmax(torch.tensor(df[filter_col].to_numpy()).float(), dim=1)
+    X = torch.tensor(df.drop(filter_col + ['Id'], axis=1).to_numpy()).float()
+    D, C = X.shape[1], len(filter_col)
+
+    split = int(0.67 * X.shape[0])
+    train_dl, test_dl = get_dataloaders(((X[:split], T[:split]), (X[split:], T[split:])), batch_size=10)
+
+    # instead of a hand written `configs` list, every combination is tried & the weak ones are dropped early
+    space = {
+        'steps': [1, 2, 3],
+        'activation': [None, 'relu', 'tanh'],
+        'extra_neurons': [0, 5],
+        'lr': [0.01, 0.001],
+    }
+
+    trials = sweep(space, D, C, train_dl, test_dl, F.cross_entropy, epochs=27, min_epochs=1, eta=3,
+                   workers=2, test_accuracy=True, seed=seed, context='iris', cache_dir='.cache/iris_sweep')
+
+    print('%6s %12s  %s' % ('epochs', 'accuracy', 'config'))
+    for trial in trials[:10]:
+        print('%6i %12.4f  %s' % (trial['epochs'], trial['test_history'][-1] if trial['test_history'] else 0,
+                                  trial['config']))
@@ -0,0 +1,77 @@
+"""Training throughput & accuracy of a P-ResNet in fp32 vs bf16 autocast, w/ & w/o channels_last.
+
+Every config starts from the same weights & trains on the same synthetic task (noisy class templates), so the
+accuracies are directly comparable to the fp32 baseline.
+"""
+
+import time
+import argparse
+from copy import deepcopy
+
+import torch
+import torch.nn.functional as F
+
+from pagnn import p_resnet
+
+
+parser = argparse.ArgumentParser(description='P-ResNet mixed precision benchmark')
+parser.add_argument('-a', '--arch', default='p_resnet18', choices=p_resnet.__all__)
+parser.add_argument('--image-size', default=64, type=int)
+parser.add_argument('--classes', default=10, type=int)
+parser.add_argument('-b', '--batch-size', default=32, type=int)
+parser.add_argument('--iterations', default=60, type=int)
+parser.add_argument('--test-size', default=256, type=int)
+
+
+def synthetic_data(templates, n, noise=1.0):
+    T = torch.randint(0, templates.shape[0], (n,))
+    X = templates[T] + noise * torch.randn((n,) + templates.shape[1:])
+    return X, T
+
+
+def run(model, templates, args, bf16, channels_last):
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01, momentum=0.9)
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+
+    def prepare(X):
+        return X.contiguous(memory_format=torch.channels_last) if channels_last else X
+
+    torch.manual_seed(0)
+    batches = [synthetic_data(templates, args.batch_size) for _ in range(args.iterations)]
+    test_X, test_T = synthetic_data(templates, args.test_size)
+
+    model.train()
+    start = time.perf_counter()
+    for X, T in batches:
+        optimizer.zero_grad()
+        with torch.autocast('cpu', dtype=torch.bfloat16, enabled=bf16):
+            loss = F.cross_entropy(model(prepare(X)), T)
+        loss.backward()
+        optimizer.step()
+    images_per_sec = args.iterations * args.batch_size / (time.perf_counter() - start)
+
+    model.eval()
+    with torch.no_grad(), torch.autocast('cpu', dtype=torch.bfloat16, enabled=bf16):
+        accuracy = (model(prepare(test_X)).argmax(1) == test_T).float().mean().item()
+
+    return images_per_sec, loss.item(), accuracy
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    torch.manual_seed(666)
+
+    base = p_resnet.__dict__[args.arch](num_classes=args.classes)
+    templates = torch.randn(args.classes, 3, args.image_size, args.image_size)
+
+    print('%8s %14s %10s %10s %10s' % ('dtype', 'memory format', 'img/s', 'loss', 'accuracy'))
+    baseline = None
+    for bf16 in [False, True]:
+        for channels_last in [False, True]:
+            images_per_sec, loss, accuracy = run(deepcopy(base), templates, args, bf16, channels_last)
+            baseline = images_per_sec if baseline is None else baseline
+            print('%8s %14s %10.1f %10.4f %10.3f   (%.2fx)' % ('bf16' if bf16 else 'fp32',
+                                                            'channels_last' if channels_last else 'nchw',
+                                                            images_per_sec, loss, accuracy,
+                                                            images_per_sec / baseline))
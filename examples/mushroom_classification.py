@@ -5,7 +5,7 @@ import pandas as pd
 import matplotlib.pyplot as plt
 
 from pagnn.pagnn import PAGNNLayer
-from pagnn.utils.comparisons import FFNN, one_hot, separate_targets, get_train_and_test, get_dataloaders, compare, count_params
+from pagnn.utils.comparisons import FFNN, load_categorical_csv, split_train_and_test, get_dataloaders, compare, count_params
 from pagnn.utils.visualize import draw_networkx_graph
 
 
@@ -15,47 +15,22 @@ if __name__ == '__main__':
         torch.manual_seed(seed)
         np.random.seed(seed)
 
-    df = pd.read_csv('datasets/mushrooms.csv')
-
-    # one-hot encodings
-    df = one_hot(df, 'cap-shape')
-    df = one_hot(df, 'cap-surface')
-    df = one_hot(df, 'cap-color')
-    df = one_hot(df, 'bruises')
-    df = one_hot(df, 'odor')
-    df = one_hot(df, 'gill-attachment')
-    df = one_hot(df, 'gill-spacing')
-    df = one_hot(df, 'gill-size')
-    df = one_hot(df, 'gill-color')
-    df = one_hot(df, 'stalk-shape')
-    df = one_hot(df, 'stalk-root')
-    df = one_hot(df, 'stalk-surface-above-ring')
-    df = one_hot(df, 'stalk-surface-below-ring')
-    df = one_hot(df, 'stalk-color-above-ring')
-    df = one_hot(df, 'stalk-color-below-ring')
-    df = one_hot(df, 'veil-type')
-    df = one_hot(df, 'veil-color')
-    df = one_hot(df, 'ring-number')
-    df = one_hot(df, 'ring-type')
-    df = one_hot(df, 'spore-print-color')
-    df = one_hot(df, 'population')
-    df = one_hot(df, 'habitat')
-    df = one_hot(df, 'class')
-
-    df, targets = separate_targets(df, 'class')
+    # all columns are categorical, they're one-hot encoded in one pass & cached for the next runs
+    X, T = load_categorical_csv('datasets/mushrooms.csv', 'class')
     train_perc = 0.8
-    data_tensors = get_train_and_test(df, targets, train_perc, dtype=torch.float)
+    data_tensors = split_train_and_test(X, T, train_perc)
     (train_X, train_T), (test_X, test_T) = data_tensors
 
-    batch_size = 10
-    train_dl, test_dl = get_dataloaders(data_tensors, batch_size)
-
     D = train_X.shape[1]
     C = 2
 
     print('input features:', D, 'num classes:', C)
     device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 
+    # the whole dataset fits on the device, so batches are just slices of it
+    batch_size = 10
+    train_dl, test_dl = get_dataloaders(data_tensors, batch_size, device=device)
+
     model_dicts = []
 
     linear_lr = 0.01
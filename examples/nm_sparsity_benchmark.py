@@ -0,0 +1,76 @@
+"""Throughput of a PAGNN step (`s_{t+1} = s_t W + b`) w/ a dense, unstructured sparse (CSR) & N:M sparse `W`.
+
+Both sparse variants are compared at the same density (n/m).
+"""
+
+import time
+import argparse
+
+import torch
+
+from pagnn.pagnn import PAGNNLayer
+from pagnn.utils.sparsity import nm_mask, compress_nm
+
+
+parser = argparse.ArgumentParser(description='PAGNN N:M sparsity benchmark')
+parser.add_argument('--neurons', default=[119, 794, 3048], type=int, nargs='+',
+                    help='total neuron counts (mushrooms, mnist & p_resnet50 head by default)')
+parser.add_argument('--batch-sizes', default=[1, 64], type=int, nargs='+')
+parser.add_argument('--patterns', default=['2:4', '1:4', '2:8'], nargs='+')
+parser.add_argument('--steps', default=3, type=int)
+parser.add_argument('--iterations', default=50, type=int)
+
+
+def throughput(pagnn, x, iterations):
+    with torch.no_grad():
+        pagnn(x) # warmup
+        start = time.perf_counter()
+        for _ in range(iterations):
+            pagnn(x)
+        elapsed = time.perf_counter() - start
+    return iterations * x.shape[0] / elapsed
+
+
+@torch.no_grad()
+def unstructured_csr(pagnn, W, density):
+    """Same density as the N:M pattern, but random (unstructured) edges of `W`."""
+
+    class CSRWeight:
+        def __init__(self, W):
+            self.csr = W.t().contiguous().to_sparse_csr()
+
+        def rmatmul(self, state):
+            return torch.sparse.mm(self.csr, state.t()).t()
+
+    mask = torch.rand_like(W) < density
+    pagnn.compressed_weight = CSRWeight(W * mask)
+    return pagnn
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    torch.manual_seed(666)
+
+    print('%8s %6s %8s %14s %14s %14s %10s' % ('neurons', 'batch', 'pattern', 'dense (s/sec)', 'csr (s/sec)',
+                                                'n:m (s/sec)', 'n:m mem'))
+
+    for N in args.neurons:
+        for batch_size in args.batch_sizes:
+            for pattern in args.patterns:
+                n, m = [int(v) for v in pattern.split(':')]
+
+                pagnn = PAGNNLayer(1, 1, N - 2, steps=args.steps, retain_state=False)
+                W = pagnn.weight.detach().clone()
+                pagnn.weight.data *= nm_mask(pagnn.weight, n, m)
+                x = torch.rand(batch_size, 1)
+
+                dense = throughput(pagnn, x, args.iterations)
+
+                unstructured_csr(pagnn, W, n / m)
+                csr = throughput(pagnn, x, args.iterations)
+
+                compress_nm(pagnn, n, m)
+                nm = throughput(pagnn, x, args.iterations)
+                mem = pagnn.compressed_weight.nbytes() / (pagnn.weight.numel() * pagnn.weight.element_size())
+
+                print('%8i %6i %8s %14.1f %14.1f %14.1f %9.1f%%' % (N, batch_size, pattern, dense, csr, nm, 100 * mem))
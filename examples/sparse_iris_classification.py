@@ -8,6 +8,7 @@ import matplotlib.pyplot as plt
 from pagnn.utils.comparisons import FFNN, one_hot, normalize_inplace, count_params, compare
 from pagnn.utils.visualize import draw_networkx_graph
 from pagnn.pagnn import PAGNNLayer
+from pagnn.utils.optim import SparseStateOptimizer, pruner_masks
 
 from rigl_torch.RigL import RigLScheduler
 
@@ -86,11 +87,13 @@ if __name__ == '__main__':
         else:
             model_name = '%s(#p=%i, steps=%i) + %s' % (name_prefix, count_params(pagnn_model), config['num_steps'], str(config['activation']))
 
-        pagnn_optimizer = torch.optim.Adam(pagnn_model.parameters(), lr=pagnn_lr)
+        # only keeps Adam's moments for the active edges
+        pagnn_optimizer = SparseStateOptimizer(torch.optim.Adam, pagnn_model.parameters(), lr=pagnn_lr)
 
         pruner = None
         if config['dense_allocation'] is not None:
             pruner = RigLScheduler(pagnn_model, pagnn_optimizer, dense_allocation=config['dense_allocation'], T_end=T_end)
+            pagnn_optimizer.mask_fn = lambda pruner=pruner: pruner_masks(pruner)
 
         pagnn = {
             'name': model_name,
@@ -8,7 +8,7 @@ from sklearn.preprocessing import MinMaxScaler
 import matplotlib.pyplot as plt
 
 from pagnn.pagnn import PAGNNLayer
-from pagnn.utils.comparisons import count_params, LSTM, create_inout_sequences
+from pagnn.utils.comparisons import count_params, LSTM, WindowDataset
 
 
 
@@ -46,7 +46,7 @@ if __name__ == '__main__':
     train_data_normalized = torch.FloatTensor(train_data_normalized).view(-1)
 
     train_window = 12
-    train_inout_seq = create_inout_sequences(train_data_normalized, train_window)
+    train_inout_seq = WindowDataset(train_data_normalized, train_window)
 
     device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
     model = LSTM(device=device)
@@ -57,23 +57,22 @@ if __name__ == '__main__':
     pagnn_optimizer = torch.optim.Adam(pagnn_model.parameters(), lr=0.001)
 
     epochs = 300
+    batch_size = 16
 
     for i in range(epochs):
         pagnn_avg_loss = 0
         lstm_avg_loss = 0
 
-        for seq, labels in train_inout_seq:
+        # batches of windows (every window starts from a zero state), instead of one window at a time
+        for seq, labels in train_inout_seq.batches(batch_size, shuffle=True):
             seq = seq.to(device)
             labels = labels.to(device)
 
             optimizer.zero_grad()
             pagnn_optimizer.zero_grad()
 
-            model.hidden_cell = (torch.zeros(1, 1, model.hidden_layer_size, device=device),
-                            torch.zeros(1, 1, model.hidden_layer_size, device=device))
-    
-            y_pred = model(seq)
-            y_pred_pagnn = pagnn_model(seq)
+            y_pred = model(seq.unsqueeze(-1))
+            y_pred_pagnn = pagnn_model.forward_sequences(seq)
 
             single_loss = loss_function(y_pred, labels)
             single_loss.backward()
@@ -83,8 +82,8 @@ if __name__ == '__main__':
             pagnn_single_loss.backward()
             pagnn_optimizer.step()
 
-            pagnn_avg_loss += pagnn_single_loss.item()
-            lstm_avg_loss += single_loss.item()
+            pagnn_avg_loss += pagnn_single_loss.item() * len(seq)
+            lstm_avg_loss += single_loss.item() * len(seq)
 
         pagnn_avg_loss /= len(train_inout_seq)
         lstm_avg_loss /= len(train_inout_seq)
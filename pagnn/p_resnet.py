@@ -3,10 +3,16 @@
 import torch
 from torch import Tensor
 import torch.nn as nn
-from torchvision.models.utils import load_state_dict_from_url
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+try:
+    from torchvision.models.utils import load_state_dict_from_url
+except ImportError:
+    # moved out of torchvision.models.utils in newer torchvision versions
+    from torch.hub import load_state_dict_from_url
 from typing import Type, Any, Callable, Union, List, Optional
 
 from pagnn import PAGNNLayer
+from pagnn.pagnn import PAGNNHead
 
 
 __all__ = ['p_resnet18', 'p_resnet34', 'p_resnet50', 'p_resnet101',
@@ -157,7 +163,8 @@ class ResNet(nn.Module):
         width_per_group: int = 64,
         replace_stride_with_dilation: Optional[List[bool]] = None,
         norm_layer: Optional[Callable[..., nn.Module]] = None,
-        use_pagnn: bool = True
+        use_pagnn: bool = True,
+        compact_head: bool = False
     ) -> None:
         super(ResNet, self).__init__()
         if norm_layer is None:
@@ -189,7 +196,10 @@ class ResNet(nn.Module):
                                        dilate=replace_stride_with_dilation[2])
         self.avgpool = nn.AdaptiveAvgPool2d((1, 1))
 
-        if use_pagnn:
+        if use_pagnn and compact_head:
+            # only the input -> output block of the PAGNN can affect the outputs (1 step, no extra neurons)
+            self.fc = PAGNNHead(512 * block.expansion, num_classes)
+        elif use_pagnn:
             self.fc = PAGNNLayer(512 * block.expansion, num_classes, 0, retain_state=False)
         else:
             self.fc = nn.Linear(512 * block.expansion, num_classes)
@@ -238,6 +248,13 @@ class ResNet(nn.Module):
 
     def _forward_impl(self, x: Tensor) -> Tensor:
         # See note [TorchScript super()]
+        x = self.forward_features(x)
+        x = self.fc(x)
+
+        return x
+
+    def forward_features(self, x: Tensor) -> Tensor:
+        """The backbone (everything up to & including `avgpool`), returns the pooled features the head sees."""
         x = self.conv1(x)
         x = self.bn1(x)
         x = self.relu(x)
@@ -250,13 +267,68 @@ class ResNet(nn.Module):
 
         x = self.avgpool(x)
         x = torch.flatten(x, 1)
-        x = self.fc(x)
 
         return x
 
     def forward(self, x: Tensor) -> Tensor:
         return self._forward_impl(x)
 
+    @torch.no_grad()
+    def optimize_for_inference(self, example_input: Optional[Tensor] = None) -> nn.Module:
+        """Freeze the model for eval / serving (in place, it can't be trained afterwards).
+
+        Every BatchNorm is folded into the preceding conv's weight & bias (using it's running stats) & the PAGNN head
+        is frozen into it's fastest equivalent form (see `_frozen_head`). Given an `example_input`, the model is also
+        traced & frozen into a TorchScript graph, which fuses the ReLUs (& residual adds) into the convs, so that is
+        what's returned (use it in place of the model). Outputs are the same as `eval()` mode up to float rounding.
+        """
+
+        self.eval()
+        self.conv1, self.bn1 = _fold_bn(self.conv1, self.bn1)
+        for m in self.modules():
+            if isinstance(m, (BasicBlock, Bottleneck)):
+                m.conv1, m.bn1 = _fold_bn(m.conv1, m.bn1)
+                m.conv2, m.bn2 = _fold_bn(m.conv2, m.bn2)
+                if isinstance(m, Bottleneck):
+                    m.conv3, m.bn3 = _fold_bn(m.conv3, m.bn3)
+                if m.downsample is not None:
+                    m.downsample[0], m.downsample[1] = _fold_bn(m.downsample[0], m.downsample[1])
+
+        self.fc = _frozen_head(self.fc)
+        self.requires_grad_(False)
+
+        if example_input is None:
+            return self
+        traced = torch.jit.trace(self, example_input)
+        return torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
+
+def _fold_bn(conv: nn.Conv2d, bn: nn.Module):
+    if not isinstance(bn, nn.BatchNorm2d):
+        # already folded
+        return conv, bn
+    return fuse_conv_bn_eval(conv, bn), nn.Identity()
+
+
+@torch.no_grad()
+def _frozen_head(fc: nn.Module) -> nn.Module:
+    """A single step PAGNN head w/o retained state only reads the input -> output block of it's weight (the rest
+    multiplies zeros & the activation isn't applied after the last step), so it's exactly an `nn.Linear` w/ that block,
+    whatever form the weight is stored in (dense, sparse edges or N:M compressed). Anything else is returned as is."""
+
+    if isinstance(fc, PAGNNHead):
+        weight, bias = fc.weight.t(), fc.bias
+    elif isinstance(fc, PAGNNLayer) and fc._steps == 1 and not fc._retain_state:
+        I, O = fc._input_neurons, fc._output_neurons
+        weight, bias = fc.dense_weight()[:I, -O:].t(), fc.bias[-O:]
+    else:
+        return fc
+
+    linear = nn.Linear(weight.shape[1], weight.shape[0]).to(weight.device)
+    linear.weight.copy_(weight)
+    linear.bias.copy_(bias)
+    return linear
+
 
 def _resnet(
     arch: str,
@@ -1,4 +1,9 @@
+import math
+
 import torch
+from torch.nn.utils.rnn import PackedSequence, pad_packed_sequence
+
+from pagnn.utils.data import prefetch
 
 
 def get_linear_layers(net):
@@ -63,7 +68,29 @@ def import_ffnn(ffnn, activation):
     return pagnn
 
 
+def identity(x):
+    # module level (not a lambda) so layers can be pickled, ex. to send them to `compare` worker processes
+    return x
+
+
+# activations by name, so sweep configs stay json (hashable) & checkpoints can record them (see `pagnn.utils.serving`)
+ACTIVATIONS = {
+    None: None,
+    'relu': torch.nn.functional.relu,
+    'tanh': torch.tanh,
+    'sigmoid': torch.sigmoid,
+    'leaky_relu': torch.nn.functional.leaky_relu,
+}
+
+
 def _pagnn_op(state, weight, bias=None):
+    if not torch.is_tensor(weight):
+        # compressed/frozen weights (ex. `pagnn.utils.sparsity.NMSparseWeight`) provide their own matmul
+        output = weight.rmatmul(state)
+        if bias is not None:
+            output = output + bias
+        return output
+
     if state.dim() == 2 and bias is not None:
         # fused op is marginally faster
         ret = torch.addmm(bias, state, weight)
@@ -76,19 +103,88 @@ def _pagnn_op(state, weight, bias=None):
     return ret
 
 
+def _sample_keys(total, count):
+    """`count` distinct random integers in [0, total) (sorted), w/o a permutation of all `total` of them."""
+
+    if count > total // 2:
+        # mostly dense, sample the ones to leave out instead
+        keep = torch.ones(total, dtype=torch.bool)
+        keep[_sample_keys(total, total - count)] = False
+        return keep.nonzero().squeeze(1)
+
+    # every set of distinct draws is equally likely, so a random subset of them is a uniform sample
+    keys = torch.empty(0, dtype=torch.long)
+    while keys.shape[0] < count:
+        keys = torch.cat((keys, torch.randint(total, (2 * (count - keys.shape[0]) + 16,)))).unique()
+    return keys[torch.randperm(keys.shape[0])[:count]].sort().values
+
+
+def _distributed():
+    return torch.distributed.is_available() and torch.distributed.is_initialized() and \
+        torch.distributed.get_world_size() > 1
+
+
+class SparseEdges(torch.nn.Module):
+    """Sparse (COO) edge store for a PAGNN adjacency matrix.
+
+    `index` holds the (source, target) neuron of every edge & `weight` it's value. The number of edges (slots) is
+    fixed, so rewiring overwrites slots in place (see `replace`) & the optimizer state stays aligned w/ `weight`.
+    Gradients are only ever computed for the existing edges.
+    """
+
+    def __init__(self, total_neurons, edges):
+        super().__init__()
+
+        self._total_neurons = total_neurons
+        self.weight = torch.nn.Parameter(torch.zeros(edges))
+        self.register_buffer('index', torch.zeros((2, edges), dtype=torch.long))
+
+    @property
+    def keys(self):
+        return self.index[0] * self._total_neurons + self.index[1]
+
+    def rmatmul(self, state):
+        """Returns `state @ W`, every edge passes `state[source] * weight` to it's target."""
+
+        source, target = self.index
+        messages = state[..., source] * self.weight
+        output = torch.zeros(state.shape[:-1] + (self._total_neurons,), dtype=messages.dtype, device=messages.device)
+        return output.index_add(-1, target, messages)
+
+    @torch.no_grad()
+    def replace(self, slots, source, target, optimizer=None):
+        """Rewire the edges in `slots` to `source -> target`. new edges start at 0, as does their optimizer state."""
+
+        self.index[0, slots] = source
+        self.index[1, slots] = target
+        self.weight[slots] = 0
+
+        if optimizer is not None:
+            for value in optimizer.state.get(self.weight, {}).values():
+                if torch.is_tensor(value) and value.shape == self.weight.shape:
+                    value[slots] = 0
+
+    @torch.no_grad()
+    def to_dense(self):
+        W = torch.zeros((self._total_neurons, self._total_neurons), dtype=self.weight.dtype, device=self.weight.device)
+        W.view(-1).index_add_(0, self.keys, self.weight)
+        return W
+
+    def extra_repr(self):
+        return 'edges=%i' % self.weight.shape[0]
+
+
 class PAGNNLayer(torch.nn.Module):
-    def __init__(self, input_neurons, output_neurons, extra_neurons, steps=1, sparsity=0, retain_state=True, activation=None):
+    def __init__(self, input_neurons, output_neurons, extra_neurons, steps=1, sparsity=0, retain_state=True, activation=None,
+                 rewire_delta=100, rewire_alpha=0.3, rewire_T_end=None, rewire_chunk_size=1024, parallel_scan=None):
         super(PAGNNLayer, self).__init__()
 
         assert input_neurons > 0 
         assert output_neurons > 0 
         assert extra_neurons >= 0 
-        assert sparsity >= 0 
+        assert 0 <= sparsity < 1
         assert steps >= 1
 
-        if sparsity > 0:
-            raise NotImplemented()
-
         self._total_neurons = input_neurons + output_neurons + extra_neurons
         self._input_neurons = input_neurons
         self._output_neurons = output_neurons
@@ -97,23 +193,86 @@ class PAGNNLayer(torch.nn.Module):
         self._retain_state = retain_state
         self._steps = steps
 
+        # where the output neurons sit in the state (the last ones, see `GrowablePAGNNLayer` for an exception)
+        self._outputs = slice(-output_neurons, None)
+
+        # w/o an activation between steps, a sequence is a linear time-invariant recurrence (see `_scan_sequence`).
+        # `parallel_scan=None` lets `forward` decide when the scan is worth it.
+        self._linear = activation is None or steps == 1
+        self.parallel_scan = parallel_scan
+
         if activation is None:
-            activation = lambda x: x
+            activation = identity
         # elif steps == 1:
             # raise Exception('If activation is provided, but steps = 1, the activation will not be used UNLESS input is a sequence')
         
-        self.weight = torch.nn.Parameter(torch.zeros((self._total_neurons, self._total_neurons)))
+        if sparsity > 0:
+            # the edge store (see `_init_sparse_edges`) is the only weight, there's no dense one
+            self.register_parameter('weight', None)
+        else:
+            self.weight = torch.nn.Parameter(torch.empty((self._total_neurons, self._total_neurons)))
+            torch.nn.init.kaiming_uniform_(self.weight, mode='fan_in')
         self.bias = torch.nn.Parameter(torch.zeros(self._total_neurons))
         self.state = None
+        self.compressed_weight = None # frozen inference-only replacement for `weight`, see `pagnn.utils.sparsity`
         self.activation = activation
-        torch.nn.init.kaiming_uniform_(self.weight, mode='fan_in')
+
+        # dynamic sparse training (RigL style drop/grow, but owned by the layer, see `topology_step`)
+        self.edges = None
+        self.rewire_delta = rewire_delta
+        self.rewire_alpha = rewire_alpha
+        self.rewire_T_end = rewire_T_end
+        self.rewire_chunk_size = rewire_chunk_size
+        self.topology_steps = 0
+        self.rewired_edges = 0
+        self._rewire_record = None
+
+        if sparsity > 0:
+            self._init_sparse_edges(sparsity)
 
         if retain_state:
             self.reset_state(self._total_neurons)
 
+    @torch.no_grad()
+    def _init_sparse_edges(self, sparsity):
+        """Random edges (sampled directly, so nothing NxN is ever allocated) w/ the same init as the dense weight
+        (kaiming uniform, fan in N)."""
+
+        N = self._total_neurons
+        E = max(1, int(round((1 - sparsity) * N * N)))
+
+        keys = _sample_keys(N * N, E)
+        self.edges = SparseEdges(N, E)
+        self.edges.index[0] = keys // N
+        self.edges.index[1] = keys % N
+        bound = math.sqrt(6 / N)
+        self.edges.weight.uniform_(-bound, bound)
+
+    def effective_weight(self):
+        """What `step` multiplies the state with: the compressed weight, the sparse edge store, or the dense weight."""
+
+        if self.compressed_weight is not None:
+            return self.compressed_weight
+        if self.edges is not None:
+            return self.edges
+        return self.weight
+
+    def effective_bias(self):
+        return self.bias
+
+    @torch.no_grad()
+    def dense_weight(self):
+        weight = self.effective_weight()
+        if torch.is_tensor(weight):
+            return weight.detach()
+        return weight.to_dense()
+
     @torch.no_grad()
     def zero_params(self):
-        self.weight.data = torch.zeros_like(self.weight.data)
+        if self.edges is not None:
+            self.edges.weight.data = torch.zeros_like(self.edges.weight.data)
+        else:
+            self.weight.data = torch.zeros_like(self.weight.data)
         self.bias.data = torch.zeros_like(self.bias.data)
         if self.state is not None:
             self.state.data = torch.zeros_like(self.state.data)
@@ -122,26 +281,150 @@ class PAGNNLayer(torch.nn.Module):
         super().to(device, *args, **kwargs)
         if self.state is not None:
             self.state = self.state.to(device)
+        if self.compressed_weight is not None:
+            self.compressed_weight = self.compressed_weight.to(device)
         return self
 
     def reset_state(self, state_shape):
-        self.state = torch.zeros(state_shape, device=self.weight.device)
+        self.state = torch.zeros(state_shape, device=self.bias.device)
 
     def step(self, n=1):
+        weight, bias = self.effective_weight(), self.effective_bias()
         for step in range(n):
-            self.state = _pagnn_op(self.state, self.weight, self.bias)
+            previous_state = self.state
+            self.state = self._keep_dtype(_pagnn_op(self.state, weight, bias))
+            if self._rewire_record is not None and self.state.requires_grad:
+                self._record_step(previous_state, self.state)
             if step < n-1:
                 self.state = self.activation(self.state)
 
+    def _keep_dtype(self, state):
+        # under autocast (ex. bf16 on CPU) the matmul runs in low precision, but the state carried from step to step
+        # stays in the parameters' precision, so rounding errors don't compound over the steps
+        if state.dtype != self.bias.dtype:
+            return state.to(self.bias.dtype)
+        return state
+
+    def _advance(self, state, n=1):
+        """`step` w/o touching `self.state`."""
+
+        weight, bias = self.effective_weight(), self.effective_bias()
+        for step in range(n):
+            state = self._keep_dtype(_pagnn_op(state, weight, bias))
+            if step < n-1:
+                state = self.activation(state)
+        return state
+
+    def _record_step(self, previous_state, next_state):
+        """Keep what's needed to score the dense gradient `dL/dW = sum_t s_t^T dL/ds_{t+1}` on rewiring steps."""
+
+        record = [previous_state.detach().clone(), None]
+        def hook(grad):
+            record[1] = grad.detach()
+        next_state.register_hook(hook)
+        self._rewire_record.append(record)
+
+    def _is_rewire_step(self, t):
+        if self.edges is None or t % self.rewire_delta != 0:
+            return False
+        return self.rewire_T_end is None or t < self.rewire_T_end
+
+    def _drop_fraction(self, t):
+        if self.rewire_T_end is None:
+            return self.rewire_alpha
+        return self.rewire_alpha / 2 * (1 + math.cos(math.pi * t / self.rewire_T_end))
+
+    @torch.no_grad()
+    def _grow_candidates(self, k):
+        """Top-k non-existing edges by dense gradient magnitude.
+
+        The dense gradient is only ever materialized `rewire_chunk_size` source neurons (rows) at a time, so scoring
+        costs O(chunk_size * N) memory instead of O(N^2).
+        """
+
+        N = self._total_neurons
+        records = [(s.reshape(-1, N), g.reshape(-1, N)) for s, g in self._rewire_record if g is not None]
+        existing = self.edges.keys.sort().values
+
+        best_scores = torch.empty(0, device=existing.device)
+        best_keys = torch.empty(0, dtype=torch.long, device=existing.device)
+        for r0 in range(0, N, self.rewire_chunk_size):
+            r1 = min(N, r0 + self.rewire_chunk_size)
+
+            grad = sum(s[:, r0:r1].t().matmul(g) for s, g in records)
+            scores = grad.abs().view(-1)
+
+            # existing edges can't be grown again
+            lo, hi = torch.searchsorted(existing, torch.tensor([r0 * N, r1 * N], device=existing.device)).tolist()
+            scores[existing[lo:hi] - r0 * N] = -float('inf')
+
+            top = scores.topk(min(k, scores.shape[0]))
+            best_scores = torch.cat((best_scores, top.values))
+            best_keys = torch.cat((best_keys, top.indices + r0 * N))
+            if best_scores.shape[0] > k:
+                top = best_scores.topk(k)
+                best_scores, best_keys = top.values, best_keys[top.indices]
+
+        return best_keys[torch.isfinite(best_scores)]
+
+    def topology_step(self, optimizer=None):
+        """Call once per iteration after `loss.backward()`, in place of a `RigLScheduler`:
+
+            if pagnn.topology_step(optimizer):
+                optimizer.step()
+
+        Every `rewire_delta` steps (until `rewire_T_end`) the weakest edges (by magnitude) are dropped & the same number
+        of new edges w/ the largest dense gradient are grown in their slots. The drop fraction starts at
+        `rewire_alpha` & is cosine annealed to 0 over `rewire_T_end`. Returns False on rewiring steps (the optimizer
+        step is skipped, same as RigL). Under `torch.distributed` every rank grows rank 0's new edges, so the edge sets
+        never drift apart (call it on every rank at the same iteration).
+        """
+
+        self.topology_steps += 1
+        t = self.topology_steps
+        if self._rewire_record is None:
+            return True
+
+        try:
+            with torch.no_grad():
+                E = self.edges.weight.shape[0]
+                k = int(self._drop_fraction(t) * E)
+                new_keys = self._grow_candidates(k)
+                if _distributed():
+                    new_keys = self._broadcast_keys(new_keys)
+                k = new_keys.shape[0]
+                if k > 0:
+                    drop = self.edges.weight.abs().topk(k, largest=False).indices
+                    self.edges.replace(drop, new_keys // self._total_neurons, new_keys % self._total_neurons,
+                                       optimizer=optimizer)
+                    self.rewired_edges += k
+        finally:
+            self._rewire_record = None
+
+        return False
+
+    @staticmethod
+    def _broadcast_keys(keys):
+        # every rank scores it's own (local) gradients, rank 0's edges are used everywhere so the edge sets stay the
+        # same (the dropped ones already match, they're picked by the synced weights)
+        count = torch.tensor([keys.shape[0]], device=keys.device)
+        torch.distributed.broadcast(count, 0)
+        if torch.distributed.get_rank() != 0:
+            keys = torch.empty(int(count.item()), dtype=keys.dtype, device=keys.device)
+        torch.distributed.broadcast(keys, 0)
+        return keys
+
     def forward(self, x):
+        if self._rewire_record is None and self.training and self._is_rewire_step(self.topology_steps + 1):
+            self._rewire_record = []
+
+        if isinstance(x, PackedSequence):
+            return self.forward_sequences(x)
+
         if len(x.shape) == 1 and x.shape[0] != self._input_neurons:
             # treat input data as a sequence
-            if self._input_neurons != 1:
-                raise NotImplemented('TODO')
-
-            for idx, sample in enumerate(x.unsqueeze(-1)):
-                self.load_input_neurons(sample, force_retain_state=idx != 0)
-                self.step(n=self._steps)
+            self._check_1d_sequence()
+            self.state = self._run_sequence(x)
 
         else:
             self.load_input_neurons(x)
@@ -149,6 +432,185 @@ class PAGNNLayer(torch.nn.Module):
 
         return self.extract_output_neurons_data()
 
+    def forward_sequences(self, x, lengths=None):
+        """Batch of variable length sequences, returns the output neurons at each sequence's last real timestep.
+
+        `x` is a `PackedSequence` or a padded `(B, T)` / `(B, T, input_neurons)` tensor w/ the real `lengths` of it's
+        sequences (defaults to all T). Each sequence's state is frozen once it ends, so `self.state` holds the final
+        state of every sequence. Sequences are processed longest first & a step only touches the ones still running,
+        so padding is never computed. Bucketing batches by length (see `pagnn.utils.data.bucket_by_length`) keeps the
+        number of steps close to the real length of every sequence in the batch.
+        """
+
+        if isinstance(x, PackedSequence):
+            x, lengths = pad_packed_sequence(x, batch_first=True)
+        if len(x.shape) == 2:
+            x = x.unsqueeze(-1)
+        assert x.shape[-1] == self._input_neurons
+
+        B, T = x.shape[:2]
+        lengths = torch.full((B,), T) if lengths is None else torch.as_tensor(lengths).cpu()
+        assert lengths.shape[0] == B and lengths.max() <= T
+
+        # longest sequences first, then the sequences still running at step t are always the first `batch_sizes[t]`
+        order = lengths.argsort(descending=True)
+        batch_sizes = (lengths[order].unsqueeze(0) > torch.arange(T).unsqueeze(1)).sum(1).tolist()
+        x = x[order.to(x.device)].to(self.bias.dtype)
+
+        if self._retain_state and self.state is not None and self.state.shape == (B, self._total_neurons):
+            state = self.state[order.to(self.state.device)]
+        else:
+            state = torch.zeros((B, self._total_neurons), dtype=self.bias.dtype, device=self.bias.device)
+
+        for t, active in enumerate(batch_sizes):
+            if active <= 0:
+                break
+            self.state = self._with_inputs(state[:active], x[:active, t])
+            self.step(n=self._steps)
+            state = self.state if active == B else torch.cat((self.state, state[active:]))
+
+        self.state = state[order.argsort().to(state.device)]
+        return self.extract_output_neurons_data()
+
+    def functional_forward(self, x, state=None):
+        """Stateless `forward`, returns `(y, new_state)` & never mutates the layer.
+
+        `state` plays the part of the retained state (None starts from zeros) & is never modified in place, so a
+        single layer can be shared by any number of threads (or replicas) w/o locking, each carrying it's own state:
+
+            y, state = pagnn.functional_forward(x, state)
+        """
+
+        if len(x.shape) == 1 and x.shape[0] != self._input_neurons:
+            # treat input data as a sequence
+            self._check_1d_sequence()
+
+            if self._use_parallel_scan(x.shape[0]):
+                new_state = self._scan_sequence(x, state)
+            else:
+                new_state = state
+                if new_state is None:
+                    new_state = torch.zeros(self._total_neurons, dtype=self.bias.dtype, device=self.bias.device)
+                for sample in x.unsqueeze(-1):
+                    new_state = self._advance(self._with_inputs(new_state, sample), n=self._steps)
+
+        else:
+            if state is None:
+                state = torch.zeros(x.shape[:-1] + (self._total_neurons,), dtype=self.bias.dtype, device=self.bias.device)
+            new_state = self._advance(self._with_inputs(state, x), n=self._steps)
+
+        return new_state[..., self._outputs], new_state
+
+    def _check_1d_sequence(self):
+        if self._input_neurons != 1:
+            raise NotImplementedError('a 1D input is only treated as a sequence for layers w/ a single input neuron, '
+                                      'this one has %i. Pass multi-feature sequences as (T, input_neurons) chunks to '
+                                      '`forward_chunks` or as a batch to `forward_sequences`.' % self._input_neurons)
+
+    def _with_inputs(self, state, x):
+        """`load_input_neurons` w/o the in place write."""
+
+        assert x.shape[-1] == self._input_neurons
+        state = state.expand(x.shape[:-1] + state.shape[-1:])
+        return torch.cat((x.to(state.dtype), state[..., self._input_neurons:]), dim=-1)
+
+    def forward_chunks(self, x, chunk_size=4096, prefetch_chunks=0, retain_state=None):
+        """Feed a long 1D sequence through the network in chunks, yielding the output neurons after every chunk.
+
+        `x` is either a `(T,)` / `(T, input_neurons)` tensor (split into `chunk_size` chunks) or any iterable of such
+        chunks (ex. a generator reading a sensor stream from disk). The state is carried over from chunk to chunk but detached in between, so the
+        autograd graph (& memory) never spans more than a single chunk. Training on the yielded outputs is truncated
+        backprop through time:
+
+            for y in pagnn.forward_chunks(stream, chunk_size=1024):
+                loss = criterion(y, target)
+                ...
+
+        With `prefetch_chunks > 0` the next chunks are loaded (& moved to the layer's device) on a background thread
+        while the current one is computed. The first chunk starts from a zero state unless `retain_state` (defaults
+        to the layer's `retain_state`) is True.
+        """
+
+        retain_state = self._retain_state if retain_state is None else retain_state
+        chunks = x.split(chunk_size) if torch.is_tensor(x) else x
+        if prefetch_chunks > 0:
+            chunks = prefetch(chunks, n=prefetch_chunks, device=self.bias.device)
+
+        state = None
+        if retain_state and self.state is not None and self.state.dim() == 1:
+            state = self.state.detach()
+
+        for chunk in chunks:
+            chunk = torch.as_tensor(chunk, device=self.bias.device).reshape(-1, self._input_neurons).to(self.bias.dtype)
+            if chunk.shape[0] <= 0:
+                continue
+            self.state = self._run_sequence(chunk, state)
+            yield self.extract_output_neurons_data()
+            state = self.state.detach()
+
+    def _run_sequence(self, x, state=None):
+        """Final state after loading the sequence `x` (`(T,)` or `(T, input_neurons)`) sample by sample, starting from
+        `state` (zeros if None)."""
+
+        x = x.reshape(x.shape[0], self._input_neurons)
+
+        if self._use_parallel_scan(x.shape[0]):
+            return self._scan_sequence(x, state)
+
+        if state is not None:
+            # loading the inputs writes into the state in place, don't touch a tensor other graphs may still use
+            self.state = state.clone()
+        for idx, sample in enumerate(x):
+            self.load_input_neurons(sample, force_retain_state=idx != 0 or state is not None)
+            self.step(n=self._steps)
+        return self.state
+
+    def _use_parallel_scan(self, T):
+        if not self._linear or not torch.is_tensor(self.effective_weight()) or self._rewire_record is not None:
+            return False
+        if self.parallel_scan is not None:
+            return self.parallel_scan
+
+        # the scan trades T * steps matrix-vector products for ~log2(T) NxN matrix squarings, which only pays off
+        # when the sequence is long compared to the number of neurons.
+        return self._total_neurons * math.ceil(math.log2(max(T, 2))) <= 4 * T * self._steps
+
+    def _scan_sequence(self, x, state=None):
+        """Final state of the sequence `x` in O(log T) depth.
+
+        Loading `x_t` & taking the `steps` (w/o activations) is the affine map `s_t = s_{t-1} A + c_t`, where
+        `A = P W^steps` (`P` zeroes the input neurons, they get overwritten by the load) & `c_t = x_t W^steps[:inputs] + b_steps`.
+        The first sample starts from a zero state, so `s_T = sum_t c_t A^(T-1-t)`, which is reduced pairwise
+        (`c_{2i} A + c_{2i+1}`, then `A = A^2`) as a tree of batched matmuls instead of T sequential steps.
+        A non-zero starting `state` is simply the first element of the reduction (`s_0 = state A + c_0`).
+        """
+
+        W = self.effective_weight()
+        b = self.effective_bias()
+        N = self._total_neurons
+
+        W_steps = W
+        b_steps = b
+        for _ in range(self._steps - 1):
+            W_steps = W_steps.matmul(W)
+            b_steps = _pagnn_op(b_steps, W, b)
+
+        A = torch.cat((torch.zeros((self._input_neurons, N), dtype=W.dtype, device=W.device), W_steps[self._input_neurons:]))
+        x = x.reshape(x.shape[0], self._input_neurons).to(W.dtype)
+        c = torch.addmm(b_steps, x, W_steps[:self._input_neurons])
+        if state is not None:
+            c = torch.cat((state.unsqueeze(0), c))
+
+        while c.shape[0] > 1:
+            if c.shape[0] % 2 == 1:
+                # a zero element in front is neutral, the state before the first sample is all 0s
+                c = torch.cat((torch.zeros_like(c[:1]), c))
+            c = torch.addmm(c[1::2], c[0::2], A)
+            if c.shape[0] > 1:
+                A = A.matmul(A)
+
+        return c[0]
+
     def load_input_neurons(self, x, force_retain_state=None):
         retain_state = self._retain_state if force_retain_state is None else force_retain_state
 
@@ -168,41 +630,293 @@ class PAGNNLayer(torch.nn.Module):
             raise Exception()
 
     def extract_output_neurons_data(self):
-        if len(self.state.shape) == 1:
-            return self.state[-self._output_neurons:]
-        return self.state[:, -self._output_neurons:]
+        return self.state[..., self._outputs]
 
 
-    torch.no_grad()
+    @torch.no_grad()
     def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
                               missing_keys, unexpected_keys, error_msgs):
-        use_super_load = False
-        tensors = []
-
-        for name, param in self.named_parameters():
-            key = prefix + name
-            if key in state_dict:
-                input_param = state_dict[key]
-                
-                # if shapes are equal, can defer to default super loader
-                if input_param.shape == param.shape:
-                    use_super_load = True
-                    break
-
-                tensors.append(input_param)
-
-        if use_super_load:
-            super()._load_from_state_dict(state_dict, prefix, local_metadata, strict,
-                                          missing_keys, unexpected_keys, error_msgs)
-        else:
-            W, b = tensors
-            net = torch.nn.Linear(W.shape[1], W.shape[0])
+        """Besides it's own state dicts, loads FFNN ones (see `import_ffnn`) & converts between the dense & the sparse
+        (`edges`) layout: a sparse layer keeps the largest of a dense checkpoint's weights (as many as it has edges)."""
+
+        N = self._total_neurons
+        weight_key, bias_key = prefix + 'weight', prefix + 'bias'
+        edge_weight_key, edge_index_key = prefix + 'edges.weight', prefix + 'edges.index'
+        W = state_dict.get(weight_key)
+
+        if W is not None and W.shape != (N, N):
+            # a FFNN's (out_features, in_features) weight
+            b = state_dict.get(bias_key)
+            net = torch.nn.Linear(W.shape[1], W.shape[0], bias=b is not None)
             net.weight.data = W
-            net.bias.data = b
-            new_pagnn = import_ffnn(net, None)
-            self.weight.data = new_pagnn.weight.data
-            self.bias.data = new_pagnn.bias.data
+            if b is not None:
+                net.bias.data = b
+            imported = import_ffnn(net, None)
+            W = state_dict[weight_key] = imported.weight.data
+            state_dict[bias_key] = imported.bias.data
+
+        if self.edges is not None and W is not None:
+            del state_dict[weight_key]
+            keys = W.abs().view(-1).topk(self.edges.weight.shape[0]).indices.sort().values
+            state_dict[edge_weight_key] = W.view(-1)[keys]
+            state_dict[edge_index_key] = torch.stack((keys // N, keys % N))
+
+        if self.edges is None and edge_index_key in state_dict:
+            index, values = state_dict.pop(edge_index_key), state_dict.pop(edge_weight_key)
+            W = torch.zeros((N, N), dtype=values.dtype, device=values.device)
+            W.index_put_((index[0], index[1]), values, accumulate=True)
+            state_dict[weight_key] = W
+
+        if self.edges is not None and edge_index_key in state_dict:
+            E = state_dict[edge_index_key].shape[1]
+            if E != self.edges.weight.shape[0]:
+                # saved at another sparsity, take on the checkpoint's number of edges
+                self.edges = SparseEdges(N, E).to(self.bias.device)
+                self._sparsity = 1 - E / (N * N)
+
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict,
+                                      missing_keys, unexpected_keys, error_msgs)
+
+
+    def extra_repr(self):
+        return 'input_neurons=%i, output_neurons=%i, extra_neurons=%i, sparsity=%s' % (self._input_neurons, self._output_neurons, self._extra_neurons, self._sparsity)
+
+
+class GrowablePAGNNLayer(PAGNNLayer):
+    """PAGNNLayer whose number of extra (hidden) neurons can grow while training, see `grow`.
+
+    `weight` & `bias` reserve room for `capacity` neurons, only the first `_total_neurons` (the active ones) are ever
+    computed with (`weight[:N, :N]`, so no cost for the spare ones). Neurons are laid out as
+    `[inputs | outputs | extra | spare]`, a permutation of PAGNNLayer's `[inputs | extra | outputs]` (see
+    `to_pagnn_layer`), so a new neuron is simply the first spare one. Spare neurons never get a gradient, so their
+    weights & optimizer moments stay 0 until they're activated.
+
+    Once the capacity runs out it's multiplied by `growth_factor` (like a dynamic array), so the parameters (& the
+    optimizer's buffers, which are carried over) are only reallocated O(log N) times instead of once per neuron.
+
+    Loads it's own state dicts (of any capacity), plain PAGNNLayer ones & FFNN ones (same as PAGNNLayer), the neurons
+    of those are reordered into the growable layout (see `from_pagnn_layer`).
+    """
+
+    def __init__(self, input_neurons, output_neurons, extra_neurons=0, capacity=None, growth_factor=2, **kwargs):
+        assert kwargs.get('sparsity', 0) == 0, 'sparse layers can\'t grow'
+        assert growth_factor > 1
+
+        super().__init__(input_neurons, output_neurons, extra_neurons, **kwargs)
+
+        self.growth_factor = growth_factor
+        self._outputs = slice(input_neurons, input_neurons + output_neurons)
+        self._reserve(max(self._total_neurons, capacity or 0))
+
+    @property
+    def capacity(self):
+        return self.weight.shape[0]
+
+    def effective_weight(self):
+        if self.compressed_weight is not None:
+            return self.compressed_weight
+        N = self._total_neurons
+        return self.weight[:N, :N]
+
+    def effective_bias(self):
+        return self.bias[:self._total_neurons]
+
+    @torch.no_grad()
+    def _reserve(self, capacity, optimizer=None):
+        """Reallocate `weight` & `bias` w/ room for `capacity` neurons, moving `optimizer`'s state (ex. Adam moments)
+        over to the new parameters."""
+
+        old_weight, old_bias = self.weight, self.bias
+        C = old_weight.shape[0]
+        if capacity == C:
+            return
+
+        self.weight = torch.nn.Parameter(old_weight.new_zeros((capacity, capacity)))
+        self.bias = torch.nn.Parameter(old_bias.new_zeros(capacity))
+        self.weight[:C, :C] = old_weight
+        self.bias[:C] = old_bias
+
+        if optimizer is None:
+            return
+        for old, new in ((old_weight, self.weight), (old_bias, self.bias)):
+            for group in optimizer.param_groups:
+                group['params'] = [new if p is old else p for p in group['params']]
+            if old in optimizer.state:
+                state = optimizer.state.pop(old)
+                for key, value in state.items():
+                    if torch.is_tensor(value) and value.shape == old.shape:
+                        grown = value.new_zeros(new.shape)
+                        grown[tuple(slice(0, n) for n in value.shape)] = value
+                        state[key] = grown
+                optimizer.state[new] = state
+
+    @torch.no_grad()
+    def grow(self, n=1, optimizer=None):
+        """Activate `n` new extra neurons. Pass the `optimizer` training the layer, so it keeps training the (possibly
+        reallocated) parameters w/ it's existing moments.
+
+        A new neuron listens to every active neuron (random incoming weights, same distribution as the init) but it's
+        outgoing weights start at 0, so the layer computes exactly the same function until it trains them.
+        """
+
+        N = self._total_neurons
+        if N + n > self.capacity:
+            self._reserve(max(N + n, math.ceil(self.capacity * self.growth_factor)), optimizer)
+
+        bound = math.sqrt(6 / (N + n))
+        self.weight[:N + n, N:N + n].uniform_(-bound, bound)
+        self.weight[N:N + n].zero_()
+        self.bias[N:N + n] = 0
+
+        self._total_neurons += n
+        self._extra_neurons += n
+        if self.state is not None:
+            self.state = torch.cat((self.state, self.state.new_zeros(self.state.shape[:-1] + (n,))), dim=-1)
+
+    @classmethod
+    def from_pagnn_layer(cls, pagnn, capacity=None, growth_factor=2):
+        """Growable copy of a (dense) PAGNNLayer, the inverse of `to_pagnn_layer`."""
+
+        growable = cls(pagnn._input_neurons, pagnn._output_neurons, pagnn._extra_neurons, capacity=capacity,
+                       growth_factor=growth_factor, steps=pagnn._steps, retain_state=pagnn._retain_state,
+                       activation=pagnn.activation)
+        growable.load_state_dict(pagnn.state_dict())
+        return growable.to(pagnn.weight.device)
+
+    @torch.no_grad()
+    def to_pagnn_layer(self):
+        """Equivalent (fixed size) PAGNNLayer, w/ the neurons back in PAGNNLayer's order."""
+
+        I, O, N = self._input_neurons, self._output_neurons, self._total_neurons
+        order = torch.cat((torch.arange(I), torch.arange(I + O, N), torch.arange(I, I + O))).to(self.weight.device)
+
+        pagnn = PAGNNLayer(I, O, self._extra_neurons, steps=self._steps, retain_state=self._retain_state,
+                           activation=self.activation)
+        pagnn.weight.data = self.weight[:N, :N][order][:, order].clone()
+        pagnn.bias.data = self.bias[:N][order].clone()
+        return pagnn
+
+    def get_extra_state(self):
+        return {'extra_neurons': self._extra_neurons}
+
+    def set_extra_state(self, state):
+        # the parameters are already loaded (& big enough, see `_load_from_state_dict`)
+        self._extra_neurons = state['extra_neurons']
+        self._total_neurons = self._input_neurons + self._output_neurons + self._extra_neurons
+        if self.state is not None and self.state.shape[-1] != self._total_neurons:
+            self.reset_state(self.state.shape[:-1] + (self._total_neurons,))
+
+    @torch.no_grad()
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
+                              missing_keys, unexpected_keys, error_msgs):
+        W = state_dict.get(prefix + 'weight')
+        if W is not None and prefix + '_extra_state' not in state_dict:
+            # not one of ours: a PAGNNLayer (`[inputs | extra | outputs]`) or a FFNN (see `PAGNNLayer`), reorder it
+            b = state_dict.get(prefix + 'bias')
+            if W.dim() != 2 or W.shape[0] != W.shape[1]:
+                net = torch.nn.Linear(W.shape[1], W.shape[0], bias=b is not None)
+                net.weight.data = W
+                if net.bias is not None and b is not None:
+                    net.bias.data = b
+                imported = import_ffnn(net, None)
+                W, b = imported.weight.data, imported.bias.data
+
+            I, O, N = self._input_neurons, self._output_neurons, W.shape[0]
+            if N < I + O:
+                raise Exception('can\'t load a %ix%i weight into %s' % (N, N, self.__class__.__name__) +
+                                ' w/ %i input & %i output neurons' % (I, O))
+            order = torch.cat((torch.arange(I), torch.arange(N - O, N), torch.arange(I, N - O))).to(W.device)
+            state_dict[prefix + 'weight'] = W[order][:, order]
+            if b is not None:
+                state_dict[prefix + 'bias'] = b[order]
+            state_dict[prefix + '_extra_state'] = {'extra_neurons': N - I - O}
+            W = state_dict[prefix + 'weight']
+
+        if W is not None and W.shape != self.weight.shape:
+            # a checkpoint w/ another capacity, only it's active neurons have to fit
+            extra = state_dict.get(prefix + '_extra_state', {}).get('extra_neurons', self._extra_neurons)
+            N = self._input_neurons + self._output_neurons + extra
+            self._reserve(max(N, self.capacity))
+
+            weight, bias = torch.zeros_like(self.weight), torch.zeros_like(self.bias)
+            weight[:N, :N] = W[:N, :N]
+            bias[:N] = state_dict[prefix + 'bias'][:N]
+            state_dict[prefix + 'weight'], state_dict[prefix + 'bias'] = weight, bias
+
+        # skip PAGNNLayer's FFNN import
+        torch.nn.Module._load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
+                                              missing_keys, unexpected_keys, error_msgs)
+
+    def extra_repr(self):
+        return super().extra_repr() + ', capacity=%i' % self.capacity
+
+
+class PAGNNHead(torch.nn.Module):
+    """Compact stand-in for `PAGNNLayer(input_neurons, output_neurons, 0, steps=1, retain_state=False)`.
 
+    W/o extra neurons, a single step & no retained state, everything but the input -> output block of `W` (& the
+    output part of `b`) multiplies zeros, so only those are allocated: `I*O` instead of `(I+O)^2` weights (ex. 2048x1000
+    instead of 3048x3048 for a P-ResNet-50 head), w/ the exact same outputs.
+
+    Loads full size PAGNNLayer state dicts (the block is sliced out), `nn.Linear` ones (ex. torchvision's `fc`) &
+    it's own. `to_pagnn_layer` expands it back into a full PAGNNLayer.
+    """
+
+    def __init__(self, input_neurons, output_neurons):
+        super().__init__()
+
+        self._input_neurons = input_neurons
+        self._output_neurons = output_neurons
+        self._total_neurons = input_neurons + output_neurons
+
+        self.weight = torch.nn.Parameter(torch.empty((input_neurons, output_neurons)))
+        self.bias = torch.nn.Parameter(torch.zeros(output_neurons))
+
+        # same distribution as the block of a PAGNNLayer's (kaiming uniform over all N neurons) weight
+        bound = math.sqrt(6 / self._total_neurons)
+        torch.nn.init.uniform_(self.weight, -bound, bound)
+
+    def forward(self, x):
+        return _pagnn_op(x, self.weight, self.bias)
+
+    def get_extra_state(self):
+        # marks our own `(I, O)` weight, w/o it a square one can't be told apart from a `nn.Linear`'s `(O, I)`
+        return {'layout': 'pagnn'}
+
+    def set_extra_state(self, state):
+        pass
+
+    @torch.no_grad()
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
+                              missing_keys, unexpected_keys, error_msgs):
+        I, O, N = self._input_neurons, self._output_neurons, self._total_neurons
+        weight_key, bias_key = prefix + 'weight', prefix + 'bias'
+
+        if weight_key in state_dict and prefix + '_extra_state' not in state_dict:
+            # not one of ours, the layout comes from the shape (a square `I == O` one is taken as a `nn.Linear`)
+            W = state_dict[weight_key]
+            b = state_dict.get(bias_key)
+            if W.shape == (N, N):
+                # full PAGNNLayer
+                state_dict[weight_key] = W[:I, I:]
+                if b is not None:
+                    state_dict[bias_key] = b[I:]
+            elif W.shape == (O, I):
+                # nn.Linear (out_features, in_features)
+                state_dict[weight_key] = W.t()
+            # else one of ours from before the layout was saved
+            state_dict[prefix + '_extra_state'] = {'layout': 'pagnn'}
+
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict,
+                                      missing_keys, unexpected_keys, error_msgs)
+
+    @torch.no_grad()
+    def to_pagnn_layer(self):
+        pagnn = PAGNNLayer(self._input_neurons, self._output_neurons, 0, retain_state=False)
+        pagnn.zero_params()
+        pagnn.weight.data[:self._input_neurons, self._input_neurons:] = self.weight
+        pagnn.bias.data[self._input_neurons:] = self.bias
+        return pagnn.to(self.weight.device)
 
     def extra_repr(self):
-        return 'input_neurons=%i, output_neurons=%i, extra_neurons=%i' % (self._input_neurons, self._output_neurons, self._extra_neurons)
+        return 'input_neurons=%i, output_neurons=%i' % (self._input_neurons, self._output_neurons)
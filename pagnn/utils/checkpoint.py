@@ -0,0 +1,94 @@
+import os
+import shutil
+import threading
+from queue import Queue
+
+import torch
+
+
+def snapshot(obj):
+    """Deep copy of `obj` w/ every tensor copied to host memory, so training can keep mutating the originals."""
+
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def save_atomic(state, filename, best_filename=None):
+    """`torch.save` to a temp file that's renamed over `filename` once fully on disk, so a crash mid-write never
+    leaves a truncated checkpoint behind. `best_filename` becomes a hardlink to the same file (a copy only if the
+    filesystem can't link)."""
+
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
+    if best_filename is not None:
+        tmp = best_filename + '.tmp'
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        try:
+            os.link(filename, tmp)
+        except OSError:
+            shutil.copyfile(filename, tmp)
+        os.replace(tmp, best_filename)
+
+
+class AsyncCheckpointer:
+    """Writes checkpoints from a background thread.
+
+    `save` only snapshots the tensors to host memory (see `snapshot`) & returns, the write itself (see `save_atomic`)
+    overlaps w/ training. At most `max_pending` snapshots wait for the disk, after that `save` blocks (so a slow disk
+    can't pile up host memory). Errors from the writer are raised by the next `save` / `wait`.
+    """
+
+    def __init__(self, max_pending=1):
+        self._queue = Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                state, targets = job
+                for filename, best_filename in targets:
+                    save_atomic(state, filename, best_filename)
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def save(self, state, filename, best_filename=None):
+        """Queue `state` to be written to `filename` (a single path or a list of `(filename, best_filename)` pairs,
+        all written from the same snapshot)."""
+
+        self._raise()
+        targets = [(filename, best_filename)] if isinstance(filename, str) else list(filename)
+        self._queue.put((snapshot(state), targets))
+
+    def wait(self):
+        """Block until everything queued is on disk."""
+
+        self._queue.join()
+        self._raise()
+
+    def close(self):
+        self.wait()
+        self._queue.put(None)
+        self._thread.join()
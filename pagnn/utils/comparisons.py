@@ -1,24 +1,68 @@
+import hashlib
+import io
+import json
+import os
+import queue as queue_module
+import traceback
+
 import torch
+import torch.multiprocessing as mp
 from torch import nn
-from torch.utils.data import TensorDataset, DataLoader
 
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
+from pagnn.utils.data import TensorBatcher
+from pagnn.utils.watchdog import DivergenceWatchdog
+
 
 def count_params(model):
     return sum(dict((p.data_ptr(), p.numel()) for p in model.parameters()).values())
 
 
+class WindowDataset:
+    """Every (window, label) pair of a time series, as strided views into the series (nothing is copied).
+
+    Window i is `data[i:i+window]` & it's label the following `horizon` samples `data[i+window:i+window+horizon]`.
+    `data` is (T,) or (T, features). Indexing gives a single pair (so this also works w/ a `DataLoader`), `batches`
+    yields batches of windows sliced straight from the views.
+    """
+
+    def __init__(self, data, window, horizon=1):
+        data = torch.as_tensor(data)
+        assert window >= 1 and horizon >= 1
+
+        # (L, window + horizon) or (L, window + horizon, features), still sharing data's storage
+        windows = data.unfold(0, window + horizon, 1)
+        if data.dim() > 1:
+            windows = windows.movedim(-1, 1)
+
+        self.inputs = windows[:, :window]
+        self.labels = windows[:, window:]
+
+    def __len__(self):
+        return self.inputs.shape[0]
+
+    def __getitem__(self, idx):
+        return self.inputs[idx], self.labels[idx]
+
+    def __iter__(self):
+        return zip(self.inputs, self.labels)
+
+    def batches(self, batch_size, shuffle=False):
+        if shuffle:
+            idx = torch.randperm(len(self))
+            for i in range(0, len(self), batch_size):
+                batch = idx[i:i+batch_size]
+                yield self.inputs[batch], self.labels[batch]
+        else:
+            for i in range(0, len(self), batch_size):
+                yield self.inputs[i:i+batch_size], self.labels[i:i+batch_size]
+
+
 def create_inout_sequences(input_data, tw):
-    inout_seq = []
-    L = len(input_data)
-    for i in range(L-tw):
-        train_seq = input_data[i:i+tw]
-        train_label = input_data[i+tw:i+tw+1]
-        inout_seq.append((train_seq ,train_label))
-    return inout_seq
+    return list(WindowDataset(input_data, tw))
 
 
 class LSTM(nn.Module):
@@ -35,6 +79,12 @@ class LSTM(nn.Module):
                             torch.zeros(1,1,self.hidden_layer_size, device=device))
 
     def forward(self, input_seq):
+        if input_seq.dim() == 3:
+            # (B, T, features) batch of sequences (ex. from `WindowDataset.batches`), each starts from a zero hidden
+            # cell. (T,) & (T, features) are a single sequence
+            lstm_out, _ = self.lstm(input_seq.transpose(0, 1))
+            return self.linear(lstm_out[-1])
+
         lstm_out, self.hidden_cell = self.lstm(input_seq.view(len(input_seq) ,1, -1), self.hidden_cell)
         predictions = self.linear(lstm_out.view(len(input_seq), -1))
         return predictions[-1]
@@ -58,6 +108,74 @@ def one_hot(df, key):
     return pd.concat([df, pd.get_dummies(df[key], prefix=key)], axis=1).drop(key, axis=1)
 
 
+def encode_categorical(df, keys):
+    """One-hot encode all `keys` columns in a single pass, straight into a float32 array.
+
+    Same result (& column order) as `one_hot` called for every key in turn: the other columns first, then the
+    `key_category` columns of each key. Returns `(array, column names)`.
+    """
+
+    rest = [col for col in df.columns if col not in keys]
+    names = list(rest)
+    codes = []
+    for key in keys:
+        categorical = pd.Categorical(df[key])
+        # missing values are code -1 & stay all 0s, same as `get_dummies`
+        codes.append(np.where(categorical.codes >= 0, categorical.codes + len(names), -1))
+        names.extend('%s_%s' % (key, category) for category in categorical.categories)
+
+    out = np.zeros((len(df), len(names)), dtype=np.float32)
+    out[:, :len(rest)] = df[rest].to_numpy(dtype=np.float32)
+    rows = np.arange(len(df))
+    for code in codes:
+        valid = code >= 0
+        out[rows[valid], code[valid]] = 1
+
+    return out, names
+
+
+def _file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def load_categorical_csv(path, target_key, keys=None, cache_dir='.cache'):
+    """Features & targets of a categorical CSV as `(X, T)` tensors, ready for `split_train_and_test`.
+
+    Every `keys` column (by default all non-numeric columns except `target_key`) is one-hot encoded w/
+    `encode_categorical` & the targets are the category indices of `target_key`. The result is cached in `cache_dir`
+    as .npy files keyed by the hash of the CSV & the encoding, which later runs memory-map instead of re-parsing.
+    """
+
+    spec = json.dumps({'target_key': target_key, 'keys': keys, 'version': 1}, sort_keys=True)
+    key = hashlib.sha1((_file_hash(path) + spec).encode()).hexdigest()[:16]
+    X_path = os.path.join(cache_dir, '%s.X.npy' % key)
+    T_path = os.path.join(cache_dir, '%s.T.npy' % key)
+
+    if not (os.path.exists(X_path) and os.path.exists(T_path)):
+        df = pd.read_csv(path)
+        if keys is None:
+            keys = [col for col in df.columns if col != target_key and not pd.api.types.is_numeric_dtype(df[col])]
+
+        X, _ = encode_categorical(df.drop(target_key, axis=1), keys)
+        T = pd.Categorical(df[target_key]).codes.astype(np.int64)
+
+        # write then rename, so an interrupted run never leaves a truncated cache behind
+        os.makedirs(cache_dir, exist_ok=True)
+        for array, array_path in [(X, X_path), (T, T_path)]:
+            with open(array_path + '.tmp', 'wb') as f:
+                np.save(f, array)
+            os.replace(array_path + '.tmp', array_path)
+
+    # copy-on-write memory maps, pages are only read when touched & writes never go back to the cache
+    X = torch.from_numpy(np.load(X_path, mmap_mode='c'))
+    T = torch.from_numpy(np.load(T_path, mmap_mode='c'))
+    return X, T
+
+
 def normalize_inplace(df, key):
     df[key] = df[key] / np.linalg.norm(df[key])
 
@@ -74,6 +192,10 @@ def get_train_and_test(df, targets, train_perc, dtype=torch.float):
     X = torch.tensor(df.to_numpy(), dtype=dtype)
     T = torch.tensor(targets.to_numpy(), dtype=dtype)
     T = torch.argmax(T, dim=1)
+    return split_train_and_test(X, T, train_perc)
+
+
+def split_train_and_test(X, T, train_perc):
     split = int(train_perc * X.shape[0])
     train_X, test_X = X[:split], X[split:]
     train_T, test_T = T[:split], T[split:]
@@ -81,16 +203,64 @@ def get_train_and_test(df, targets, train_perc, dtype=torch.float):
     return (train_X, train_T), (test_X, test_T)
 
 
-def get_dataloaders(data_tensors, batch_size):
+def get_dataloaders(data_tensors, batch_size, **kwargs):
+    """`TensorBatcher`s over the train & test tensors, `kwargs` are passed to both (ex. device, prefetch)."""
+
     (train_X, train_T), (test_X, test_T) = data_tensors
 
-    train_dl = DataLoader(TensorDataset(train_X, train_T), batch_size=batch_size)
-    test_dl = DataLoader(TensorDataset(test_X, test_T), batch_size=batch_size)
+    train_dl = TensorBatcher(train_X, train_T, batch_size=batch_size, **kwargs)
+    test_dl = TensorBatcher(test_X, test_T, batch_size=batch_size, **kwargs)
 
     return train_dl, test_dl
 
 
-def compare(model_dicts, train_dl, test_dl, epochs, criterion, use_tqdm=True, test_accuracy=False, device=torch.device('cpu'), flat_dim=None, pruner=None):
+class TopologyStep:
+    """`pruner` for `compare` that does the dynamic sparse training of every sparse PAGNNLayer in `model` (see
+    `PAGNNLayer.topology_step`). Picklable, so it works w/ `workers > 1`."""
+
+    def __init__(self, model, optimizer):
+        self.model = model
+        self.optimizer = optimizer
+
+    def __call__(self):
+        step = True
+        for module in self.model.modules():
+            if getattr(module, 'edges', None) is not None:
+                step = module.topology_step(self.optimizer) and step
+        return step
+
+
+def topology_counters(model):
+    """The rewiring progress of the sparse PAGNNLayers in `model`, it isn't part of their state dicts."""
+
+    return {name: (module.topology_steps, module.rewired_edges) for name, module in model.named_modules()
+            if getattr(module, 'edges', None) is not None}
+
+
+def load_topology_counters(model, counters):
+    modules = dict(model.named_modules())
+    for name, (topology_steps, rewired_edges) in counters.items():
+        modules[name].topology_steps = topology_steps
+        modules[name].rewired_edges = rewired_edges
+
+
+def compare(model_dicts, train_dl, test_dl, epochs, criterion, use_tqdm=True, test_accuracy=False, device=torch.device('cpu'), flat_dim=None, pruner=None, stop_diverged=True, divergence_check_freq=50, workers=1, history_callback=None):
+    """Train & test every model in `model_dicts` side by side.
+
+    If `stop_diverged` is True, each model gets a `DivergenceWatchdog` (unless it's dict already provides one under
+    'watchdog') that checks the loss & state every batch, it's gradient norm & spectral radius every
+    `divergence_check_freq` batches (when it also syncs to check for divergence). A model that diverges stops training for the rest of the comparison & is marked with
+    `model_dict['diverged'] = True`, so the compute goes to the models that can still recover.
+
+    With `workers > 1` the models are trained in parallel, each in it's own process (see `_compare_parallel`).
+    `history_callback(model_dict, key, value)` is called whenever a value is appended to one of the histories.
+    """
+
+    if workers > 1:
+        return _compare_parallel(model_dicts, train_dl, test_dl, epochs, criterion, workers, history_callback,
+                                 test_accuracy=test_accuracy, device=device, flat_dim=flat_dim, pruner=pruner,
+                                 stop_diverged=stop_diverged, divergence_check_freq=divergence_check_freq)
+
     if pruner is None:
         pruner = lambda: True
 
@@ -98,25 +268,34 @@ def compare(model_dicts, train_dl, test_dl, epochs, criterion, use_tqdm=True, te
         for model_dict in model_dicts:
             model_dict['train_history'] = []
             model_dict['test_history'] = []
+            model_dict['diverged'] = False
+            if stop_diverged and model_dict.get('watchdog') is None:
+                model_dict['watchdog'] = DivergenceWatchdog(model_dict['model'], check_freq=divergence_check_freq)
 
         for epoch in range(epochs):
             print('epoch', epoch)
 
             for model_dict in model_dicts:
+                if model_dict['diverged']:
+                    continue
+
                 model = model_dict['model']
                 model_name = model_dict['name']
                 optimizer = model_dict['optimizer']
+                watchdog = model_dict.get('watchdog')
+                model_pruner = pruner if model_dict.get('pruner') is None else model_dict['pruner']
 
                 with torch.enable_grad():
                     model.train()
-                    total_loss = 0
+                    # metrics are accumulated on the device, `.item()` would sync every batch
+                    total_loss = torch.zeros((), device=device)
 
                     # do the training epoch
                     iterator = train_dl
                     if use_tqdm:
                         iterator = tqdm(iterator, desc='[train] %s' % (model_name), total=len(iterator))
 
-                    for x, t in iterator:
+                    for batch_idx, (x, t) in enumerate(iterator):
                         if flat_dim is not None:
                             x = x.flatten(flat_dim)
 
@@ -131,22 +310,33 @@ def compare(model_dicts, train_dl, test_dl, epochs, criterion, use_tqdm=True, te
                         y = model(x)
 
                         loss = criterion(y, t)
-                        total_loss += loss.item()
+                        total_loss += loss.detach()
 
                         loss.backward()
 
-                        if pruner():
+                        if watchdog is not None:
+                            watchdog.observe(loss)
+                            if (batch_idx + 1) % divergence_check_freq == 0 and watchdog.diverged():
+                                break
+
+                        if model_pruner():
                             optimizer.step()
 
-                    avg_loss = total_loss / len(train_dl)
+                    avg_loss = total_loss.item() / len(train_dl)
                     print('[%s] training loss: %f' % (model_name, avg_loss))
                     model_dict['train_history'].append(avg_loss)
+                    if history_callback is not None:
+                        history_callback(model_dict, 'train_history', avg_loss)
 
+                if watchdog is not None and watchdog.diverged():
+                    print('[%s] diverged (%s), skipping it for the remaining epochs' % (model_name, watchdog.reason))
+                    model_dict['diverged'] = True
+                    continue
 
                 model.eval()
                 with torch.no_grad():
-                    total_correct = 0
-                    total_loss = 0
+                    total_correct = torch.zeros((), dtype=torch.long, device=device)
+                    total_loss = torch.zeros((), device=device)
 
                     iterator = test_dl
                     if use_tqdm:
@@ -166,18 +356,120 @@ def compare(model_dicts, train_dl, test_dl, epochs, criterion, use_tqdm=True, te
 
                         if test_accuracy:
                             pred = torch.argmax(y, axis=1)
-                            total_correct += torch.sum(pred == t).item()
+                            total_correct += torch.sum(pred == t)
                         else:
-                            total_loss += criterion(y, t).item()
+                            total_loss += criterion(y, t)
 
                     if test_accuracy:
-                        accuracy = total_correct / len(test_dl.dataset)
-                        print('[%s] testing accuracy:' % model_name, accuracy)
-                        model_dict['test_history'].append(accuracy)
+                        value = total_correct.item() / len(test_dl.dataset)
+                        print('[%s] testing accuracy:' % model_name, value)
                     else:
-                        avg_loss = total_loss / len(test_dl)
-                        print('[%s] testing loss: %f' % (model_name, avg_loss))
-                        model_dict['test_history'].append(avg_loss)
+                        value = total_loss.item() / len(test_dl)
+                        print('[%s] testing loss: %f' % (model_name, value))
+                    model_dict['test_history'].append(value)
+                    if history_callback is not None:
+                        history_callback(model_dict, 'test_history', value)
+
+    except KeyboardInterrupt:
+        print('early exit keyboard interrupt')
+
+
+def _compare_worker(idx, model_dict, train_dl, test_dl, epochs, criterion, threads, queue, kwargs):
+    torch.set_num_threads(threads)
+
+    def history_callback(model_dict, key, value):
+        queue.put((idx, key, value))
+
+    try:
+        compare([model_dict], train_dl, test_dl, epochs, criterion, use_tqdm=False, history_callback=history_callback,
+                **kwargs)
+        # sent as bytes, tensors would be shared through file descriptors that die w/ this process
+        result = io.BytesIO()
+        pruner = model_dict.get('pruner')
+        torch.save({
+            'model': model_dict['model'].state_dict(),
+            'optimizer': model_dict['optimizer'].state_dict(),
+            'topology_counters': topology_counters(model_dict['model']),
+            'pruner': pruner.state_dict() if _syncs_state(pruner) else None,
+            'diverged': model_dict['diverged'],
+        }, result)
+        queue.put((idx, 'done', result.getvalue()))
+    except BaseException:
+        queue.put((idx, 'error', traceback.format_exc()))
+
+
+def _syncs_state(pruner):
+    return hasattr(pruner, 'state_dict') and hasattr(pruner, 'load_state_dict')
+
+
+def _compare_parallel(model_dicts, train_dl, test_dl, epochs, criterion, workers, history_callback, poll_timeout=1,
+                      **kwargs):
+    """`compare`, but every model trains in it's own (spawned) process, `workers` at a time.
+
+    The CPU threads are split evenly between the workers. Histories are streamed back to the parent as they are
+    recorded (so they fill up while the models train) & once a model is done it's trained weights, optimizer state &
+    rewiring progress (see `topology_counters`) are loaded back into the parent's model / optimizer. So is the state
+    of a model dict's own 'pruner' if it has `state_dict` & `load_state_dict` (ex. `NMSparsityScheduler`'s masks),
+    anything else a pruner changes in the worker (incl. a shared `pruner` argument) is lost w/ the worker's copy.
+    Everything in a model dict (& the data loaders, criterion & pruner) has to be picklable, so no lambdas (ex. as
+    activations).
+
+    A worker that dies w/o reporting back (ex. killed for running out of memory) raises, the queue is polled every
+    `poll_timeout` seconds to notice.
+    """
+
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    threads = max(1, torch.get_num_threads() // workers)
+
+    for model_dict in model_dicts:
+        model_dict['train_history'] = []
+        model_dict['test_history'] = []
+        model_dict['diverged'] = False
+
+    pending = list(range(len(model_dicts)))
+    running = {}
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < workers:
+                idx = pending.pop(0)
+                process = ctx.Process(target=_compare_worker, args=(idx, model_dicts[idx], train_dl, test_dl, epochs,
+                                                                    criterion, threads, queue, kwargs), daemon=True)
+                process.start()
+                running[idx] = process
+
+            try:
+                idx, key, value = queue.get(timeout=poll_timeout)
+            except queue_module.Empty:
+                for idx, process in running.items():
+                    # a clean exit has already queued it's result
+                    if process.exitcode not in (None, 0):
+                        raise Exception('[%s] worker died (exit code %i)' % (model_dicts[idx]['name'],
+                                                                             process.exitcode))
+                continue
+
+            model_dict = model_dicts[idx]
+            if key == 'error':
+                raise Exception('[%s] worker failed:\n%s' % (model_dict['name'], value))
+
+            if key == 'done':
+                value = torch.load(io.BytesIO(value), map_location='cpu')
+                model_dict['model'].load_state_dict(value['model'])
+                model_dict['optimizer'].load_state_dict(value['optimizer'])
+                load_topology_counters(model_dict['model'], value['topology_counters'])
+                if value['pruner'] is not None:
+                    model_dict['pruner'].load_state_dict(value['pruner'])
+                model_dict['diverged'] = value['diverged']
+                running.pop(idx).join()
+                continue
+
+            model_dict[key].append(value)
+            if history_callback is not None:
+                history_callback(model_dict, key, value)
 
     except KeyboardInterrupt:
         print('early exit keyboard interrupt')
+
+    finally:
+        for process in running.values():
+            process.terminate()
@@ -0,0 +1,106 @@
+"""Connectivity analysis of a PAGNN's adjacency structure.
+
+`s_k = s_0 W^k` (+ bias terms), so after `k` steps an output neuron only sees the inputs w/ a walk of exactly `k`
+edges to it. Outputs no input reaches are the "empty output neurons" from the README. Everything here works on the
+edge list (sparse boolean matrix products & vectorized label propagation), so it stays cheap for large sparse layers
+& can be run every so often during sparse training:
+
+    if len(dead_outputs(pagnn)) > 0:
+        print('some outputs are disconnected from the inputs')
+"""
+
+import torch
+
+
+@torch.no_grad()
+def edge_index(pagnn, threshold=0):
+    """(sources, targets) of every edge of `pagnn` w/ `|w| > threshold`."""
+
+    if pagnn.edges is not None and pagnn.compressed_weight is None:
+        keep = pagnn.edges.weight.detach().abs() > threshold
+        return pagnn.edges.index[0][keep], pagnn.edges.index[1][keep]
+    return (pagnn.dense_weight().abs() > threshold).nonzero(as_tuple=True)
+
+
+@torch.no_grad()
+def reachability(pagnn, k=None, within=False, threshold=0):
+    """(input_neurons, output_neurons) bool matrix, True where the input reaches the output in exactly `k` steps
+    (defaults to the layer's steps), or in at most `k` steps w/ `within=True`.
+
+    A batched BFS from all inputs at once: the frontier is advanced w/ a sparse (N x N) x (N x inputs) product.
+    """
+
+    k = pagnn._steps if k is None else k
+    N = pagnn._total_neurons
+    sources, targets = edge_index(pagnn, threshold=threshold)
+    device = sources.device
+
+    # A^T, so `A_T @ frontier` moves every input's frontier one edge forward
+    A_T = torch.sparse_coo_tensor(torch.stack((targets, sources)), torch.ones(sources.shape[0], device=device),
+                                  (N, N)).coalesce()
+
+    frontier = torch.zeros((N, pagnn._input_neurons), device=device)
+    frontier[torch.arange(pagnn._input_neurons), torch.arange(pagnn._input_neurons)] = 1
+    reached = torch.zeros_like(frontier, dtype=torch.bool)
+    for _ in range(k):
+        frontier = (torch.sparse.mm(A_T, frontier) > 0).float()
+        reached |= frontier.bool()
+
+    reached = reached if within else frontier.bool()
+    return reached[pagnn._outputs].t()
+
+
+def receptive_sets(pagnn, k=None, within=False, threshold=0):
+    """The input neurons each output neuron sees, as a list of index tensors (one per output)."""
+
+    reach = reachability(pagnn, k=k, within=within, threshold=threshold)
+    return [reach[:, o].nonzero().view(-1) for o in range(pagnn._output_neurons)]
+
+
+def dead_outputs(pagnn, k=None, within=False, threshold=0):
+    """Indices (among the outputs) of the output neurons that no input reaches."""
+
+    reach = reachability(pagnn, k=k, within=within, threshold=threshold)
+    return (~reach.any(0)).nonzero().view(-1)
+
+
+@torch.no_grad()
+def strongly_connected_components(pagnn, threshold=0):
+    """SCC label of every neuron (labels are 0..C-1), via vectorized forward/backward label propagation.
+
+    Each round every unassigned neuron takes the largest id that can reach it (the "color"). Neurons that keep their
+    own id are roots & their SCC is everything of the same color that can reach back to them. Those get removed &
+    the next round runs on the rest of the graph.
+    """
+
+    N = pagnn._total_neurons
+    sources, targets = edge_index(pagnn, threshold=threshold)
+    device = sources.device
+    ids = torch.arange(N, device=device)
+
+    labels = torch.full((N,), -1, dtype=torch.long, device=device)
+    while (labels < 0).any():
+        active = labels < 0
+        live = active[sources] & active[targets]
+        src, tgt = sources[live], targets[live]
+
+        color = torch.where(active, ids, torch.full_like(ids, -1))
+        while True:
+            new_color = color.scatter_reduce(0, tgt, color[src], reduce='amax', include_self=True)
+            if torch.equal(new_color, color):
+                break
+            color = new_color
+
+        member = active & (color == ids)
+        same = color[src] == color[tgt]
+        src, tgt = src[same], tgt[same]
+        while True:
+            new_member = member.clone()
+            new_member[src[member[tgt]]] = True
+            if torch.equal(new_member, member):
+                break
+            member = new_member
+
+        labels[member] = color[member]
+
+    return labels.unique(return_inverse=True)[1]
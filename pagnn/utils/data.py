@@ -0,0 +1,145 @@
+import random
+import threading
+from queue import Queue, Empty, Full
+
+import torch
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import TensorDataset
+
+
+_END = object()
+
+
+def prefetch(iterable, n=1, device=None):
+    """Iterate `iterable` from a background thread, keeping up to `n` items ready ahead of the consumer.
+
+    Overlaps producing the next item (reading a file, decoding, host -> device copies when `device` is given) with
+    whatever the consumer does with the current one. Memory is bounded by the `n` queued items. Exceptions raised by
+    the producer are re-raised in the consumer. If the consumer stops early (ex. `break`), the thread stops too.
+    """
+
+    queue = Queue(maxsize=max(1, n))
+    stop = threading.Event()
+
+    def put(item):
+        # w/ a timeout, so a full queue nobody reads anymore can't block the thread forever
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.05)
+                return True
+            except Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for item in iterable:
+                if device is not None:
+                    item = _to(item, device)
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(e)
+        finally:
+            put(_END)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item = queue.get()
+            if item is _END:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # also runs when the generator is closed early, drop the queued items & let the thread finish
+        stop.set()
+        try:
+            while True:
+                queue.get_nowait()
+        except Empty:
+            pass
+        thread.join()
+
+
+def _to(item, device):
+    if torch.is_tensor(item):
+        return item.to(device, non_blocking=True)
+    if isinstance(item, (tuple, list)):
+        return type(item)(_to(v, device) for v in item)
+    return torch.as_tensor(item).to(device, non_blocking=True)
+
+
+def bucket_by_length(sequences, batch_size, targets=None, shuffle=True):
+    """Batch variable length sequences w/ others of similar length, yielding `(padded, lengths)` (or
+    `(padded, lengths, targets)`) batches for `PAGNNLayer.forward_sequences`.
+
+    Sequences are sorted by length before batching, so a batch only pads (& steps) up to it's own longest sequence.
+    With `shuffle` the order of the batches (not their contents) is shuffled every time this is iterated.
+    """
+
+    lengths = torch.tensor([len(seq) for seq in sequences])
+    order = lengths.argsort(descending=True).tolist()
+    batches = [order[i:i+batch_size] for i in range(0, len(order), batch_size)]
+    if shuffle:
+        random.shuffle(batches)
+
+    for batch in batches:
+        padded = pad_sequence([torch.as_tensor(sequences[i]) for i in batch], batch_first=True)
+        if targets is None:
+            yield padded, lengths[batch]
+        else:
+            yield padded, lengths[batch], torch.as_tensor(targets)[batch]
+
+
+class TensorBatcher:
+    """Drop-in `DataLoader(TensorDataset(*tensors), batch_size)` replacement for in-memory tensors.
+
+    Batches are contiguous slices of the backing tensors instead of per-sample indexing & collating. With `shuffle`
+    the tensors are gathered through a single permutation per epoch, then sliced. `device` keeps the tensors resident
+    on that device (no per-batch copies at all), `pin_memory` pins them for faster async host -> GPU copies & with
+    `prefetch > 0` the next batches are prepared (& moved to `prefetch_device`) on a background thread.
+
+    Like a `DataLoader`, `len()` is the number of batches & `.dataset` the underlying dataset.
+    """
+
+    def __init__(self, *tensors, batch_size=1, shuffle=False, drop_last=False, device=None, pin_memory=False,
+                 prefetch=0, prefetch_device=None):
+        assert len(tensors) > 0
+        assert all(t.shape[0] == tensors[0].shape[0] for t in tensors)
+
+        if device is not None:
+            tensors = tuple(t.to(device) for t in tensors)
+        elif pin_memory and torch.cuda.is_available():
+            tensors = tuple(t.pin_memory() for t in tensors)
+
+        self.tensors = tensors
+        self.dataset = TensorDataset(*tensors)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.prefetch = prefetch
+        self.prefetch_device = prefetch_device
+
+    def __len__(self):
+        n = self.tensors[0].shape[0]
+        if self.drop_last:
+            return n // self.batch_size
+        return (n + self.batch_size - 1) // self.batch_size
+
+    def _batches(self):
+        tensors = self.tensors
+        if self.shuffle:
+            perm = torch.randperm(tensors[0].shape[0], device=tensors[0].device)
+            tensors = tuple(t[perm] for t in tensors)
+
+        for i in range(len(self)):
+            yield tuple(t[i*self.batch_size:(i+1)*self.batch_size] for t in tensors)
+
+    def __iter__(self):
+        if self.prefetch > 0:
+            return prefetch(self._batches(), n=self.prefetch, device=self.prefetch_device)
+        return self._batches()
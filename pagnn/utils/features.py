@@ -0,0 +1,261 @@
+"""Backbone feature cache, for PAGNN head experiments on a frozen P-ResNet.
+
+The backbone (`conv1` ... `avgpool`) runs once over a dataset & the pooled features are written to a memory mapped
+cache, the head then trains straight from the cache:
+
+    python -m pagnn.utils.features extract -a p_resnet50 --pretrained --data /imagenet/train --output /features/train --augmentations 4
+    python -m pagnn.utils.features extract -a p_resnet50 --pretrained --data /imagenet/val --output /features/val
+    python -m pagnn.utils.features train --train /features/train --val /features/val --extra-neurons 100 --steps 2
+
+`--data` can be an ImageFolder or a directory of pre-decoded shards (see `pagnn.utils.shards`).
+"""
+
+import argparse
+import copy
+import json
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from pagnn.pagnn import PAGNNLayer
+from pagnn.utils.data import prefetch
+from pagnn.utils.metrics import MetricAccumulator
+
+
+def _transform(augment, sharded):
+    import torchvision.transforms as transforms
+
+    normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+    crop = [transforms.RandomResizedCrop(224), transforms.RandomHorizontalFlip()] if augment else \
+           [transforms.CenterCrop(224)] if sharded else [transforms.Resize(256), transforms.CenterCrop(224)]
+    # shards are already resized uint8 tensors, ImageFolder gives PIL images
+    to_tensor = [transforms.ConvertImageDtype(torch.float)] if sharded else [transforms.ToTensor()]
+    return transforms.Compose(crop + to_tensor + [normalize])
+
+
+def image_dataset(path, augment=False):
+    """ImageFolder / shards at `path` w/ the standard ImageNet eval (or, if `augment`, train) transforms."""
+
+    from pagnn.utils.shards import ShardedImageDataset, is_sharded
+
+    if is_sharded(path):
+        return ShardedImageDataset(path, _transform(augment, True), shuffle=False, rank=0, world_size=1)
+
+    import torchvision.datasets as datasets
+    return datasets.ImageFolder(path, _transform(augment, False))
+
+
+@torch.no_grad()
+def extract_features(model, dataset, output_dir, augmented_dataset=None, augmentations=0, batch_size=256,
+                     workers=4, device=torch.device('cpu'), dtype=np.float16, seed=0):
+    """Run `model.forward_features` (a P-ResNet's backbone) over `dataset` once & write the features to `output_dir`.
+
+    W/ `augmentations > 0`, `augmented_dataset` (the same samples in the same order, but w/ random augmentations) is
+    run that many more times instead, each pass w/ it's own fixed seed, so the cache holds a fixed set of augmented
+    copies of every sample. Features are stored as `dtype` (fp16 halves the size of the cache, the pooled features
+    don't need more). Like the shards, the cache is only valid once `meta.json` is written. `model` itself is left
+    untouched, a copy of it is moved to `device` & optimized for inference.
+    """
+
+    model = copy.deepcopy(model).to(device).eval()
+    if hasattr(model, 'optimize_for_inference'):
+        model.optimize_for_inference()
+
+    passes = [(augmented_dataset, seed + i) for i in range(augmentations)] if augmentations > 0 else [(dataset, seed)]
+    count = len(dataset)
+    os.makedirs(output_dir, exist_ok=True)
+
+    features = labels = None
+    start = time.time()
+    for p, (pass_dataset, pass_seed) in enumerate(passes):
+        # seeds the augmentations (& the DataLoader workers' RNGs), the same seed gives the same copy
+        torch.manual_seed(pass_seed)
+        loader = torch.utils.data.DataLoader(pass_dataset, batch_size=batch_size, shuffle=False, num_workers=workers,
+                                             pin_memory=device.type == 'cuda')
+
+        i = 0
+        for images, targets in prefetch(loader, n=2, device=device):
+            X = model.forward_features(images).cpu().numpy()
+
+            if features is None:
+                features = np.lib.format.open_memmap(os.path.join(output_dir, 'features.tmp.npy'), mode='w+',
+                                                     dtype=dtype, shape=(len(passes), count, X.shape[1]))
+                labels = np.zeros(count, dtype=np.int64)
+
+            features[p, i:i + len(X)] = X
+            labels[i:i + len(X)] = targets.cpu().numpy()
+            i += len(X)
+
+        assert i == count, 'expected %i samples, got %i' % (count, i)
+        print('=> pass %i/%i: %i samples (%.1f samples/s)' % (p + 1, len(passes), count,
+                                                            (p + 1) * count / (time.time() - start)))
+
+    features.flush()
+    del features
+    os.replace(os.path.join(output_dir, 'features.tmp.npy'), os.path.join(output_dir, 'features.npy'))
+    np.save(os.path.join(output_dir, 'labels.npy'), labels)
+    with open(os.path.join(output_dir, 'meta.json'), 'w') as f:
+        json.dump({'count': count, 'copies': len(passes), 'augmented': augmentations > 0}, f)
+
+
+def is_feature_cache(path):
+    return os.path.isfile(os.path.join(path, 'meta.json'))
+
+
+class FeatureCache:
+    """Reads a cache written by `extract_features`, features stay memory mapped (never fully loaded into memory)."""
+
+    def __init__(self, root):
+        with open(os.path.join(root, 'meta.json')) as f:
+            self.meta = json.load(f)
+
+        self.root = root
+        self.features = np.load(os.path.join(root, 'features.npy'), mmap_mode='r')
+        self.labels = np.load(os.path.join(root, 'labels.npy'))
+        self.copies, self.count, self.dim = self.features.shape
+
+    def __len__(self):
+        return self.count
+
+    def batches(self, batch_size, shuffle=False, clone=None, rng=None):
+        """`(features, labels)` float32 & int64 tensor batches.
+
+        Every sample is read from one of it's (augmented) copies: `clone` if given, otherwise a random one when
+        `shuffle`ing (a fresh augmentation every epoch, like training on the images) & the first one if not.
+        """
+
+        rng = rng if rng is not None else np.random.default_rng()
+        order = rng.permutation(self.count) if shuffle else np.arange(self.count)
+
+        for start in range(0, self.count, batch_size):
+            # sorted reads are (mostly) sequential in the memory map, the order inside a batch doesn't matter
+            idx = np.sort(order[start:start + batch_size])
+            if clone is not None:
+                X = self.features[clone, idx]
+            elif shuffle and self.copies > 1:
+                X = self.features[rng.integers(self.copies, size=len(idx)), idx]
+            else:
+                X = self.features[0, idx]
+
+            yield torch.from_numpy(X.astype(np.float32)), torch.from_numpy(self.labels[idx])
+
+
+def evaluate_head(head, cache, batch_size=1024, device=torch.device('cpu')):
+    """{'loss', 'acc1', 'acc5'} of `head` over (the first copy of) every sample in `cache`."""
+
+    criterion = nn.CrossEntropyLoss()
+    metrics = MetricAccumulator()
+    head.eval()
+    with torch.no_grad():
+        for X, T in prefetch(cache.batches(batch_size), n=2, device=device):
+            y = head(X)
+            metrics.update(y, T, criterion(y, T))
+    return metrics.compute()
+
+
+def train_head(head, train_cache, val_cache=None, epochs=10, batch_size=256, lr=0.1, momentum=0.9,
+               weight_decay=1e-4, device=torch.device('cpu'), seed=0, print_freq=100):
+    """Train `head` (ex. a `PAGNNLayer`) on cached backbone features, SGD w/ a cosine schedule. Returns the metrics of
+    every epoch (& the validation metrics, if `val_cache` is given)."""
+
+    head = head.to(device)
+    criterion = nn.CrossEntropyLoss()
+    optimizer = torch.optim.SGD(head.parameters(), lr, momentum=momentum, weight_decay=weight_decay)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, epochs)
+    rng = np.random.default_rng(seed)
+
+    history = []
+    for epoch in range(epochs):
+        head.train()
+        metrics = MetricAccumulator()
+        start = time.time()
+        batches = train_cache.batches(batch_size, shuffle=True, rng=rng)
+        for i, (X, T) in enumerate(prefetch(batches, n=2, device=device)):
+            y = head(X)
+            loss = criterion(y, T)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            metrics.update(y, T, loss)
+
+            if print_freq and i % print_freq == 0:
+                print('Epoch: [%i][%i]\t%s' % (epoch, i, metrics))
+        scheduler.step()
+
+        results = {'epoch': epoch, 'train': metrics.compute(), 'seconds': time.time() - start}
+        if val_cache is not None:
+            results['val'] = evaluate_head(head, val_cache, device=device)
+        print('=> epoch %i (%.1fs): train %s%s' % (epoch, results['seconds'], results['train'],
+                                                  ', val %s' % results['val'] if 'val' in results else ''))
+        history.append(results)
+
+    return history
+
+
+parser = argparse.ArgumentParser(description='Backbone feature cache & head-only training for P-ResNets')
+subparsers = parser.add_subparsers(dest='command', required=True)
+
+extract_parser = subparsers.add_parser('extract', help='run the backbone over a dataset & cache the features')
+extract_parser.add_argument('-a', '--arch', default='p_resnet50')
+extract_parser.add_argument('--pretrained', action='store_true', help='torchvision ImageNet weights')
+extract_parser.add_argument('--checkpoint', default=None, help='train_imagenet.py checkpoint to take the backbone from')
+extract_parser.add_argument('--data', required=True, help='ImageFolder or shards directory')
+extract_parser.add_argument('--output', required=True)
+extract_parser.add_argument('--augmentations', default=0, type=int,
+                            help='number of randomly augmented copies to cache (0: a single un-augmented copy)')
+extract_parser.add_argument('-b', '--batch-size', default=256, type=int)
+extract_parser.add_argument('-j', '--workers', default=4, type=int)
+extract_parser.add_argument('--fp32', action='store_true', help='store fp32 features (default is fp16)')
+
+train_parser = subparsers.add_parser('train', help='train a PAGNN head on cached features')
+train_parser.add_argument('--train', required=True)
+train_parser.add_argument('--val', default=None)
+train_parser.add_argument('--classes', default=1000, type=int)
+train_parser.add_argument('--extra-neurons', default=0, type=int)
+train_parser.add_argument('--steps', default=1, type=int)
+train_parser.add_argument('--sparsity', default=0, type=float)
+train_parser.add_argument('--epochs', default=10, type=int)
+train_parser.add_argument('-b', '--batch-size', default=256, type=int)
+train_parser.add_argument('--lr', default=0.1, type=float)
+train_parser.add_argument('--momentum', default=0.9, type=float)
+train_parser.add_argument('--wd', '--weight-decay', default=1e-4, type=float, dest='weight_decay')
+train_parser.add_argument('--output', default=None, help='where to save the trained head (see `serving.load_model`)')
+
+
+def main(args):
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+
+    if args.command == 'extract':
+        from pagnn import p_resnet
+
+        model = p_resnet.__dict__[args.arch](pretrained=args.pretrained)
+        if args.checkpoint is not None:
+            state_dict = torch.load(args.checkpoint, map_location='cpu')['state_dict']
+            model.load_state_dict({k[len('module.'):] if k.startswith('module.') else k: v
+                                   for k, v in state_dict.items()})
+
+        extract_features(model, image_dataset(args.data), args.output,
+                         augmented_dataset=image_dataset(args.data, augment=True) if args.augmentations else None,
+                         augmentations=args.augmentations, batch_size=args.batch_size, workers=args.workers,
+                         device=device, dtype=np.float32 if args.fp32 else np.float16)
+        return
+
+    from pagnn.utils.serving import save_pagnn_checkpoint
+
+    train_cache = FeatureCache(args.train)
+    val_cache = FeatureCache(args.val) if args.val is not None else None
+    head = PAGNNLayer(train_cache.dim, args.classes, args.extra_neurons, steps=args.steps, sparsity=args.sparsity,
+                      retain_state=False)
+    train_head(head, train_cache, val_cache, epochs=args.epochs, batch_size=args.batch_size, lr=args.lr,
+               momentum=args.momentum, weight_decay=args.weight_decay, device=device)
+
+    if args.output is not None:
+        save_pagnn_checkpoint(head.cpu(), args.output)
+        print('=> saved head to %s' % args.output)
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
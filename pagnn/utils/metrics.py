@@ -0,0 +1,72 @@
+import torch
+
+
+class MetricAccumulator:
+    """Running loss & top-k accuracy, accumulated as device tensors.
+
+    `update` never syncs w/ the host (unlike `loss.item()` / a python-side average), only `compute` (& printing) does,
+    so call those every `print_freq` batches or at the end of an epoch. Printing shows the averages over the current
+    window & (in brackets) over everything so far, same as an `AverageMeter`. The window is the batches since the last
+    `reset_window` (`ProgressMeter.display` calls it after every print), printing itself doesn't change anything.
+    """
+
+    def __init__(self, topk=(1, 5)):
+        self.topk = topk
+        self.names = ['Loss'] + ['Acc@%i' % k for k in topk]
+        self.reset()
+
+    def reset(self):
+        self._sums = None
+        self._window = None
+        self.count = 0
+        self._window_count = 0
+
+    @torch.no_grad()
+    def update(self, output, target, loss=None):
+        n = target.shape[0]
+        maxk = min(max(self.topk), output.shape[1])
+        pred = output.topk(maxk, 1, True, True).indices
+        correct = pred.eq(target.view(-1, 1))
+
+        values = [loss.detach().float() * n if loss is not None else torch.zeros((), device=output.device)]
+        values += [correct[:, :k].any(1).sum().float() for k in self.topk]
+        values = torch.stack(values)
+
+        if self._sums is None:
+            self._sums = torch.zeros_like(values)
+            self._window = torch.zeros_like(values)
+        self._sums += values
+        self._window += values
+        self.count += n
+        self._window_count += n
+
+    def reset_window(self):
+        if self._window is not None:
+            self._window.zero_()
+        self._window_count = 0
+
+    def _averages(self, sums, count):
+        averages = (sums / max(count, 1)).tolist()
+        # loss is a plain average, accuracies are in percent
+        return [averages[0]] + [100 * v for v in averages[1:]]
+
+    def compute(self):
+        """{'loss': average loss, 'acc1': top-1 accuracy (%), ...} over everything so far (syncs)."""
+
+        keys = ['loss'] + ['acc%i' % k for k in self.topk]
+        if self._sums is None:
+            return dict.fromkeys(keys, 0.0)
+        return dict(zip(keys, self._averages(self._sums, self.count)))
+
+    def __str__(self):
+        if self._sums is None:
+            return ''
+
+        # a single transfer for both the window & the running averages
+        sums, window = torch.stack((self._sums, self._window)).cpu()
+        averages = self._averages(sums, self.count)
+        window_averages = self._averages(window, self._window_count)
+
+        fmts = ['{:.4e}'] + ['{:6.2f}'] * len(self.topk)
+        return '\t'.join('{} {} ({})'.format(name, fmt.format(w), fmt.format(a))
+                         for name, fmt, w, a in zip(self.names, fmts, window_averages, averages))
@@ -0,0 +1,150 @@
+from collections import defaultdict
+
+import torch
+
+
+def pruner_masks(pruner):
+    """{param: bool mask} of every weight masked by `pruner` (a `RigLScheduler` or `NMSparsityScheduler`)."""
+
+    if hasattr(pruner, 'backward_masks'):
+        # rigl-torch keeps None masks for the layers it leaves dense
+        return {w: mask for w, mask in zip(pruner.W, pruner.backward_masks) if mask is not None}
+    return {layer.weight: mask for layer, mask in zip(pruner.layers, pruner.masks)}
+
+
+class SparseStateOptimizer:
+    """Wraps an optimizer so masked weights only keep optimizer state for their active edges.
+
+    Momentum / Adam's moments for a masked weight normally stay dense (NxN for a PAGNN), even at 90% sparsity. Here
+    each masked weight is represented to the wrapped optimizer by a flat "shadow" parameter holding only it's active
+    entries, so the optimizer state scales w/ the number of non-zeros. When the topology changes (`mask_fn` returns a
+    different mask) the state of surviving edges is remapped & new edges start w/ fresh state.
+
+    Usage:
+        optimizer = SparseStateOptimizer(torch.optim.Adam, model.parameters(), lr=0.01)
+        pruner = RigLScheduler(model, optimizer, ...)
+        optimizer.mask_fn = lambda: pruner_masks(pruner)
+
+    Checking for topology changes costs a gather over the active edges & a sync every step.
+    """
+
+    def __init__(self, optimizer_cls, params, mask_fn=None, **kwargs):
+        params = list(params)
+        if len(params) > 0 and not isinstance(params[0], dict):
+            params = [{'params': params}]
+
+        self.mask_fn = mask_fn
+        self.optimizer = optimizer_cls([dict(group, params=list(group['params'])) for group in params], **kwargs)
+        self.params = [p for group in self.optimizer.param_groups for p in group['params']]
+
+        # masked param -> (shadow param, flat indices of it's active entries)
+        self._shadows = {}
+
+        # only here for schedulers that poke at optimizer state (ex. RigL's momentum reset), masked weights have none
+        self.state = defaultdict(dict)
+
+    @property
+    def param_groups(self):
+        return self.optimizer.param_groups
+
+    @torch.no_grad()
+    def _replace(self, old, new):
+        for group in self.optimizer.param_groups:
+            for i, p in enumerate(group['params']):
+                if p is old:
+                    group['params'][i] = new
+        if old in self.optimizer.state:
+            self.optimizer.state[new] = self.optimizer.state.pop(old)
+
+    @torch.no_grad()
+    def _set_indices(self, param, idx):
+        shadow = torch.nn.Parameter(param.detach().view(-1)[idx].clone())
+
+        if param in self._shadows:
+            old_shadow, old_idx = self._shadows[param]
+            state = self.optimizer.state.pop(old_shadow, {})
+            self._replace(old_shadow, shadow)
+
+            # remap the state of surviving edges, both index lists are sorted so no dense lookup table is needed
+            pos = torch.searchsorted(old_idx, idx).clamp_max(max(len(old_idx) - 1, 0))
+            found = old_idx[pos] == idx if len(old_idx) > 0 else torch.zeros_like(idx, dtype=torch.bool)
+            for key, value in state.items():
+                if torch.is_tensor(value) and value.shape == old_idx.shape and value.dim() == 1:
+                    remapped = torch.zeros(idx.shape, dtype=value.dtype, device=value.device)
+                    remapped[found] = value[pos[found]]
+                    state[key] = remapped
+            self.optimizer.state[shadow] = state
+        else:
+            # a dense weight that just became masked, keep the state of it's active entries
+            state = self.optimizer.state.pop(param, {})
+            self._replace(param, shadow)
+            for key, value in state.items():
+                if torch.is_tensor(value) and value.shape == param.shape:
+                    state[key] = value.view(-1)[idx].clone()
+            if len(state) > 0:
+                self.optimizer.state[shadow] = state
+
+        self._shadows[param] = (shadow, idx)
+
+    @torch.no_grad()
+    def sync_masks(self):
+        if self.mask_fn is None:
+            return
+
+        for param, mask in self.mask_fn().items():
+            flat_mask = mask.view(-1)
+            if param in self._shadows:
+                idx = self._shadows[param][1]
+                if int(flat_mask.sum()) == len(idx) and bool(flat_mask[idx].all()):
+                    continue # topology didn't change
+            self._set_indices(param, flat_mask.nonzero().view(-1))
+
+    def step(self, closure=None):
+        self.sync_masks()
+
+        with torch.no_grad():
+            for param, (shadow, idx) in self._shadows.items():
+                # the pruner may have touched the weights (ex. zeroing dropped edges), they are the source of truth
+                shadow.copy_(param.view(-1)[idx])
+                shadow.grad = None if param.grad is None else param.grad.view(-1)[idx]
+
+        loss = self.optimizer.step(closure)
+
+        with torch.no_grad():
+            for param, (shadow, idx) in self._shadows.items():
+                param.view(-1).index_copy_(0, idx, shadow)
+        return loss
+
+    def zero_grad(self, set_to_none=True):
+        for p in self.params:
+            if p.grad is None:
+                continue
+            if set_to_none:
+                p.grad = None
+            else:
+                p.grad.zero_()
+        for shadow, _ in self._shadows.values():
+            shadow.grad = None
+
+    def state_nbytes(self):
+        total = 0
+        for state in self.optimizer.state.values():
+            for value in state.values():
+                if torch.is_tensor(value):
+                    total += value.numel() * value.element_size()
+        return total
+
+    def state_dict(self):
+        return {
+            'optimizer': self.optimizer.state_dict(),
+            'indices': [self._shadows[p][1] if p in self._shadows else None for p in self.params],
+        }
+
+    def load_state_dict(self, state_dict):
+        for param, idx in zip(self.params, state_dict['indices']):
+            if idx is not None:
+                self._set_indices(param, idx.to(param.device))
+        self.optimizer.load_state_dict(state_dict['optimizer'])
+
+    def __repr__(self):
+        return 'SparseStateOptimizer(%s, masked_params=%i)' % (self.optimizer.__class__.__name__, len(self._shadows))
@@ -0,0 +1,345 @@
+"""Local micro-batching inference server for PAGNN & P-ResNet models.
+
+Concurrent requests are coalesced into batches (bounded by `max_batch_size` & `max_wait_ms`), so the per-request
+overhead that dominates small PAGNNs is paid once per batch. When the queue is full new requests are rejected
+(HTTP 503) instead of piling up.
+
+    python -m pagnn.utils.serving --checkpoint model.pth.tar --port 8080
+
+    POST /predict   {"inputs": [...]}  -> {"outputs": [...]}     (a single sample per request)
+    GET  /stats                        -> latency / throughput / batching stats
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from pagnn.pagnn import PAGNNLayer, ACTIVATIONS, identity
+
+
+class ServerBusy(Exception):
+    pass
+
+
+def _activation_name(activation):
+    if activation is identity:
+        return None
+    for name, fn in ACTIVATIONS.items():
+        if fn is activation:
+            return name
+    raise Exception('activation %s can\'t be saved by name, add it to `pagnn.pagnn.ACTIVATIONS`' % activation)
+
+
+def save_pagnn_checkpoint(pagnn, path):
+    """Save a PAGNNLayer w/ everything needed to rebuild it in `load_model` (the activation by name, see
+    `ACTIVATIONS`)."""
+
+    torch.save({
+        'arch': 'PAGNNLayer',
+        'kwargs': {
+            'input_neurons': pagnn._input_neurons,
+            'output_neurons': pagnn._output_neurons,
+            'extra_neurons': pagnn._extra_neurons,
+            'steps': pagnn._steps,
+            'sparsity': pagnn._sparsity,
+            'activation': _activation_name(pagnn.activation),
+        },
+        'state_dict': pagnn.state_dict(),
+    }, path)
+
+
+def load_model(path, activation=None, map_location='cpu'):
+    """Load a PAGNNLayer checkpoint (see `save_pagnn_checkpoint`) or a P-ResNet checkpoint from train_imagenet.py.
+
+    A PAGNNLayer gets the activation it was saved with, `activation` overrides it (ex. for checkpoints w/o one).
+    """
+
+    checkpoint = torch.load(path, map_location=map_location)
+    arch = checkpoint['arch']
+
+    # (Distributed)DataParallel checkpoints prefix everything w/ 'module.'
+    state_dict = {k[len('module.'):] if k.startswith('module.') else k: v for k, v in checkpoint['state_dict'].items()}
+
+    if arch == 'PAGNNLayer':
+        kwargs = dict(checkpoint['kwargs'])
+        name = kwargs.pop('activation', None)
+        if activation is None:
+            activation = ACTIVATIONS[name]
+        model = PAGNNLayer(**kwargs, retain_state=False, activation=activation)
+    else:
+        from pagnn import p_resnet
+        if arch not in p_resnet.__all__:
+            raise Exception('arch %s not found.' % arch)
+        fc_weight = state_dict['fc.weight']
+        model = p_resnet.__dict__[arch](compact_head=fc_weight.shape[0] != fc_weight.shape[1])
+
+    model.load_state_dict(state_dict)
+    model.eval()
+    if arch != 'PAGNNLayer':
+        # BN folded into the convs & the PAGNN head frozen, see `ResNet.optimize_for_inference`
+        model.optimize_for_inference()
+    return model
+
+
+class MicroBatcher:
+    """Coalesces concurrent `predict` calls into batches for `model`.
+
+    A single worker runs the batches (on a thread, so the event loop keeps accepting requests meanwhile), so
+    stateful models like PAGNNLayer are never run concurrently.
+
+    Requests are checked against `input_shape` (`None` for dimensions of any size) before they're queued, so a bad
+    request is rejected on it's own instead of failing the whole batch it would've been stacked into. It defaults
+    to `(input_neurons,)` for PAGNNLayers & `(channels, None, None)` for P-ResNets.
+    """
+
+    def __init__(self, model, max_batch_size=64, max_wait_ms=2, max_queue_size=1024, device=torch.device('cpu'),
+                 input_shape=None):
+        self.model = model.to(device)
+        self.model.eval()
+        self.device = device
+        self.input_shape = _input_shape(model) if input_shape is None else tuple(input_shape)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue_size = max_queue_size
+
+        self.queue = None
+        self._task = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+        self.requests = 0
+        self.batches = 0
+        self.rejected = 0
+        self.latencies = deque(maxlen=10000)
+        self.start_time = time.perf_counter()
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        self.start_time = time.perf_counter()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _check(self, x):
+        x = torch.as_tensor(x, dtype=torch.float)
+        shape = self.input_shape
+        if shape is not None and (x.dim() != len(shape) or
+                                  any(d is not None and d != n for d, n in zip(shape, x.shape))):
+            expected = tuple('*' if d is None else d for d in shape)
+            raise ValueError('expected a single input of shape %s, got %s' % (str(expected), str(tuple(x.shape))))
+        return x
+
+    async def predict(self, x):
+        x = self._check(x)
+        if self.queue.full():
+            self.rejected += 1
+            raise ServerBusy('queue is full (%i requests)' % self.queue.qsize())
+
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((x, future, time.perf_counter()))
+        return await future
+
+    @torch.no_grad()
+    def _infer(self, X):
+        return self.model(X.to(self.device)).cpu()
+
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+        items = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+
+        while len(items) < self.max_batch_size:
+            if not self.queue.empty():
+                items.append(self.queue.get_nowait())
+                continue
+
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return items
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = await self._next_batch()
+
+            # inputs w/ free dimensions (ex. image sizes) can differ, those are stacked into a batch per shape
+            groups = {}
+            for item in items:
+                groups.setdefault(tuple(item[0].shape), []).append(item)
+
+            for group in groups.values():
+                try:
+                    X = torch.stack([x for x, _, _ in group])
+                    Y = await loop.run_in_executor(self._executor, self._infer, X)
+                except Exception as e:
+                    for _, future, _ in group:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+
+                now = time.perf_counter()
+                for (_, future, start), y in zip(group, Y):
+                    if not future.done():
+                        future.set_result(y)
+                    self.latencies.append(now - start)
+
+                self.requests += len(group)
+                self.batches += 1
+
+    def stats(self):
+        latencies = np.array(self.latencies) * 1000
+        elapsed = time.perf_counter() - self.start_time
+        stats = {
+            'requests': self.requests,
+            'batches': self.batches,
+            'avg_batch_size': self.requests / max(self.batches, 1),
+            'rejected': self.rejected,
+            'queue_size': 0 if self.queue is None else self.queue.qsize(),
+            'throughput': self.requests / max(elapsed, 1e-9),
+        }
+        if len(latencies) > 0:
+            stats['latency_ms'] = {
+                'mean': float(latencies.mean()),
+                'p50': float(np.percentile(latencies, 50)),
+                'p95': float(np.percentile(latencies, 95)),
+                'p99': float(np.percentile(latencies, 99)),
+            }
+        return stats
+
+
+def _input_shape(model):
+    if hasattr(model, '_input_neurons'):
+        return (model._input_neurons,)
+    if isinstance(getattr(model, 'conv1', None), torch.nn.Conv2d):
+        return (model.conv1.in_channels, None, None)
+    return None
+
+
+def _http_response(writer, status, payload):
+    reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 503: 'Service Unavailable'}
+    body = json.dumps(payload).encode()
+    writer.write(('HTTP/1.1 %i %s\r\nContent-Type: application/json\r\nContent-Length: %i\r\n\r\n'
+                  % (status, reasons[status], len(body))).encode() + body)
+
+
+def _is_numeric(value):
+    if isinstance(value, list):
+        return all(_is_numeric(v) for v in value)
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _parse_inputs(body):
+    """The `inputs` of a /predict body as a float tensor, ValueError if it isn't a json object w/ a (nested) list of
+    numbers under 'inputs'."""
+
+    payload = json.loads(body)
+    if not isinstance(payload, dict) or 'inputs' not in payload:
+        raise ValueError('expected a json object w/ "inputs"')
+    if not isinstance(payload['inputs'], list) or not _is_numeric(payload['inputs']):
+        raise ValueError('"inputs" must be a (nested) list of numbers')
+    return torch.tensor(payload['inputs'], dtype=torch.float)
+
+
+async def _read_request(reader):
+    """(method, path, headers, body) of the next request, None once the client is done. ValueError if it's malformed."""
+
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode().split(' ', 2)
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, value = line.decode().split(':', 1)
+        headers[key.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return method, path, headers, body
+
+
+def make_handler(batcher):
+    async def handle(reader, writer):
+        try:
+            while True:
+                try:
+                    request = await _read_request(reader)
+                except ValueError as e: # incl. UnicodeDecodeError
+                    # can't tell where the next request would start, so this is the last one
+                    _http_response(writer, 400, {'error': 'malformed request: %s' % e})
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+
+                if method == 'GET' and path == '/stats':
+                    _http_response(writer, 200, batcher.stats())
+                elif method == 'POST' and path == '/predict':
+                    try:
+                        y = await batcher.predict(_parse_inputs(body))
+                        _http_response(writer, 200, {'outputs': y.tolist()})
+                    except ServerBusy as e:
+                        _http_response(writer, 503, {'error': str(e)})
+                    except (ValueError, TypeError, KeyError, RuntimeError) as e:
+                        _http_response(writer, 400, {'error': str(e)})
+                else:
+                    _http_response(writer, 404, {'error': 'unknown route %s %s' % (method, path)})
+
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return handle
+
+
+async def serve(model, host='127.0.0.1', port=8080, **batcher_kwargs):
+    batcher = MicroBatcher(model, **batcher_kwargs)
+    await batcher.start()
+    server = await asyncio.start_server(make_handler(batcher), host, port)
+    print('serving %s on http://%s:%i' % (model.__class__.__name__, host, port))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await batcher.stop()
+
+
+parser = argparse.ArgumentParser(description='PAGNN / P-ResNet micro-batching inference server')
+parser.add_argument('--checkpoint', required=True, help='PAGNNLayer or P-ResNet checkpoint')
+parser.add_argument('--host', default='127.0.0.1')
+parser.add_argument('--port', default=8080, type=int)
+parser.add_argument('--max-batch-size', default=64, type=int)
+parser.add_argument('--max-wait-ms', default=2, type=float, help='how long to wait for a batch to fill up')
+parser.add_argument('--max-queue-size', default=1024, type=int, help='requests beyond this are rejected w/ a 503')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    model = load_model(args.checkpoint)
+    asyncio.run(serve(model, host=args.host, port=args.port, max_batch_size=args.max_batch_size,
+                      max_wait_ms=args.max_wait_ms, max_queue_size=args.max_queue_size, device=device))
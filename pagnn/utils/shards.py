@@ -0,0 +1,198 @@
+"""Pre-decoded image shards, so training doesn't decode & resize every JPEG every epoch.
+
+Convert an ImageFolder style dataset (ex. ImageNet's train/ & val/) once:
+
+    python -m pagnn.utils.shards --data /imagenet --output /imagenet-shards --size 256
+
+Every image is resized (shorter side) & center cropped to `size x size`, then written as raw uint8 HWC pixels into
+large sequential shard files, w/ the labels next to them & an index.json per split. `ShardedImageDataset` streams
+them back w/ memory maps.
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+def _load_image(args):
+    from PIL import Image
+
+    path, size = args
+    with open(path, 'rb') as f:
+        image = Image.open(f).convert('RGB')
+
+    # same as transforms.Resize(size) + transforms.CenterCrop(size)
+    w, h = image.size
+    scale = size / min(w, h)
+    image = image.resize((max(size, round(w * scale)), max(size, round(h * scale))), Image.BILINEAR)
+    w, h = image.size
+    left, top = (w - size) // 2, (h - size) // 2
+    return np.asarray(image.crop((left, top, left + size, top + size)), dtype=np.uint8)
+
+
+def convert_image_folder(folder, output_dir, size=256, images_per_shard=5000, workers=0, seed=0):
+    """Convert the ImageFolder at `folder` into shards in `output_dir`.
+
+    Samples are shuffled once before sharding, so every shard holds a mix of classes (ImageFolder lists them class
+    by class) & reading a shard sequentially is already close to random order.
+    """
+
+    from torchvision.datasets import ImageFolder
+
+    dataset = ImageFolder(folder)
+    samples = list(dataset.samples)
+    random.Random(seed).shuffle(samples)
+    os.makedirs(output_dir, exist_ok=True)
+
+    pool = Pool(workers) if workers > 0 else None
+    shards = []
+    try:
+        for shard_idx, start in enumerate(range(0, len(samples), images_per_shard)):
+            chunk = samples[start:start + images_per_shard]
+            name = 'shard-%05i' % shard_idx
+            jobs = [(path, size) for path, _ in chunk]
+            images = pool.imap(_load_image, jobs, chunksize=16) if pool is not None else map(_load_image, jobs)
+
+            # write then rename, a half written shard is never picked up
+            with open(os.path.join(output_dir, name + '.bin.tmp'), 'wb') as f:
+                for image in images:
+                    f.write(image.tobytes())
+            os.replace(os.path.join(output_dir, name + '.bin.tmp'), os.path.join(output_dir, name + '.bin'))
+            np.save(os.path.join(output_dir, name + '.labels.npy'), np.array([t for _, t in chunk], dtype=np.int64))
+
+            shards.append({'name': name, 'count': len(chunk)})
+            print('=> wrote %s (%i/%i images)' % (name, start + len(chunk), len(samples)))
+    finally:
+        if pool is not None:
+            pool.close()
+
+    with open(os.path.join(output_dir, 'index.json'), 'w') as f:
+        json.dump({'size': size, 'classes': dataset.classes, 'shards': shards}, f)
+
+
+def is_sharded(path):
+    return os.path.isfile(os.path.join(path, 'index.json'))
+
+
+class ShardedImageDataset(torch.utils.data.IterableDataset):
+    """Streams the shards written by `convert_image_folder` as `(transform(image), label)` pairs.
+
+    `image` is a uint8 CHW tensor. Shards are read sequentially through memory maps & split between the distributed
+    ranks & the DataLoader workers of each rank at the sample level (see `_my_segments`), every rank gets `len(self)`
+    samples. Samples are shuffled through a `shuffle_buffer` sized buffer & the shard order is
+    reshuffled every epoch (see `set_epoch`, call it before every epoch like a `DistributedSampler`).
+    """
+
+    def __init__(self, root, transform=None, shuffle=True, shuffle_buffer=10000, seed=0, rank=None, world_size=None):
+        super().__init__()
+
+        with open(os.path.join(root, 'index.json')) as f:
+            index = json.load(f)
+
+        self.root = root
+        self.size = index['size']
+        self.classes = index['classes']
+        self.shards = index['shards']
+        self.transform = transform
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+
+        distributed = dist.is_available() and dist.is_initialized()
+        self.rank = rank if rank is not None else (dist.get_rank() if distributed else 0)
+        self.world_size = world_size if world_size is not None else (dist.get_world_size() if distributed else 1)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        # every rank gets exactly the same number of samples (the remainder is dropped), so DDP ranks run the same
+        # number of batches
+        return sum(shard['count'] for shard in self.shards) // self.world_size
+
+    def _my_segments(self):
+        """`(shard, start, end)` ranges of samples for this rank & DataLoader worker.
+
+        The (shuffled) shards are laid end to end & split at the sample level: each rank gets a contiguous range of
+        `len(self)` samples & each worker an (almost) equal part of it's rank's range, so reads stay sequential.
+        """
+
+        shards = list(self.shards)
+        if self.shuffle:
+            # same order on every rank (same seed), so the split below stays disjoint
+            random.Random(self.seed + self.epoch).shuffle(shards)
+
+        worker_info = torch.utils.data.get_worker_info()
+        workers = 1 if worker_info is None else worker_info.num_workers
+        worker_id = 0 if worker_info is None else worker_info.id
+
+        per_rank = len(self)
+        rank_start = self.rank * per_rank
+        begin = rank_start + per_rank * worker_id // workers
+        end = rank_start + per_rank * (worker_id + 1) // workers
+
+        offset = 0
+        for shard in shards:
+            lo, hi = max(begin, offset), min(end, offset + shard['count'])
+            if lo < hi:
+                yield shard, lo - offset, hi - offset
+            offset += shard['count']
+
+    def _samples(self):
+        for shard, start, end in self._my_segments():
+            images = np.memmap(os.path.join(self.root, shard['name'] + '.bin'), dtype=np.uint8, mode='r',
+                               shape=(shard['count'], self.size, self.size, 3))
+            labels = np.load(os.path.join(self.root, shard['name'] + '.labels.npy'))
+            for image, label in zip(images[start:end], labels[start:end]):
+                yield image, int(label)
+
+    def _shuffled(self, samples):
+        rng = random.Random(self.seed + self.epoch * 1000 + self.rank)
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            i = rng.randrange(len(buffer))
+            yield buffer[i]
+            buffer[i] = sample
+
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self):
+        samples = self._samples()
+        if self.shuffle and self.shuffle_buffer > 1:
+            samples = self._shuffled(samples)
+
+        for image, label in samples:
+            # copy out of the read-only memory map
+            image = torch.from_numpy(np.array(image)).permute(2, 0, 1)
+            if self.transform is not None:
+                image = self.transform(image)
+            yield image, label
+
+
+parser = argparse.ArgumentParser(description='Convert an ImageFolder dataset (ex. ImageNet) into pre-decoded shards')
+parser.add_argument('--data', required=True, help='dataset root, every split (ex. train/ & val/) is converted')
+parser.add_argument('--output', required=True)
+parser.add_argument('--splits', default='train,val')
+parser.add_argument('--size', default=256, type=int, help='images are resized & center cropped to size x size')
+parser.add_argument('--images-per-shard', default=5000, type=int)
+parser.add_argument('-j', '--workers', default=4, type=int, help='number of decoding processes')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    for split in args.splits.split(','):
+        print('=> converting %s' % split)
+        convert_image_folder(os.path.join(args.data, split), os.path.join(args.output, split), size=args.size,
+                             images_per_shard=args.images_per_shard, workers=args.workers)
@@ -0,0 +1,272 @@
+import torch
+import torch.nn.functional as F
+
+from pagnn.pagnn import PAGNNLayer, _distributed
+
+
+def _group_rows(tensor, m, fill=0):
+    """Pads the rows of `tensor` to a multiple of `m` & reshapes it into (groups, m, columns)."""
+
+    pad = (-tensor.shape[0]) % m
+    if pad > 0:
+        tensor = F.pad(tensor, (0, 0, 0, pad), value=fill)
+    return tensor.view(-1, m, tensor.shape[1])
+
+
+def nm_mask(weight, n, m, scores=None):
+    """Boolean N:M mask for a PAGNN `weight`.
+
+    Rows are the reduction dimension of `s_{t+1} = s_t W`, so every output neuron (column) keeps the `n` highest
+    scoring incoming edges out of every group of `m` consecutive input neurons (rows). `scores` defaults to `|weight|`.
+    """
+
+    assert 0 < n <= m
+    if scores is None:
+        scores = weight.detach().abs()
+
+    R = scores.shape[0]
+    grouped = _group_rows(scores, m, fill=float('-inf'))
+    idx = grouped.topk(n, dim=1).indices
+    mask = torch.zeros_like(grouped, dtype=torch.bool).scatter_(1, idx, True)
+    return mask.view(-1, scores.shape[1])[:R]
+
+
+def is_nm_sparse(weight, n, m):
+    """Returns True if every column of `weight` has at most `n` non-zeros per group of `m` rows."""
+
+    nonzero = _group_rows((weight != 0).to(torch.int32), m)
+    return bool((nonzero.sum(1) <= n).all())
+
+
+class NMSparseWeight:
+    """Compressed storage for an N:M sparse PAGNN `weight`.
+
+    Only the `n` kept values of each group of `m` rows are stored, along with their position inside the group as a
+    uint8. For 2:4 that is 50% of the values + 1 byte per kept value instead of the full dense NxN matrix, & that is
+    all the matmul ever keeps around (see `rmatmul`). Both are stored per output neuron (column), `(columns, groups * n)`,
+    so the incoming edges of a neuron are contiguous.
+    """
+
+    # upper bound on the elements of the gathered state in `rmatmul`, columns are processed in chunks to respect it
+    max_chunk_elements = 2 ** 22
+
+    def __init__(self, values, indices, n, m, shape):
+        self.values = values
+        self.indices = indices
+        self.n = n
+        self.m = m
+        self.shape = tuple(shape)
+
+    @classmethod
+    @torch.no_grad()
+    def from_dense(cls, weight, n, m):
+        weight = weight.detach()
+        scores = _group_rows(weight.abs(), m, fill=float('-inf'))
+        idx = scores.topk(n, dim=1).indices.sort(dim=1).values
+        values = _group_rows(weight, m).gather(1, idx)
+
+        # (groups, n, columns) -> (columns, groups * n)
+        C = weight.shape[1]
+        values = values.permute(2, 0, 1).reshape(C, -1).contiguous()
+        idx = idx.permute(2, 0, 1).reshape(C, -1).to(torch.uint8).contiguous()
+        return cls(values, idx, n, m, weight.shape)
+
+    @property
+    def device(self):
+        return self.values.device
+
+    def to(self, *args, **kwargs):
+        values = self.values.to(*args, **kwargs)
+        return NMSparseWeight(values, self.indices.to(values.device), self.n, self.m, self.shape)
+
+    def nbytes(self):
+        """Every byte the compressed weight keeps (the values & their uint8 positions, nothing else is cached)."""
+
+        return self.values.numel() * self.values.element_size() + self.indices.numel() * self.indices.element_size()
+
+    def _rows(self, columns=slice(None)):
+        # row of every kept value: it's group's first row + it's position inside the group (int32, half the
+        # transient memory of int64 indices)
+        K = self.values.shape[1]
+        offsets = torch.arange(K, dtype=torch.int32, device=self.device) // self.n * self.m
+        return offsets + self.indices[columns]
+
+    def to_dense(self):
+        R, C = self.shape
+        G = self.values.shape[1] // self.n
+        dense = torch.zeros((C, G * self.m), dtype=self.values.dtype, device=self.device)
+        dense.scatter_(1, self._rows().long(), self.values)
+        return dense[:, :R].t()
+
+    def rmatmul(self, state):
+        """Returns `state @ W` for a 1D or 2D (batched) `state`, straight from the compressed form.
+
+        Output neuron `c` is the dot product of it's kept values w/ the state gathered at their rows. The rows & the
+        gathered state only ever exist for a chunk of columns (see `max_chunk_elements`). On CPU this is still slower
+        than a dense matmul (there's no N:M kernel, the gather touches every kept value), what it saves is memory.
+        """
+
+        R, C = self.shape
+        K = self.values.shape[1]
+        squeeze = state.dim() == 1
+        state = state.reshape(-1, R).to(self.values.dtype)
+        B = state.shape[0]
+
+        # padded rows (when R % m != 0) only ever meet 0 values
+        state = F.pad(state, (0, K // self.n * self.m - R))
+        if B > 1:
+            # gather whole rows of the batch at once
+            state = state.t().contiguous()
+
+        chunk = max(1, self.max_chunk_elements // (B * K))
+        outputs = []
+        for start in range(0, C, chunk):
+            columns = slice(start, start + chunk)
+            rows = self._rows(columns)
+            if B > 1:
+                gathered = state.index_select(0, rows.view(-1)).view(rows.shape + (B,))
+                outputs.append(torch.bmm(self.values[columns].unsqueeze(1), gathered).squeeze(1))
+            else:
+                gathered = state[0].index_select(0, rows.view(-1)).view(rows.shape)
+                outputs.append((gathered * self.values[columns]).sum(1, keepdim=True))
+        output = torch.cat(outputs).t()
+
+        return output.squeeze(0) if squeeze else output
+
+    def __repr__(self):
+        return 'NMSparseWeight(%i:%i, shape=%s)' % (self.n, self.m, str(self.shape))
+
+
+@torch.no_grad()
+def compress_nm(pagnn, n, m):
+    """Freeze `pagnn`'s weight into it's compressed N:M form for inference (see `decompress`)."""
+
+    pagnn.compressed_weight = NMSparseWeight.from_dense(pagnn.weight, n, m)
+    return pagnn
+
+
+def decompress(pagnn):
+    pagnn.compressed_weight = None
+    return pagnn
+
+
+class NMSparsityScheduler:
+    """Keeps the `weight` of every PAGNNLayer in `model` N:M sparse during training.
+
+    Drop-in for `RigLScheduler` in the training loops (`if pruner(): optimizer.step()`):
+        - gradients are masked with a hook so pruned edges never move.
+        - every `delta` steps (until `T_end`) each group of `m` incoming edges re-selects it's `n` edges by
+          `|W| + |dense grad|`. pruned edges are 0 so they compete by gradient alone, active edges get a head start from
+          their magnitude. dropped edges are zeroed along with their optimizer state.
+        - the optimizer step is skipped on topology update steps (same as RigL).
+        - under `torch.distributed` the dense gradients are averaged over the ranks before scoring, so the masks stay
+          the same on every rank.
+    """
+
+    def __init__(self, model, optimizer, n=2, m=4, delta=100, T_end=None, static_topo=False, state_dict=None):
+        self.model = model
+        self.optimizer = optimizer
+        # layers w/ a sparse edge store (`sparsity > 0`) manage their own topology
+        self.layers = [m_ for m_ in model.modules() if isinstance(m_, PAGNNLayer) and m_.weight is not None]
+        self.n = n
+        self.m = m
+        self.delta = delta
+        self.T_end = T_end
+        self.static_topo = static_topo
+        self.step = 0
+        self.rewired_edges = 0
+
+        if state_dict is not None:
+            self.load_state_dict(state_dict)
+        else:
+            self.masks = [nm_mask(layer.weight, n, m) for layer in self.layers]
+
+        self._dense_grads = [None] * len(self.layers)
+        self.apply_masks()
+        self._register_hooks()
+
+    def _register_hooks(self):
+        for i, layer in enumerate(self.layers):
+            layer.weight.register_hook(self._make_grad_hook(i))
+
+    def __setstate__(self, state):
+        # tensor hooks aren't pickled, ex. when sent to a `compare` worker process w/ it's model
+        self.__dict__.update(state)
+        self._register_hooks()
+
+    def _make_grad_hook(self, i):
+        @torch.utils.hooks.unserializable_hook
+        def hook(grad):
+            if self._next_is_update_step():
+                self._dense_grads[i] = grad.detach().clone()
+            return grad * self.masks[i]
+        return hook
+
+    def _next_is_update_step(self):
+        step = self.step + 1
+        if self.static_topo or step % self.delta != 0:
+            return False
+        return self.T_end is None or step < self.T_end
+
+    @torch.no_grad()
+    def apply_masks(self):
+        for layer, mask in zip(self.layers, self.masks):
+            layer.weight.data *= mask
+
+            # zeroed weights must stay zeroed, so forget their momentum/variance too
+            for buffer in self.optimizer.state.get(layer.weight, {}).values():
+                if torch.is_tensor(buffer) and buffer.shape == mask.shape:
+                    buffer *= mask
+
+    @torch.no_grad()
+    def update_masks(self):
+        for i, layer in enumerate(self.layers):
+            grad = self._dense_grads[i]
+            if grad is None:
+                continue
+            if _distributed():
+                # the hook runs before DDP's all-reduce, score w/ the average gradient so every rank (whose weights
+                # are the same) picks the same mask
+                torch.distributed.all_reduce(grad)
+                grad /= torch.distributed.get_world_size()
+
+            scores = layer.weight.abs() + grad.abs()
+            new_mask = nm_mask(layer.weight, self.n, self.m, scores=scores)
+            self.rewired_edges += int((new_mask & ~self.masks[i]).sum())
+            self.masks[i] = new_mask
+            self._dense_grads[i] = None
+
+        self.apply_masks()
+
+    def is_valid(self):
+        return all(is_nm_sparse(layer.weight, self.n, self.m) for layer in self.layers)
+
+    def __call__(self):
+        do_update = self._next_is_update_step()
+        self.step += 1
+
+        if do_update:
+            self.update_masks()
+            return False
+        return True
+
+    def state_dict(self):
+        return {
+            'n': self.n,
+            'm': self.m,
+            'delta': self.delta,
+            'T_end': self.T_end,
+            'static_topo': self.static_topo,
+            'step': self.step,
+            'rewired_edges': self.rewired_edges,
+            'masks': self.masks,
+        }
+
+    def load_state_dict(self, state_dict):
+        for key, value in state_dict.items():
+            setattr(self, key, value)
+
+    def __str__(self):
+        density = 100 * self.n / self.m
+        return 'NMSparsityScheduler(%i:%i, layers=%i, density=%.1f%%, step=%i, rewired_edges=%i)' % (
+            self.n, self.m, len(self.layers), density, self.step, self.rewired_edges)
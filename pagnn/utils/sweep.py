@@ -0,0 +1,193 @@
+"""Hyperparameter sweeps over PAGNNLayer configs, built on `compare`.
+
+    space = {'steps': [1, 2, 3], 'activation': [None, 'relu'], 'extra_neurons': [0, 10], 'lr': [0.01, 0.001]}
+    trials = sweep(space, D, C, train_dl, test_dl, F.cross_entropy, epochs=27, workers=4, test_accuracy=True)
+
+Every config of the grid is a trial. Trials are pruned w/ successive halving: all of them train for `min_epochs`, the
+best `1/eta` continue for `eta` times as many epochs & so on until `epochs`. Each trial's progress (weights, optimizer
+state & histories) is cached under the hash of it's config, so rerunning a sweep (or extending it's search space)
+only trains what hasn't been trained yet.
+"""
+
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+
+import torch
+
+from pagnn.pagnn import PAGNNLayer, ACTIVATIONS
+from pagnn.utils.checkpoint import save_atomic
+from pagnn.utils.comparisons import compare, TopologyStep, topology_counters, load_topology_counters
+
+
+# config keys that aren't PAGNNLayer arguments
+TRAINING_KEYS = ('lr',)
+
+
+def grid(space, samples=None, seed=0):
+    """Every combination of the values in `space` (`{argument: [values]}`), or `samples` random ones of them."""
+
+    keys = sorted(space)
+    configs = [dict(zip(keys, values)) for values in itertools.product(*(space[k] for k in keys))]
+    if samples is not None and samples < len(configs):
+        configs = random.Random(seed).sample(configs, samples)
+    return configs
+
+
+def config_hash(config, context=None):
+    """Stable hash of a config (& whatever else determines the result, ex. the dataset & optimizer, as `context`)."""
+
+    blob = json.dumps({'config': config, 'context': context}, sort_keys=True, default=str)
+    return hashlib.sha1(blob.encode()).hexdigest()[:16]
+
+
+def build_pagnn(config, input_neurons, output_neurons):
+    """PAGNNLayer from a config: it's arguments, w/ the activation by name (see `ACTIVATIONS`) & `dense_allocation` as
+    an alternative to `sparsity`. Sparse layers are trained w/ dynamic sparsity (`sweep` calls their `topology_step`,
+    see `TopologyStep`), same as `dense_allocation` in train_imagenet.py."""
+
+    kwargs = {k: v for k, v in config.items() if k not in TRAINING_KEYS}
+    kwargs.setdefault('extra_neurons', 0)
+    if 'activation' in kwargs:
+        kwargs['activation'] = ACTIVATIONS[kwargs['activation']]
+    if 'dense_allocation' in kwargs:
+        kwargs['sparsity'] = 1 - kwargs.pop('dense_allocation')
+    return PAGNNLayer(input_neurons, output_neurons, retain_state=False, **kwargs)
+
+
+def rungs(min_epochs, epochs, eta):
+    """Epoch budgets of the successive halving rungs, ex. (1, 27, 3) -> [1, 3, 9, 27]."""
+
+    budgets = []
+    budget = min_epochs
+    while budget < epochs:
+        budgets.append(budget)
+        budget *= eta
+    return budgets + [epochs]
+
+
+def _score(trial, epochs, test_accuracy):
+    # lower is better, diverged / NaN trials are always last
+    if trial['diverged'] or len(trial['test_history']) < epochs:
+        return math.inf
+    value = trial['test_history'][epochs - 1]
+    if value != value:
+        return math.inf
+    return -value if test_accuracy else value
+
+
+def sweep(space, input_neurons, output_neurons, train_dl, test_dl, criterion, epochs, min_epochs=1, eta=3,
+          lr=0.01, optimizer=torch.optim.Adam, workers=1, test_accuracy=False, samples=None, seed=0,
+          cache_dir='.cache/sweep', context=None, build_model=build_pagnn, **compare_kwargs):
+    """Successive halving over the configs of `space` (see `grid`), returns the trials best first.
+
+    A trial is a dict w/ it's 'config', 'hash', 'model', 'optimizer', 'train_history' / 'test_history' (one value per
+    epoch trained), 'epochs', 'diverged', 'pruned_at' (the rung's epoch budget, None if it made it through) & 'score' (the
+    last test value, negated for accuracies). Each rung's trials train in parallel when `workers > 1` (see `compare`).
+
+    Trials are cached in `cache_dir` by `config_hash(config, context)`, so caching requires a `context`: pass
+    everything that makes results incomparable (ex. the dataset's name & preprocessing) as `context` (the criterion,
+    the dataset sizes, lr, the optimizer & the seed are already included).
+    `build_model(config, input_neurons, output_neurons)` creates the model of a trial (the default builds a
+    PAGNNLayer), a config's 'lr' overrides `lr`. Sparse configs (`dense_allocation`) rewire until 75% of the
+    training iterations unless they set `rewire_T_end` themselves.
+    """
+
+    if cache_dir is not None and context is None:
+        raise Exception('caching trials requires a `context` describing the data (ex. context=\'iris\'), '
+                        'or pass cache_dir=None')
+
+    budgets = rungs(min_epochs, epochs, eta)
+    context = {
+        'context': context,
+        'criterion': getattr(criterion, '__name__', repr(criterion)),
+        'data': [len(train_dl.dataset), len(test_dl.dataset), len(train_dl)],
+        'lr': lr,
+        'optimizer': optimizer.__name__,
+        'seed': seed,
+        'test_accuracy': test_accuracy,
+    }
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    configs = grid(space, samples=samples, seed=seed)
+    for config in configs:
+        if 'dense_allocation' in config and 'rewire_T_end' not in config:
+            # part of the config (& the hash), it depends on the number of epochs
+            config['rewire_T_end'] = int(0.75 * epochs * len(train_dl))
+
+    trials = []
+    for config in configs:
+        # every trial starts from it's own deterministic init, independent of the order of the grid
+        key = config_hash(config, context)
+        torch.manual_seed(seed + int(key, 16) % (2 ** 31))
+        model = build_model(config, input_neurons, output_neurons)
+        trial = {
+            'name': '%s %s' % (key[:8], json.dumps(config, sort_keys=True)),
+            'config': config,
+            'hash': key,
+            'model': model,
+            'optimizer': optimizer(model.parameters(), lr=config.get('lr', lr)),
+            'train_history': [],
+            'test_history': [],
+            'epochs': 0,
+            'diverged': False,
+            'pruned_at': None,
+        }
+
+        path = os.path.join(cache_dir, key + '.pt') if cache_dir is not None else None
+        if path is not None and os.path.exists(path):
+            cached = torch.load(path, map_location='cpu')
+            trial['model'].load_state_dict(cached['model'])
+            trial['optimizer'].load_state_dict(cached['optimizer'])
+            load_topology_counters(trial['model'], cached['topology_counters'])
+            for k in ['train_history', 'test_history', 'epochs', 'diverged']:
+                trial[k] = cached[k]
+        trials.append(trial)
+
+    alive = trials
+    for rung, budget in enumerate(budgets):
+        todo = [t for t in alive if t['epochs'] < budget and not t['diverged']]
+        print('=> rung %i: %i trials @ %i epochs (%i cached)' % (rung, len(alive), budget, len(alive) - len(todo)))
+
+        # trials that are further along than this rung (from the cache) would train for a different number of
+        # epochs than the others, so train them in groups of equal epoch counts
+        for remaining in sorted(set(budget - t['epochs'] for t in todo)):
+            group = [t for t in todo if budget - t['epochs'] == remaining]
+            model_dicts = [{'name': t['name'], 'model': t['model'], 'optimizer': t['optimizer'],
+                            'pruner': TopologyStep(t['model'], t['optimizer'])} for t in group]
+            compare(model_dicts, train_dl, test_dl, remaining, criterion, use_tqdm=False, test_accuracy=test_accuracy,
+                    workers=workers, **compare_kwargs)
+
+            for t, model_dict in zip(group, model_dicts):
+                t['train_history'] = t['train_history'] + model_dict['train_history']
+                t['test_history'] = t['test_history'] + model_dict['test_history']
+                t['diverged'] = model_dict['diverged']
+                t['epochs'] = budget
+                if cache_dir is not None:
+                    save_atomic({
+                        'config': t['config'],
+                        'model': t['model'].state_dict(),
+                        'optimizer': t['optimizer'].state_dict(),
+                        'topology_counters': topology_counters(t['model']),
+                        'train_history': t['train_history'],
+                        'test_history': t['test_history'],
+                        'epochs': t['epochs'],
+                        'diverged': t['diverged'],
+                    }, os.path.join(cache_dir, t['hash'] + '.pt'))
+
+        for t in alive:
+            t['score'] = _score(t, budget, test_accuracy)
+        alive = sorted(alive, key=lambda t: t['score'])
+
+        if rung < len(budgets) - 1:
+            keep = max(1, len(alive) // eta)
+            for t in alive[keep:]:
+                t['pruned_at'] = budget
+            alive = alive[:keep]
+
+    # the survivors first, then by how far they made it & their score at that point
+    return sorted(trials, key=lambda t: (t['pruned_at'] is not None, -(t['pruned_at'] or 0), t['score']))
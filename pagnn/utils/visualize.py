@@ -1,33 +1,77 @@
+from operator import itemgetter
+
 import networkx as nx
 import numpy as np
+import torch
 
 
-def get_networkx_graph(pagnn, return_color_map=True):
-    W = pagnn.weight.cpu().detach().numpy()
-    G = nx.DiGraph(W)
+@torch.no_grad()
+def get_edge_list(pagnn, threshold=0, top_k=None, max_edges=None):
+    """Vectorized `(sources, targets, weights)` numpy arrays of the edges of `pagnn`.
 
-    if not return_color_map:
-        return G
+    Only edges w/ `|w| > threshold` are kept, w/ `top_k` only the k strongest outgoing edges of every neuron & w/
+    `max_edges` a random sample of at most that many edges (weighted by `|w|`, so the strong edges tend to survive).
+    Sparse layers are read straight from their edge store, nothing is densified.
+    """
+
+    if pagnn.edges is not None and pagnn.compressed_weight is None:
+        sources, targets = pagnn.edges.index
+        weights = pagnn.edges.weight.detach()
+        keep = weights.abs() > threshold
+        sources, targets, weights = sources[keep], targets[keep], weights[keep]
+
+        if top_k is not None:
+            # sort by (source, |w| descending), then keep the first k of every source
+            order = weights.abs().argsort(descending=True)
+            order = order[sources[order].argsort(stable=True)]
+            sources, targets, weights = sources[order], targets[order], weights[order]
+            starts = torch.searchsorted(sources, sources, right=False)
+            keep = torch.arange(sources.shape[0], device=sources.device) - starts < top_k
+            sources, targets, weights = sources[keep], targets[keep], weights[keep]
+    else:
+        W = pagnn.dense_weight()
+        mask = W.abs() > threshold
+        if top_k is not None and top_k < W.shape[1]:
+            top = torch.zeros_like(mask)
+            top.scatter_(1, W.abs().topk(top_k, dim=1).indices, True)
+            mask &= top
+        sources, targets = mask.nonzero(as_tuple=True)
+        weights = W[sources, targets]
+
+    if max_edges is not None and weights.shape[0] > max_edges:
+        # weighted sampling w/o replacement (Efraimidis-Spirakis): the largest `log(u) / |w|` keys win
+        keys = torch.rand(weights.shape[0], device=weights.device).log() / weights.abs().clamp_min(1e-12)
+        keep = keys.topk(max_edges).indices.sort().values
+        sources, targets, weights = sources[keep], targets[keep], weights[keep]
 
-    color_map = []
-    for i, neuron in enumerate(W):
-        # "input" neurons
-        if i < pagnn._input_neurons:
-            color_map.append('green')
+    return sources.cpu().numpy(), targets.cpu().numpy(), weights.cpu().numpy()
 
-        # "output" neurons
-        elif i >= (pagnn._total_neurons - pagnn._output_neurons):
-            color_map.append('blue')
 
-        # "hidden" neurons
-        else:
-            color_map.append('gray')
+def get_color_map(pagnn):
+    color_map = np.full(pagnn._total_neurons, 'gray', dtype=object)
+    color_map[:pagnn._input_neurons] = 'green' # "input" neurons
+    color_map[pagnn._outputs] = 'blue' # "output" neurons
+    return list(color_map)
+
+
+def get_networkx_graph(pagnn, return_color_map=True, threshold=0, top_k=None, max_edges=None):
+    """`nx.DiGraph` of `pagnn`, only w/ the edges picked by `get_edge_list` (every neuron is always a node)."""
+
+    sources, targets, weights = get_edge_list(pagnn, threshold=threshold, top_k=top_k, max_edges=max_edges)
+
+    G = nx.DiGraph()
+    G.add_nodes_from(range(pagnn._total_neurons))
+    G.add_weighted_edges_from(zip(sources.tolist(), targets.tolist(), weights.tolist()))
+
+    if not return_color_map:
+        return G
 
-    return G, color_map
+    return G, get_color_map(pagnn)
 
 
-def draw_networkx_graph(pagnn, mode='default'):
-    G, color_map = get_networkx_graph(pagnn, return_color_map=True)
+def draw_networkx_graph(pagnn, mode='default', threshold=0, top_k=None, max_edges=20000):
+    G, color_map = get_networkx_graph(pagnn, return_color_map=True, threshold=threshold, top_k=top_k,
+                                      max_edges=max_edges)
 
     if mode == 'default':
         nx.draw(G, with_labels=True, node_color=color_map)
@@ -51,9 +95,11 @@ def draw_networkx_graph(pagnn, mode='default'):
         degrees = degrees / max(np.max(degrees), 1)
         degrees *= 200
         degrees += 10
-        weightings = np.abs(pagnn.weight.cpu().detach().numpy().flatten())
-        weightings = weightings - np.min(weightings)
-        weightings = weightings / np.max(weightings)
+        # one width per drawn edge (in G's edge order)
+        weightings = np.abs(np.array([w for _, _, w in G.edges(data='weight')], dtype=float))
+        if len(weightings) > 0:
+            weightings = weightings - np.min(weightings)
+            weightings = weightings / max(np.max(weightings), 1e-12)
         weightings *= 1
         weightings += 0.1
         nx.draw(G, node_color=color_map, node_size=degrees, width=weightings)
@@ -0,0 +1,143 @@
+import torch
+
+from pagnn.pagnn import PAGNNLayer, _pagnn_op
+
+
+class DivergenceWatchdog:
+    """Cheap divergence monitor for (P)AGNN training.
+
+    Every statistic is accumulated as a device tensor, so observing a batch never forces a host sync. Only
+    `diverged()` / `summary()` sync, which callers should do every so often (ex. every 50 batches or once per epoch).
+
+    Watched quantities:
+        - the loss (NaN / inf).
+        - the largest absolute value of any PAGNNLayer state (repeated `sW + b` steps w/o an activation blow up).
+        - the global gradient norm.
+        - a spectral radius estimate of each PAGNNLayer's `weight`. the estimate is a single power iteration per
+          observation that reuses the vector cached from the previous observation, so it converges over the course
+          of training for almost no cost.
+
+    The gradient norm & spectral radius are the expensive ones (a pass over every gradient & a matmul per layer), so
+    `observe` only looks at them every `check_freq` calls. The loss & state are checked on every call.
+    """
+
+    def __init__(self, model, max_state=1e8, max_grad_norm=1e8, max_spectral_radius=None, power_iterations=1,
+                 check_freq=1):
+        self.model = model
+        self.layers = [m for m in model.modules() if isinstance(m, PAGNNLayer)]
+        self.max_state = max_state
+        self.max_grad_norm = max_grad_norm
+        self.max_spectral_radius = max_spectral_radius
+        self.power_iterations = power_iterations
+        self.check_freq = check_freq
+        self._observations = 0
+
+        self._vectors = [None] * len(self.layers)
+        self.reset()
+
+    def reset(self):
+        self._stats = {}
+        self._flags = {}
+        self.reason = None
+
+    def _record(self, name, value, limit=None):
+        value = value.detach().float()
+        bad = ~torch.isfinite(value)
+        if limit is not None:
+            bad = bad | (value > limit)
+
+        if name in self._stats:
+            # NaNs must stick around, `torch.maximum` propagates them
+            self._stats[name] = torch.maximum(self._stats[name], value)
+            self._flags[name] = self._flags[name] | bad
+        else:
+            self._stats[name] = value
+            self._flags[name] = bad
+
+    @torch.no_grad()
+    def observe_loss(self, loss):
+        self._record('loss', loss.abs())
+
+    @torch.no_grad()
+    def observe_state(self):
+        for layer in self.layers:
+            if layer.state is not None:
+                self._record('state', layer.state.abs().max(), self.max_state)
+
+    @torch.no_grad()
+    def observe_grads(self):
+        norms = [p.grad.detach().float().norm() for p in self.model.parameters() if p.grad is not None]
+        if len(norms) > 0:
+            self._record('grad_norm', torch.stack(norms).norm(), self.max_grad_norm)
+
+    @torch.no_grad()
+    def spectral_radius(self, i=0):
+        """Power iteration estimate of the spectral radius of the i-th PAGNNLayer's `weight`."""
+
+        layer = self.layers[i]
+        W = layer.effective_weight()
+        v = self._vectors[i]
+        if v is None or v.device != layer.bias.device:
+            v = torch.randn(layer._total_neurons, device=layer.bias.device, dtype=layer.bias.dtype)
+            v /= v.norm()
+
+        log_growth = torch.zeros((), device=v.device, dtype=v.dtype)
+        for _ in range(self.power_iterations):
+            # state is a row vector (s_{t+1} = s_t W), so iterate from the left.
+            u = _pagnn_op(v, W)
+            norm = u.norm()
+            log_growth = log_growth + norm.clamp_min(1e-30).log()
+
+            # nilpotent topologies (ex. imported FFNNs) map everything to 0, restart from a random vector
+            # instead of getting stuck there. `torch.where` keeps this sync free.
+            restart = torch.randn_like(v)
+            v = torch.where(norm > 1e-12, u / norm.clamp_min(1e-12), restart / restart.norm())
+
+        # geometric mean of the per-iteration growth, the plain norm ratio oscillates forever when the dominant
+        # eigenvalues are a complex conjugate pair (common for real, non-symmetric W)
+        rho = (log_growth / self.power_iterations).exp()
+        rho = torch.where(rho > 1e-12, rho, torch.zeros_like(rho))
+
+        self._vectors[i] = v
+        return rho
+
+    @torch.no_grad()
+    def observe_spectral_radius(self):
+        for i in range(len(self.layers)):
+            self._record('spectral_radius', self.spectral_radius(i), self.max_spectral_radius)
+
+    def observe(self, loss=None):
+        """Observe everything (see `check_freq`). Call after `loss.backward()` and before `optimizer.step()`."""
+
+        if loss is not None:
+            self.observe_loss(loss)
+        self.observe_state()
+
+        self._observations += 1
+        if self._observations % self.check_freq == 0:
+            self.observe_grads()
+            self.observe_spectral_radius()
+
+    def diverged(self):
+        """Returns True if anything watched has gone non-finite or over it's limit (forces a sync)."""
+
+        if self.reason is not None:
+            return True
+
+        if len(self._flags) <= 0:
+            return False
+
+        names = list(self._flags.keys())
+        flags = torch.stack([self._flags[name] for name in names]).cpu()
+        for name, flag in zip(names, flags):
+            if flag:
+                self.reason = '%s=%s' % (name, self._stats[name].item())
+                return True
+        return False
+
+    def summary(self):
+        return {name: stat.item() for name, stat in self._stats.items()}
+
+    def __str__(self):
+        stats = ', '.join('%s=%.4g' % (name, value) for name, value in self.summary().items())
+        return 'DivergenceWatchdog(%s)' % stats
@@ -1,9 +1,10 @@
+import pytest
 import torch
 from torch import nn
 import torch.nn.functional as F
 
 import numpy as np
-from pagnn.pagnn import PAGNNLayer, _pagnn_op
+from pagnn.pagnn import PAGNNLayer, PAGNNHead, _pagnn_op
 from pagnn.utils.comparisons import count_params, LSTM, create_inout_sequences
 
 import matplotlib.pyplot as plt
@@ -295,3 +296,347 @@ def test_sequence_inputs():
     assert pagnn_avg_loss < lstm_avg_loss, 'PAGNN should outperform LSTMs significantly for this test case.'
 
      
+
+
+def test_sparse_edges():
+    for sequence in [False, True]:
+        sparse = PAGNNLayer(1 if sequence else 3, 2, 6, steps=2, sparsity=0.7, retain_state=False, rewire_delta=1, rewire_chunk_size=3)
+        dense = PAGNNLayer(1 if sequence else 3, 2, 6, steps=2, retain_state=False)
+        dense.weight.data = sparse.dense_weight().clone()
+        dense.bias.data = sparse.bias.data.clone()
+        N = sparse._total_neurons
+        assert sparse.edges.weight.shape[0] == round(0.3 * N * N)
+
+        X = torch.rand(7) if sequence else torch.rand(4, 3)
+        Y = sparse(X)
+        assert torch.allclose(Y, dense(X), atol=1e-6)
+
+        # chunked grow scores must match the dense gradient
+        Y.sum().backward()
+        dense(X).sum().backward()
+        existing = torch.zeros(N * N, dtype=torch.bool)
+        existing[sparse.edges.keys] = True
+        scores = dense.weight.grad.abs().view(-1).masked_fill(existing, -float('inf'))
+        candidates = sparse._grow_candidates(5)
+        assert not existing[candidates].any()
+        assert torch.allclose(scores[candidates].sort().values, scores.topk(5).values.sort().values, atol=1e-6)
+
+        # rewiring keeps the number of edges & never duplicates one
+        assert not sparse.topology_step()
+        assert sparse.rewired_edges > 0
+        keys = sparse.edges.keys
+        assert keys.shape[0] == keys.unique().shape[0] == round(0.3 * N * N)
+
+
+def test_sparse_edges_init_and_loading():
+    from pagnn.pagnn import _sample_keys
+
+    # edges are sampled directly, no dense weight is ever allocated
+    for total, count in [(100, 3), (100, 50), (100, 97), (100, 100)]:
+        keys = _sample_keys(total, count)
+        assert keys.shape[0] == keys.unique().shape[0] == count and 0 <= keys.min() and keys.max() < total
+    sparse = PAGNNLayer(3, 2, 5, steps=2, sparsity=0.6, retain_state=False)
+    assert sparse.weight is None and all(p.dim() == 1 for p in sparse.parameters())
+
+    X = torch.rand(4, 3)
+    dense = PAGNNLayer(3, 2, 5, steps=2, retain_state=False)
+    dense.load_state_dict(sparse.state_dict())
+    assert torch.equal(dense.weight, sparse.dense_weight()) and torch.allclose(dense(X), sparse(X), atol=1e-6)
+
+    # a dense checkpoint keeps it's largest weights
+    other = PAGNNLayer(3, 2, 5, steps=2, sparsity=0.6, retain_state=False)
+    other.load_state_dict(dense.state_dict())
+    assert torch.equal(other.dense_weight(), sparse.dense_weight())
+
+    # another sparsity takes on the checkpoint's edges, FFNNs are imported
+    other = PAGNNLayer(3, 2, 5, steps=2, sparsity=0.9, retain_state=False)
+    other.load_state_dict(sparse.state_dict())
+    assert torch.equal(other.dense_weight(), sparse.dense_weight()) and other._sparsity == sparse._sparsity
+    ffnn = torch.nn.Linear(3, 2)
+    other = PAGNNLayer(3, 2, 0, sparsity=0.5, retain_state=False)
+    other.load_state_dict(ffnn.state_dict())
+    assert torch.allclose(other(X), ffnn(X), atol=1e-6)
+
+
+def test_sparse_edges_training():
+    X = torch.rand(32, 4)
+    T = X.sum(1, keepdim=True)
+    pagnn = PAGNNLayer(4, 1, 4, steps=2, sparsity=0.5, retain_state=False, rewire_delta=5, rewire_T_end=80)
+    optimizer = torch.optim.Adam(pagnn.parameters(), lr=0.05)
+
+    losses = []
+    for _ in range(100):
+        optimizer.zero_grad()
+        loss = F.mse_loss(pagnn(X), T)
+        loss.backward()
+        if pagnn.topology_step(optimizer):
+            optimizer.step()
+        losses.append(loss.item())
+
+    assert pagnn.rewired_edges > 0
+    assert losses[-1] < 0.1 * losses[0]
+
+
+def test_parallel_scan_sequence():
+    for steps in [1, 3]:
+        for T in [1, 2, 7, 12, 33]:
+            pagnn = PAGNNLayer(1, 2, 6, steps=steps, retain_state=False)
+            with torch.no_grad():
+                pagnn.weight.mul_(0.5) # keep the state from blowing up over long sequences
+            X = torch.randn(T)
+
+            grads = []
+            outputs = []
+            states = []
+            for parallel_scan in [False, True]:
+                pagnn.parallel_scan = parallel_scan
+                pagnn.zero_grad()
+                Y = pagnn(X)
+                Y.pow(2).sum().backward()
+                outputs.append(Y.detach())
+                states.append(pagnn.state.detach())
+                grads.append((pagnn.weight.grad.clone(), pagnn.bias.grad.clone()))
+
+            assert torch.allclose(outputs[0], outputs[1], atol=1e-5, rtol=1e-4)
+            assert torch.allclose(states[0], states[1], atol=1e-5, rtol=1e-4)
+            assert torch.allclose(grads[0][0], grads[1][0], atol=1e-4, rtol=1e-3)
+            assert torch.allclose(grads[0][1], grads[1][1], atol=1e-4, rtol=1e-3)
+
+
+def test_forward_chunks():
+    for parallel_scan in [False, True]:
+        pagnn = PAGNNLayer(1, 1, 6, steps=2, retain_state=False, parallel_scan=parallel_scan)
+        with torch.no_grad():
+            pagnn.weight.mul_(0.5)
+        X = torch.randn(50)
+
+        with torch.no_grad():
+            expected = pagnn(X)
+            outputs = list(pagnn.forward_chunks(X, chunk_size=16))
+            assert len(outputs) == 4
+            assert torch.allclose(outputs[-1], expected, atol=1e-5)
+
+            # any iterable of chunks, loaded on a background thread
+            outputs = list(pagnn.forward_chunks(iter(X.split(7)), prefetch_chunks=2))
+            assert torch.allclose(outputs[-1], expected, atol=1e-5)
+
+        # truncated backprop, the graph never spans more than a chunk
+        for y in pagnn.forward_chunks(X, chunk_size=10):
+            pagnn.zero_grad()
+            y.sum().backward()
+            assert pagnn.weight.grad is not None
+
+    # multi-feature sequences come in as (T, input_neurons) chunks
+    for parallel_scan in [False, True]:
+        pagnn = PAGNNLayer(2, 1, 5, steps=2, retain_state=False, parallel_scan=parallel_scan)
+        with torch.no_grad():
+            pagnn.weight.mul_(0.5)
+        X = torch.randn(30, 2)
+
+        with torch.no_grad():
+            stateful = PAGNNLayer(2, 1, 5, steps=2, retain_state=True)
+            stateful.load_state_dict(pagnn.state_dict())
+            expected = [stateful(x) for x in X][-1]
+            outputs = list(pagnn.forward_chunks(X, chunk_size=8))
+            assert len(outputs) == 4
+            assert torch.allclose(outputs[-1], expected, atol=1e-5)
+
+
+def test_functional_forward():
+    from concurrent.futures import ThreadPoolExecutor
+
+    pagnn = PAGNNLayer(2, 2, 4, steps=3, activation=torch.tanh, retain_state=False)
+    X = torch.rand(4, 6, 2) # 4 streams of 6 batches
+
+    def run(xs):
+        state = None
+        outputs = []
+        for x in xs:
+            y, state = pagnn.functional_forward(x, state)
+            outputs.append(y)
+        return torch.stack(outputs)
+
+    with torch.no_grad():
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            outputs = list(pool.map(run, X))
+
+        # same as a dedicated retain_state layer per stream
+        for xs, actual in zip(X, outputs):
+            stateful = PAGNNLayer(2, 2, 4, steps=3, activation=torch.tanh, retain_state=True)
+            stateful.load_state_dict(pagnn.state_dict())
+            expected = torch.stack([stateful(x) for x in xs])
+            assert torch.allclose(actual, expected, atol=1e-6)
+
+    assert pagnn.state is None
+
+    # sequences, w/ & w/o the parallel scan
+    seq = PAGNNLayer(1, 1, 5, steps=2, retain_state=False)
+    X = torch.randn(20)
+    for parallel_scan in [False, True]:
+        seq.parallel_scan = parallel_scan
+        y, state = seq.functional_forward(X[:12])
+        y, state = seq.functional_forward(X[12:], state)
+        assert torch.allclose(y, seq(X), atol=1e-5)
+
+    # a 1D input is only a sequence for single input layers
+    with pytest.raises(NotImplementedError):
+        pagnn.functional_forward(torch.rand(7))
+    with pytest.raises(NotImplementedError):
+        pagnn(torch.rand(7))
+
+
+def test_forward_sequences():
+    from torch.nn.utils.rnn import pack_sequence
+    from pagnn.utils.data import bucket_by_length
+
+    pagnn = PAGNNLayer(1, 2, 5, steps=2, activation=torch.tanh, retain_state=False)
+    sequences = [torch.randn(T) for T in [5, 1, 9, 3, 9, 4]]
+    expected = []
+    expected_states = []
+    for seq in sequences:
+        expected.append(pagnn(seq))
+        expected_states.append(pagnn.state)
+    expected = torch.stack(expected)
+    expected_states = torch.stack(expected_states)
+
+    padded = torch.nn.utils.rnn.pad_sequence(sequences, batch_first=True)
+    lengths = torch.tensor([len(seq) for seq in sequences])
+    assert torch.allclose(pagnn.forward_sequences(padded, lengths), expected, atol=1e-6)
+    assert torch.allclose(pagnn.state, expected_states, atol=1e-6)
+
+    packed = pack_sequence(sequences, enforce_sorted=False)
+    assert torch.allclose(pagnn(packed), expected, atol=1e-6)
+
+    seen = 0
+    for X, L, idx in bucket_by_length(sequences, 2, targets=torch.arange(len(sequences))):
+        assert X.shape[1] == L.max()
+        assert torch.allclose(pagnn.forward_sequences(X, L), expected[idx], atol=1e-6)
+        seen += len(idx)
+    assert seen == len(sequences)
+
+
+def test_bf16_autocast_keeps_state_fp32():
+    pagnn = PAGNNLayer(8, 4, 20, steps=4, activation=torch.tanh, retain_state=False)
+    X = torch.rand(16, 8)
+
+    expected = pagnn(X)
+    with torch.autocast('cpu', dtype=torch.bfloat16):
+        y = pagnn(X)
+    assert y.dtype == torch.float32 and pagnn.state.dtype == torch.float32
+    assert torch.allclose(y, expected, atol=0.1)
+
+    y.sum().backward()
+    assert pagnn.weight.grad.dtype == torch.float32
+
+
+def test_pagnn_head():
+    pagnn = PAGNNLayer(20, 6, 0, retain_state=False)
+    X = torch.rand(16, 20)
+
+    head = PAGNNHead(20, 6)
+    head.load_state_dict(pagnn.state_dict())
+    assert count_params(head) == 20 * 6 + 6 and count_params(pagnn) == 26 * 26 + 26
+    assert torch.allclose(head(X), pagnn(X), atol=1e-6)
+    assert torch.allclose(head.to_pagnn_layer()(X), pagnn(X), atol=1e-6)
+
+    # torchvision style fc weights
+    linear = nn.Linear(20, 6)
+    head.load_state_dict(linear.state_dict())
+    assert torch.allclose(head(X), linear(X), atol=1e-6)
+
+    # own state dict round trip
+    other = PAGNNHead(20, 6)
+    other.load_state_dict(head.state_dict())
+    assert torch.equal(other(X), head(X))
+
+    # square fc, only the source tells the layouts apart
+    X = torch.rand(16, 8)
+    square, linear = PAGNNHead(8, 8), nn.Linear(8, 8)
+    square.load_state_dict(linear.state_dict())
+    assert torch.allclose(square(X), linear(X), atol=1e-6)
+    other = PAGNNHead(8, 8)
+    other.load_state_dict(square.state_dict())
+    assert torch.equal(other(X), square(X))
+
+
+def test_optimize_for_inference():
+    from copy import deepcopy
+    from pagnn.p_resnet import p_resnet18
+
+    model = p_resnet18(num_classes=10)
+    with torch.no_grad():
+        # non trivial BatchNorm running stats
+        model(torch.rand(8, 3, 32, 32))
+    model.eval()
+
+    X = torch.rand(4, 3, 32, 32)
+    with torch.no_grad():
+        expected = model(X)
+
+        folded = deepcopy(model).optimize_for_inference()
+        assert isinstance(folded.fc, nn.Linear) and isinstance(folded.layer1[0].bn1, nn.Identity)
+        assert torch.allclose(folded(X), expected, atol=1e-5)
+
+        frozen = deepcopy(model).optimize_for_inference(X)
+        assert torch.allclose(frozen(X), expected, atol=1e-5)
+        assert torch.allclose(frozen(X[:2]), expected[:2], atol=1e-5)
+
+
+def test_growable_pagnn():
+    from pagnn.pagnn import GrowablePAGNNLayer
+
+    pagnn = GrowablePAGNNLayer(3, 2, 1, steps=3, activation=torch.tanh, retain_state=False, capacity=8)
+    X = torch.rand(16, 3)
+    T = torch.randint(0, 2, (16,))
+    optimizer = torch.optim.Adam(pagnn.parameters(), lr=0.01)
+    for _ in range(3):
+        optimizer.zero_grad()
+        F.cross_entropy(pagnn(X), T).backward()
+        optimizer.step()
+
+    expected = pagnn(X).detach()
+    assert torch.allclose(pagnn.to_pagnn_layer()(X), expected, atol=1e-6)
+    moments = optimizer.state[pagnn.weight]['exp_avg'][:6, :6].clone()
+
+    # new neurons don't change the function, the capacity grows geometrically & the moments carry over
+    capacities = []
+    for _ in range(6):
+        pagnn.grow(1, optimizer)
+        capacities.append(pagnn.capacity)
+        assert torch.allclose(pagnn(X), expected, atol=1e-6)
+    assert pagnn._total_neurons == 12 and capacities == [8, 8, 16, 16, 16, 16]
+    assert optimizer.param_groups[0]['params'][0] is pagnn.weight
+    assert torch.equal(optimizer.state[pagnn.weight]['exp_avg'][:6, :6], moments)
+
+    # only the active neurons train
+    optimizer.zero_grad()
+    F.cross_entropy(pagnn(X), T).backward()
+    optimizer.step()
+    assert pagnn.weight.grad[6:12, :12].abs().sum() > 0 # the new neurons start talking
+    assert pagnn.weight.grad[12:].abs().sum() == 0 and pagnn.weight[:, 12:].abs().sum() == 0
+
+    other = GrowablePAGNNLayer(3, 2, 1, steps=3, activation=torch.tanh, retain_state=False)
+    other.load_state_dict(pagnn.state_dict())
+    assert other._extra_neurons == 7 and torch.equal(other(X), pagnn(X))
+
+    # plain PAGNNLayer checkpoints are reordered into the growable layout
+    plain = pagnn.to_pagnn_layer()
+    other = GrowablePAGNNLayer(3, 2, 0, steps=3, activation=torch.tanh, retain_state=False)
+    other.load_state_dict(plain.state_dict())
+    assert other._extra_neurons == 7 and torch.allclose(other(X), pagnn(X), atol=1e-6)
+    grown = GrowablePAGNNLayer.from_pagnn_layer(plain, capacity=20)
+    assert grown.capacity == 20 and torch.allclose(grown(X), pagnn(X), atol=1e-6)
+    assert torch.equal(grown.to_pagnn_layer().weight, plain.weight)
+
+    # & so are FFNNs
+    ffnn = torch.nn.Linear(3, 2)
+    other = GrowablePAGNNLayer(3, 2, steps=1, retain_state=False)
+    other.load_state_dict(ffnn.state_dict())
+    assert torch.allclose(other(X), ffnn(X), atol=1e-6)
+    ffnn = torch.nn.Linear(3, 2, bias=False)
+    other = GrowablePAGNNLayer(3, 2, steps=1, retain_state=False)
+    other.load_state_dict(ffnn.state_dict())
+    assert torch.allclose(other(X), ffnn(X), atol=1e-6)
+
+    with pytest.raises(Exception, match='input & 5 output neurons'):
+        GrowablePAGNNLayer(3, 5).load_state_dict(ffnn.state_dict())
@@ -0,0 +1,687 @@
+import asyncio
+import os
+import pytest
+
+import torch
+import torch.nn.functional as F
+
+import numpy as np
+from pagnn.pagnn import PAGNNLayer
+from pagnn.utils.watchdog import DivergenceWatchdog
+from pagnn.utils.comparisons import compare, WindowDataset
+from pagnn.utils.optim import SparseStateOptimizer, pruner_masks
+from pagnn.utils.serving import MicroBatcher, ServerBusy, save_pagnn_checkpoint, load_model
+from pagnn.utils.sparsity import nm_mask, is_nm_sparse, NMSparseWeight, NMSparsityScheduler, compress_nm
+
+
+np.random.seed(666)
+torch.manual_seed(666)
+
+
+def test_watchdog_spectral_radius():
+    pagnn = PAGNNLayer(2, 2, 4, retain_state=False)
+    watchdog = DivergenceWatchdog(pagnn, power_iterations=1000)
+
+    expected = torch.linalg.eigvals(pagnn.weight.detach()).abs().max().item()
+    actual = watchdog.spectral_radius().item()
+    assert np.isclose(actual, expected, rtol=0.05), (actual, expected)
+
+    # nilpotent topology (only forward edges) must not get stuck / NaN
+    pagnn.zero_params()
+    pagnn.weight.data[0, 3] = 1
+    assert watchdog.spectral_radius().item() == 0
+
+
+def test_watchdog_flags_divergence():
+    pagnn = PAGNNLayer(1, 1, 3, steps=50, retain_state=False)
+    with torch.no_grad():
+        pagnn.weight.mul_(10)
+    watchdog = DivergenceWatchdog(pagnn, max_state=1e6)
+
+    y = pagnn(torch.ones(4, 1))
+    loss = F.mse_loss(y, torch.zeros_like(y))
+    loss.backward()
+    watchdog.observe(loss)
+
+    assert watchdog.diverged()
+    assert watchdog.reason is not None
+
+    # the gradient norm & spectral radius are only observed every `check_freq` calls
+    watchdog = DivergenceWatchdog(pagnn, max_state=1e6, check_freq=3)
+    watchdog.observe(loss)
+    watchdog.observe(loss)
+    assert 'grad_norm' not in watchdog.summary() and 'state' in watchdog.summary()
+    watchdog.observe(loss)
+    assert 'grad_norm' in watchdog.summary() and 'spectral_radius' in watchdog.summary()
+
+
+def test_compare_stops_diverged_models():
+    X = torch.rand(40, 3)
+    T = torch.randint(0, 2, (40,))
+    dl = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(X, T), batch_size=10)
+
+    stable = PAGNNLayer(3, 2, 0, retain_state=False)
+    unstable = PAGNNLayer(3, 2, 3, steps=50, retain_state=False)
+    with torch.no_grad():
+        unstable.weight.mul_(100)
+
+    model_dicts = [
+        {'name': 'stable', 'model': stable, 'optimizer': torch.optim.SGD(stable.parameters(), lr=0.01)},
+        {'name': 'unstable', 'model': unstable, 'optimizer': torch.optim.SGD(unstable.parameters(), lr=0.01)},
+    ]
+
+    compare(model_dicts, dl, dl, 3, F.cross_entropy, use_tqdm=False, test_accuracy=True)
+
+    assert not model_dicts[0]['diverged']
+    assert len(model_dicts[0]['train_history']) == 3
+    assert model_dicts[1]['diverged']
+    assert len(model_dicts[1]['train_history']) == 1
+
+
+def test_nm_sparse_weight():
+    for N, n, m in [(8, 2, 4), (10, 2, 4), (13, 1, 4), (16, 4, 8)]:
+        W = torch.randn(N, N)
+        W *= nm_mask(W, n, m)
+        assert is_nm_sparse(W, n, m)
+
+        compressed = NMSparseWeight.from_dense(W, n, m)
+        assert torch.equal(compressed.to_dense(), W)
+
+        state = torch.randn(3, N)
+        assert torch.allclose(compressed.rmatmul(state), state.matmul(W), atol=1e-5)
+        assert torch.allclose(compressed.rmatmul(state[0]), state[0].matmul(W), atol=1e-5)
+
+
+def test_nm_compressed_pagnn():
+    pagnn = PAGNNLayer(4, 2, 6, steps=3, retain_state=False)
+    pagnn.weight.data *= nm_mask(pagnn.weight, 2, 4)
+    X = torch.rand(5, 4)
+
+    expected = pagnn(X)
+    compress_nm(pagnn, 2, 4)
+    assert torch.allclose(pagnn(X), expected, atol=1e-5)
+
+
+def test_nm_scheduler_keeps_pattern():
+    pagnn = PAGNNLayer(4, 2, 6, steps=2, retain_state=False)
+    optimizer = torch.optim.Adam(pagnn.parameters(), lr=0.1)
+    pruner = NMSparsityScheduler(pagnn, optimizer, n=2, m=4, delta=3)
+    assert pruner.is_valid()
+
+    X = torch.rand(8, 4)
+    T = torch.randint(0, 2, (8,))
+    for _ in range(12):
+        optimizer.zero_grad()
+        F.cross_entropy(pagnn(X), T).backward()
+        if pruner():
+            optimizer.step()
+        assert pruner.is_valid()
+
+    assert pruner.step == 12
+
+
+def _nm_ddp_worker(rank, path):
+    import torch.distributed as dist
+    os.environ['MASTER_ADDR'], os.environ['MASTER_PORT'] = '127.0.0.1', '29531'
+    dist.init_process_group('gloo', rank=rank, world_size=2)
+
+    torch.manual_seed(0)
+    pagnn = PAGNNLayer(4, 2, 20, steps=2, retain_state=False)
+    pagnn.weight.data *= 0.01 # the gradients decide the masks
+    model = torch.nn.parallel.DistributedDataParallel(pagnn)
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.01)
+    pruner = NMSparsityScheduler(model, optimizer, n=1, m=4, delta=3)
+
+    # every rank trains on (very) different data
+    torch.manual_seed(rank + 1)
+    for _ in range(9):
+        optimizer.zero_grad()
+        X = torch.rand(8, 4) * (1 if rank == 0 else -5)
+        F.cross_entropy(model(X), torch.full((8,), rank)).backward()
+        if pruner():
+            optimizer.step()
+
+    torch.save({'masks': pruner.masks, 'weight': model.module.weight.detach(), 'rewired': pruner.rewired_edges},
+               os.path.join(path, '%i.pt' % rank))
+    dist.destroy_process_group()
+
+
+def test_nm_scheduler_ddp(tmp_path):
+    torch.multiprocessing.spawn(_nm_ddp_worker, args=(str(tmp_path),), nprocs=2)
+    rank0, rank1 = [torch.load(tmp_path / ('%i.pt' % rank)) for rank in range(2)]
+    assert rank0['rewired'] == rank1['rewired'] > 0
+    assert all(torch.equal(a, b) for a, b in zip(rank0['masks'], rank1['masks']))
+    assert torch.equal(rank0['weight'], rank1['weight'])
+
+
+def test_sparse_state_optimizer():
+    for optimizer_cls, kwargs in [(torch.optim.Adam, {'lr': 0.01}), (torch.optim.SGD, {'lr': 0.01, 'momentum': 0.9})]:
+        dense = PAGNNLayer(4, 2, 10, steps=2, retain_state=False)
+        sparse = PAGNNLayer(4, 2, 10, steps=2, retain_state=False)
+        sparse.load_state_dict(dense.state_dict())
+
+        dense_optimizer = optimizer_cls(dense.parameters(), **kwargs)
+        dense_pruner = NMSparsityScheduler(dense, dense_optimizer, n=1, m=4, delta=4)
+        sparse_optimizer = SparseStateOptimizer(optimizer_cls, sparse.parameters(), **kwargs)
+        sparse_pruner = NMSparsityScheduler(sparse, sparse_optimizer, n=1, m=4, delta=4)
+        sparse_optimizer.mask_fn = lambda: pruner_masks(sparse_pruner)
+
+        X = torch.rand(8, 4)
+        T = torch.randint(0, 2, (8,))
+        for _ in range(10):
+            for model, optimizer, pruner in [(dense, dense_optimizer, dense_pruner),
+                                             (sparse, sparse_optimizer, sparse_pruner)]:
+                optimizer.zero_grad()
+                F.cross_entropy(model(X), T).backward()
+                if pruner():
+                    optimizer.step()
+
+            assert torch.allclose(dense.weight, sparse.weight, atol=1e-5)
+            assert torch.allclose(dense.bias, sparse.bias, atol=1e-5)
+
+        # moments are only kept for the active 25% of the weight (+ the dense bias)
+        dense_bytes = sum(v.numel() * v.element_size() for s in dense_optimizer.state.values()
+                          for v in s.values() if torch.is_tensor(v))
+        assert sparse_optimizer.state_nbytes() < 0.4 * dense_bytes
+
+        resumed = SparseStateOptimizer(optimizer_cls, sparse.parameters(), **kwargs)
+        resumed.load_state_dict(sparse_optimizer.state_dict())
+        assert resumed.state_nbytes() == sparse_optimizer.state_nbytes()
+
+
+def test_micro_batcher(tmp_path):
+    pagnn = PAGNNLayer(3, 2, 4, steps=2, retain_state=False, activation=torch.tanh)
+    save_pagnn_checkpoint(pagnn, tmp_path / 'pagnn.pth')
+    model = load_model(tmp_path / 'pagnn.pth')
+    assert model.activation is torch.tanh
+    X = torch.rand(20, 3)
+
+    async def run():
+        batcher = MicroBatcher(model, max_batch_size=8, max_wait_ms=20)
+        await batcher.start()
+        Y = await asyncio.gather(*[batcher.predict(x) for x in X])
+        await batcher.stop()
+        return torch.stack(Y), batcher.stats()
+
+    Y, stats = asyncio.run(run())
+    assert torch.allclose(Y, pagnn(X), atol=1e-6)
+    assert stats['requests'] == 20
+    assert stats['batches'] < 20
+    assert 'latency_ms' in stats
+
+    async def bad_request():
+        # a request of the wrong shape is rejected by itself, the rest of it's batch still goes through
+        batcher = MicroBatcher(model, max_batch_size=8, max_wait_ms=20)
+        await batcher.start()
+        results = await asyncio.gather(batcher.predict(X[0]), batcher.predict(torch.rand(4)), batcher.predict(X[1]),
+                                       return_exceptions=True)
+        await batcher.stop()
+        return results
+
+    y0, error, y1 = asyncio.run(bad_request())
+    assert isinstance(error, ValueError) and 'shape' in str(error)
+    assert torch.allclose(torch.stack((y0, y1)), pagnn(X[:2]), atol=1e-6)
+
+    async def http(requests):
+        # every malformed request gets a 400 (& the server keeps serving)
+        from pagnn.utils.serving import make_handler
+        batcher = MicroBatcher(model)
+        await batcher.start()
+        server = await asyncio.start_server(make_handler(batcher), '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        statuses = []
+        for request in requests:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(request)
+            statuses.append(int((await reader.readline()).split()[1]))
+            writer.close()
+        server.close()
+        await batcher.stop()
+        return statuses
+
+    def post(body):
+        return b'POST /predict HTTP/1.1\r\nContent-Length: %i\r\nConnection: close\r\n\r\n%s' % (len(body), body)
+
+    bodies = [b'{"inputs": [0.1, 0.2, 0.3]}', b'{"inputs": "abc"}', b'[1, 2, 3]', b'{"inputs": [[1], [1, 2]]}',
+              b'{"inputs": [1, 2]}', b'not json']
+    statuses = asyncio.run(http([post(body) for body in bodies] + [b'GARBAGE\r\n\r\n', post(bodies[0])]))
+    assert statuses == [200, 400, 400, 400, 400, 400, 400, 200]
+
+    async def overflow():
+        # w/o a worker nothing is consumed, so the queue fills up & further requests are rejected
+        batcher = MicroBatcher(model, max_queue_size=2)
+        batcher.queue = asyncio.Queue(maxsize=2)
+        tasks = [asyncio.ensure_future(batcher.predict(x)) for x in X[:2]]
+        await asyncio.sleep(0)
+        try:
+            await batcher.predict(X[2])
+            rejected = False
+        except ServerBusy:
+            rejected = True
+        for task in tasks:
+            task.cancel()
+        return rejected, batcher.rejected
+
+    assert asyncio.run(overflow()) == (True, 1)
+
+
+def test_window_dataset():
+    series = torch.randn(50)
+    dataset = WindowDataset(series, 12)
+    assert len(dataset) == 38
+    for i in [0, 17, 37]:
+        x, t = dataset[i]
+        assert torch.equal(x, series[i:i+12])
+        assert torch.equal(t, series[i+12:i+13])
+
+    # views, not copies
+    series[20] = 1234
+    assert dataset[15][0][5] == 1234
+
+    seen = 0
+    for X, T in dataset.batches(10, shuffle=True):
+        assert X.shape[1:] == (12,) and T.shape[1:] == (1,)
+        seen += X.shape[0]
+    assert seen == len(dataset)
+
+    # a batch of windows gives the same predictions as one window at a time (see examples/time_series.py)
+    from pagnn.utils.comparisons import LSTM
+    lstm, pagnn = LSTM(hidden_layer_size=8), PAGNNLayer(1, 1, 4, retain_state=False)
+    X, T = next(dataset.batches(5))
+    single = []
+    for x in X:
+        lstm.hidden_cell = tuple(torch.zeros(1, 1, 8) for _ in range(2))
+        single.append(lstm(x))
+    assert torch.allclose(lstm(X.unsqueeze(-1)), torch.stack(single), atol=1e-6)
+
+    # 2D input is still a single (T, features) sequence
+    lstm = LSTM(input_size=3, hidden_layer_size=8)
+    x = torch.randn(6, 3)
+    lstm.hidden_cell = tuple(torch.zeros(1, 1, 8) for _ in range(2))
+    single = lstm(x)
+    assert single.shape == (1,) and torch.allclose(lstm(x.unsqueeze(0)), single.unsqueeze(0), atol=1e-6)
+    assert torch.allclose(pagnn.forward_sequences(X), torch.stack([pagnn(x) for x in X]), atol=1e-6)
+
+    features = torch.randn(30, 3)
+    dataset = WindowDataset(features, 5, horizon=2)
+    x, t = dataset[4]
+    assert torch.equal(x, features[4:9])
+    assert torch.equal(t, features[9:11])
+
+
+def test_compare_parallel():
+    X = torch.rand(40, 3)
+    T = torch.randint(0, 2, (40,))
+    dl = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(X, T), batch_size=10)
+
+    model_dicts = []
+    for name in ['a', 'b', 'c']:
+        model = PAGNNLayer(3, 2, 2, steps=2, activation=torch.tanh, retain_state=False)
+        model_dicts.append({'name': name, 'model': model, 'optimizer': torch.optim.Adam(model.parameters(), lr=0.1)})
+    initial = [md['model'].weight.detach().clone() for md in model_dicts]
+
+    streamed = []
+    compare(model_dicts, dl, dl, 2, F.cross_entropy, use_tqdm=False, test_accuracy=True, workers=2,
+            history_callback=lambda model_dict, key, value: streamed.append((model_dict['name'], key)))
+
+    assert len(streamed) == 3 * 2 * 2
+    for model_dict, W in zip(model_dicts, initial):
+        assert len(model_dict['train_history']) == 2
+        assert len(model_dict['test_history']) == 2
+        assert not torch.equal(model_dict['model'].weight, W) # trained weights made it back
+        assert len(model_dict['optimizer'].state) > 0
+
+    # default activations are picklable
+    import pickle
+    pickle.dumps(PAGNNLayer(2, 2, 2))
+
+    # a pruner keeps working in the worker (it's grad hooks are re-registered) & it's state comes back w/ the model
+    schedulers = []
+    for workers in [1, 2]:
+        torch.manual_seed(1)
+        X = torch.rand(40, 3)
+        dl = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(X, (X[:, 0] > X[:, 1]).long()), batch_size=10)
+        model = PAGNNLayer(3, 2, 20, steps=2, retain_state=False)
+        optimizer = torch.optim.Adam(model.parameters(), lr=0.1)
+        schedulers.append(NMSparsityScheduler(model, optimizer, n=2, m=4, delta=3))
+        model_dicts = [{'name': 'nm', 'model': model, 'optimizer': optimizer, 'pruner': schedulers[-1]}]
+        compare(model_dicts, dl, dl, 2, F.cross_entropy, use_tqdm=False, workers=workers)
+    local, parallel = schedulers
+    assert parallel.step == local.step == 2 * len(dl) and parallel.is_valid()
+    assert parallel.rewired_edges == local.rewired_edges > 0
+    assert all(torch.equal(a, b) for a, b in zip(parallel.masks, local.masks))
+
+    # & a worker that dies w/o reporting back fails the comparison instead of hanging it
+    model_dicts = [{'name': 'dies', 'model': model, 'optimizer': optimizer, 'pruner': _ExitingPruner()}]
+    with pytest.raises(Exception, match='worker died'):
+        compare(model_dicts, dl, dl, 1, F.cross_entropy, use_tqdm=False, workers=2)
+
+
+class _ExitingPruner:
+    # module level, so it can be sent to a worker process
+    def __call__(self):
+        os._exit(3)
+
+
+def test_tensor_batcher():
+    from pagnn.utils.data import TensorBatcher
+
+    X = torch.rand(23, 3)
+    T = torch.arange(23)
+
+    batcher = TensorBatcher(X, T, batch_size=5)
+    expected = list(torch.utils.data.DataLoader(torch.utils.data.TensorDataset(X, T), batch_size=5))
+    assert len(batcher) == len(expected) == 5
+    assert len(batcher.dataset) == 23
+    for (x, t), (ex, et) in zip(batcher, expected):
+        assert torch.equal(x, ex) and torch.equal(t, et)
+
+    # shuffled (w/ prefetching) still covers every sample exactly once, w/ inputs & targets kept aligned
+    batcher = TensorBatcher(X, T, batch_size=5, shuffle=True, prefetch=2)
+    seen = []
+    for x, t in batcher:
+        assert torch.equal(x, X[t])
+        seen.append(t)
+    assert torch.equal(torch.cat(seen).sort().values, T)
+
+    # stopping early doesn't leave the prefetching thread behind
+    import threading
+    threads = threading.active_count()
+    for _ in range(3):
+        for i, _ in enumerate(TensorBatcher(X, T, batch_size=1, prefetch=1)):
+            if i == 2:
+                break
+    assert threading.active_count() == threads
+
+    assert len(TensorBatcher(X, T, batch_size=5, drop_last=True)) == 4
+
+    # plugs into compare
+    model = PAGNNLayer(3, 2, 1, retain_state=False)
+    model_dicts = [{'name': 'pagnn', 'model': model, 'optimizer': torch.optim.SGD(model.parameters(), lr=0.01)}]
+    batcher = TensorBatcher(X, T % 2, batch_size=5, shuffle=True)
+    compare(model_dicts, batcher, batcher, 2, F.cross_entropy, use_tqdm=False, test_accuracy=True)
+    assert len(model_dicts[0]['test_history']) == 2
+
+
+def test_load_categorical_csv(tmp_path):
+    import os
+    import pandas as pd
+    from pagnn.utils.comparisons import one_hot, separate_targets, get_train_and_test, load_categorical_csv, split_train_and_test
+
+    path = os.path.join(os.path.dirname(__file__), '..', 'datasets', 'mushrooms.csv')
+    cache_dir = str(tmp_path / 'cache')
+
+    # same tensors as the original one_hot -> separate_targets -> get_train_and_test pipeline
+    df = pd.read_csv(path)
+    for key in list(df.columns[1:]) + ['class']:
+        df = one_hot(df, key)
+    df, targets = separate_targets(df, 'class')
+    (train_X, train_T), (test_X, test_T) = get_train_and_test(df, targets, 0.8)
+
+    for _ in range(2): # 2nd time from the cache
+        X, T = load_categorical_csv(path, 'class', cache_dir=cache_dir)
+        (X_train, T_train), (X_test, T_test) = split_train_and_test(X, T, 0.8)
+        assert torch.equal(X_train, train_X) and torch.equal(X_test, test_X)
+        assert torch.equal(T_train, train_T) and torch.equal(T_test, test_T)
+        assert len(os.listdir(cache_dir)) == 2
+
+    # a different encoding gets it's own cache entry
+    load_categorical_csv(path, 'odor', cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 4
+
+
+def test_edge_list():
+    from pagnn.utils.visualize import get_edge_list, get_networkx_graph, draw_networkx_graph
+
+    pagnn = PAGNNLayer(5, 3, 40, retain_state=False)
+    W = pagnn.weight.detach()
+    N = pagnn._total_neurons
+
+    sources, targets, weights = get_edge_list(pagnn)
+    assert len(weights) == N * N
+    assert np.allclose(weights, W[sources, targets].numpy())
+
+    sources, targets, weights = get_edge_list(pagnn, threshold=0.1)
+    assert len(weights) == (W.abs() > 0.1).sum()
+
+    sources, targets, weights = get_edge_list(pagnn, top_k=3)
+    assert len(weights) == 3 * N
+    assert np.all(np.bincount(sources, minlength=N) == 3)
+    assert np.allclose(np.sort(np.abs(weights[sources == 0])), W[0].abs().sort().values[-3:].numpy())
+
+    sources, targets, weights = get_edge_list(pagnn, max_edges=100)
+    assert len(weights) == 100 and len(set(zip(sources, targets))) == 100
+
+    # sparse layers, straight from the edge store
+    sparse = PAGNNLayer(5, 3, 40, sparsity=0.8, retain_state=False)
+    sources, targets, weights = get_edge_list(sparse, top_k=2)
+    assert np.all(np.bincount(sources, minlength=N) <= 2)
+    dense = sparse.dense_weight()
+    assert np.allclose(weights, dense[sources, targets].numpy())
+    for i in range(N):
+        expected = dense[i].abs().sort().values[-2:]
+        assert np.allclose(np.sort(np.abs(weights[sources == i])), expected[expected > 0].numpy())
+
+    G, color_map = get_networkx_graph(pagnn, top_k=2)
+    assert G.number_of_nodes() == N and G.number_of_edges() == 2 * N
+    assert color_map[0] == 'green' and color_map[-1] == 'blue' and color_map[6] == 'gray'
+
+    import matplotlib
+    matplotlib.use('Agg')
+    for mode in ['ego', 'scaled_weights']:
+        draw_networkx_graph(pagnn, mode=mode, max_edges=200)
+
+
+def test_connectivity():
+    import networkx as nx
+    from pagnn.utils.connectivity import reachability, receptive_sets, dead_outputs, strongly_connected_components
+
+    pagnn = PAGNNLayer(2, 2, 3, steps=2, retain_state=False)
+    pagnn.zero_params()
+    # 0 -> 2 -> 5, 1 -> 3 -> 4 -> 3, nothing reaches output 6 in 2 steps
+    for s, t in [(0, 2), (2, 5), (1, 3), (3, 4), (4, 3)]:
+        pagnn.weight.data[s, t] = 1
+
+    assert reachability(pagnn).tolist() == [[True, False], [False, False]]
+    assert reachability(pagnn, k=3, within=True).tolist() == [[True, False], [False, False]]
+    assert [s.tolist() for s in receptive_sets(pagnn)] == [[0], []]
+    assert dead_outputs(pagnn).tolist() == [1]
+
+    labels = strongly_connected_components(pagnn)
+    assert labels[3] == labels[4]
+    assert len(labels.unique()) == 6
+
+    # matches networkx on random sparse topologies
+    for sparsity in [0.9, 0.97]:
+        sparse = PAGNNLayer(4, 4, 40, steps=3, sparsity=sparsity, retain_state=False)
+        W = sparse.dense_weight()
+        G = nx.DiGraph(W.numpy())
+        labels = strongly_connected_components(sparse)
+        for component in nx.strongly_connected_components(G):
+            component = list(component)
+            assert len(labels[component].unique()) == 1
+            assert (labels == labels[component[0]]).sum() == len(component)
+
+        walks = torch.matrix_power((W != 0).float(), 3)
+        assert torch.equal(reachability(sparse), walks[:4, -4:] > 0)
+
+
+def test_image_shards(tmp_path):
+    from PIL import Image
+    from pagnn.utils.shards import convert_image_folder, ShardedImageDataset
+
+    expected = {}
+    for c in range(2):
+        os.makedirs(tmp_path / 'images' / ('class%i' % c))
+        for i in range(7):
+            pixels = np.full((20 + i, 24, 3), 10 * i + c, dtype=np.uint8)
+            Image.fromarray(pixels).save(tmp_path / 'images' / ('class%i' % c) / ('%i.png' % i))
+            expected[10 * i + c] = c
+
+    convert_image_folder(str(tmp_path / 'images'), str(tmp_path / 'shards'), size=16, images_per_shard=4)
+    assert len([f for f in os.listdir(tmp_path / 'shards') if f.endswith('.bin')]) == 4
+
+    dataset = ShardedImageDataset(str(tmp_path / 'shards'), shuffle_buffer=5)
+    samples = list(dataset)
+    assert len(samples) == len(dataset) == 14
+    for image, label in samples:
+        assert image.shape == (3, 16, 16) and image.dtype == torch.uint8
+        assert expected[int(image[0, 0, 0])] == label
+    assert sorted(int(image[0, 0, 0]) for image, _ in samples) == sorted(expected)
+
+    # ranks read disjoint samples & all get the same number of them (even w/ several DataLoader workers)
+    for world_size in [2, 3]:
+        seen = []
+        for rank in range(world_size):
+            dataset = ShardedImageDataset(str(tmp_path / 'shards'), rank=rank, world_size=world_size)
+            dataset.set_epoch(3)
+            loader = torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=2)
+            values = [int(image[0, 0, 0]) for image, _ in loader]
+            assert len(values) == len(dataset) == 14 // world_size
+            seen.extend(values)
+        assert len(set(seen)) == len(seen) and set(seen) <= set(expected)
+
+
+def test_async_checkpointer(tmp_path):
+    from pagnn.utils.checkpoint import AsyncCheckpointer
+
+    pagnn = PAGNNLayer(3, 2, 4)
+    checkpointer = AsyncCheckpointer()
+    filename = str(tmp_path / 'checkpoint.pth.tar')
+    best = str(tmp_path / 'model_best.pth.tar')
+
+    checkpointer.save({'epoch': 1, 'state_dict': pagnn.state_dict()}, filename, best)
+    expected = pagnn.weight.detach().clone()
+    # training keeps going while the write is in flight, the snapshot must not see it
+    with torch.no_grad():
+        pagnn.weight.add_(1)
+    checkpointer.wait()
+
+    checkpoint = torch.load(filename)
+    assert checkpoint['epoch'] == 1
+    assert torch.equal(checkpoint['state_dict']['weight'], expected)
+    assert os.path.samefile(filename, best) # hardlinked, not copied
+    assert not any(f.endswith('.tmp') for f in os.listdir(tmp_path))
+
+    # a new checkpoint replaces the file, the best one keeps pointing at the old contents
+    checkpointer.save({'epoch': 2, 'state_dict': pagnn.state_dict()}, [(filename, None)])
+    checkpointer.close()
+    assert torch.load(filename)['epoch'] == 2
+    assert torch.load(best)['epoch'] == 1
+
+
+def test_metric_accumulator():
+    from pagnn.utils.metrics import MetricAccumulator
+
+    metrics = MetricAccumulator(topk=(1, 3))
+    outputs = [torch.randn(8, 5) for _ in range(4)]
+    targets = [torch.randint(0, 5, (8,)) for _ in range(4)]
+    losses = [F.cross_entropy(y, t) for y, t in zip(outputs, targets)]
+    for y, t, loss in zip(outputs, targets, losses):
+        metrics.update(y, t, loss)
+    assert metrics.count == 32
+    assert 'Acc@3' in str(metrics)
+    assert str(metrics) == str(metrics) # printing doesn't reset the window
+
+    # the window only covers the batches since `reset_window`, the running averages everything
+    metrics.reset_window()
+    metrics.update(outputs[0], targets[0], losses[0])
+    assert str(metrics).startswith('Loss {:.4e} ('.format(losses[0].item()))
+    assert metrics.count == 40
+
+    Y, T = torch.cat(outputs + outputs[:1]), torch.cat(targets + targets[:1])
+    losses = losses + losses[:1]
+    results = metrics.compute()
+    assert np.isclose(results['loss'], torch.stack(losses).mean().item(), rtol=1e-5)
+    assert np.isclose(results['acc1'], 100 * (Y.argmax(1) == T).float().mean().item())
+    top3 = (Y.topk(3, 1).indices == T[:, None]).any(1).float().mean().item()
+    assert np.isclose(results['acc3'], 100 * top3)
+
+
+class _NoisyImages(torch.utils.data.Dataset):
+    def __init__(self, images, labels):
+        self.images, self.labels = images, labels
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, i):
+        return self.images[i] + 0.1 * torch.randn(self.images[i].shape), self.labels[i]
+
+
+def test_feature_cache(tmp_path):
+    from pagnn.p_resnet import p_resnet18
+    from pagnn.utils.features import extract_features, FeatureCache, train_head, evaluate_head
+
+    # the head's accuracy depends on the features & it's init, don't depend on the tests that ran before
+    torch.manual_seed(0)
+    model = p_resnet18(num_classes=3).eval()
+    templates = torch.randn(3, 3, 32, 32)
+    labels = torch.arange(30) % 3
+    images = templates[labels] + 0.1 * torch.randn(30, 3, 32, 32)
+    with torch.no_grad():
+        expected = model.forward_features(images)
+
+    dataset = torch.utils.data.TensorDataset(images, labels)
+    extract_features(model, dataset, str(tmp_path / 'plain'), batch_size=8, workers=0, dtype=np.float32)
+    # the caller's model isn't folded / frozen
+    assert isinstance(model.bn1, torch.nn.BatchNorm2d) and all(p.requires_grad for p in model.parameters())
+    cache = FeatureCache(str(tmp_path / 'plain'))
+    assert (cache.copies, cache.count, cache.dim) == (1, 30, 512)
+    assert np.allclose(cache.features[0], expected.numpy(), atol=1e-4)
+    assert (cache.labels == labels.numpy()).all()
+
+    X, T = zip(*cache.batches(8, shuffle=True))
+    assert sorted(torch.cat(T).tolist()) == sorted(labels.tolist())
+
+    # a fixed set of augmented copies, the same seed gives the same copies
+    for name in ['aug1', 'aug2']:
+        extract_features(model, dataset, str(tmp_path / name),
+                         augmented_dataset=_NoisyImages(images, labels), augmentations=2, batch_size=8, workers=0)
+    aug1, aug2 = FeatureCache(str(tmp_path / 'aug1')), FeatureCache(str(tmp_path / 'aug2'))
+    assert aug1.copies == 2 and aug1.features.dtype == np.float16
+    assert not np.array_equal(aug1.features[0], aug1.features[1])
+    assert np.array_equal(aug1.features[1], aug2.features[1])
+    X, _ = next(aug1.batches(30, clone=1))
+    assert np.array_equal(X.numpy(), aug1.features[1].astype(np.float32))
+
+    head = PAGNNLayer(512, 3, 10, steps=2, retain_state=False)
+    history = train_head(head, aug1, cache, epochs=10, batch_size=10, lr=0.01, print_freq=0)
+    assert len(history) == 10 and history[-1]['val']['acc1'] == evaluate_head(head, cache)['acc1']
+    assert history[-1]['val']['acc1'] > 90
+
+
+def test_sweep(tmp_path):
+    from pagnn.utils.sweep import sweep, grid, rungs
+
+    X = torch.rand(60, 4)
+    T = (X[:, 0] > X[:, 1]).long()
+    dl = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(X, T), batch_size=20)
+    space = {'steps': [1, 2], 'activation': [None, 'relu'], 'lr': [0.1, 0.0001]}
+
+    assert len(grid(space)) == 8 and len(grid(space, samples=3)) == 3
+    assert rungs(1, 9, 3) == [1, 3, 9] and rungs(2, 5, 3) == [2, 5]
+
+    with pytest.raises(Exception, match='context'):
+        sweep(space, 4, 2, dl, dl, F.cross_entropy, epochs=4, cache_dir=str(tmp_path))
+
+    trials = sweep(space, 4, 2, dl, dl, F.cross_entropy, epochs=4, min_epochs=1, eta=2,
+                   test_accuracy=True, cache_dir=str(tmp_path), context='x > y')
+    assert len(trials) == 8 and len(os.listdir(tmp_path)) == 8
+    assert [t['pruned_at'] for t in trials] == [None, None, 2, 2, 1, 1, 1, 1]
+    assert sum(len(t['test_history']) for t in trials) == 4 * 1 + 2 * 2 + 2 * 4
+    best = trials[0]
+    assert best['epochs'] == 4 and best['score'] == -best['test_history'][-1]
+
+    # rerunning skips everything that's already trained
+    cached = sweep(space, 4, 2, dl, dl, F.cross_entropy, epochs=4, min_epochs=1, eta=2, test_accuracy=True,
+                   cache_dir=str(tmp_path), context='x > y')
+    assert [t['hash'] for t in cached] == [t['hash'] for t in trials]
+    assert cached[0]['test_history'] == best['test_history']
+    assert torch.equal(cached[0]['model'].weight, best['model'].weight)
+
+    # sparse configs rewire their edges while training
+    space = {'dense_allocation': [0.5], 'extra_neurons': [6], 'rewire_delta': [2]}
+    sparse, = sweep(space, 4, 2, dl, dl, F.cross_entropy, epochs=3, cache_dir=None)
+    assert sparse['config']['rewire_T_end'] == int(0.75 * 3 * len(dl))
+    assert sparse['model'].topology_steps == 3 * len(dl) and sparse['model'].rewired_edges > 0
@@ -10,7 +10,6 @@ The only differences are that there are a few parser arguments added and the man
 import argparse
 import os
 import random
-import shutil
 import time
 import warnings
 import json
@@ -31,6 +30,12 @@ import torchvision.models as models
 from rigl_torch.RigL import RigLScheduler
 
 from pagnn import p_resnet
+from pagnn.utils.watchdog import DivergenceWatchdog
+from pagnn.utils.sparsity import NMSparsityScheduler
+from pagnn.utils.optim import SparseStateOptimizer, pruner_masks
+from pagnn.utils.shards import ShardedImageDataset, is_sharded
+from pagnn.utils.checkpoint import AsyncCheckpointer, save_atomic
+from pagnn.utils.metrics import MetricAccumulator
 
 model_names = sorted(name for name in models.__dict__
     if name.islower() and not name.startswith("__")
@@ -56,6 +61,10 @@ parser.add_argument('-a', '--arch', metavar='ARCH', default='resnet18',
                         ' (default: resnet18)')
 parser.add_argument('--dense-allocation', default=None, type=float,
                     help='percentage of dense parameters allowed. if None, pruning will not be used. must be on the interval (0, 1]')
+parser.add_argument('--nm-sparsity', default=None, type=str,
+                    help='N:M structured sparsity for the PAGNN layers (ex. 2:4), used instead of RigL. if None, not used.')
+parser.add_argument('--sparse-optimizer-state', default=0, type=int,
+                    help='if 1, the optimizer only keeps momentum for the active (unmasked) weights when pruning')
 parser.add_argument('--delta', default=100, type=int,
                     help='delta param for pruning')
 parser.add_argument('--grad-accumulation-n', default=1, type=int,
@@ -63,6 +72,9 @@ parser.add_argument('--grad-accumulation-n', default=1, type=int,
 parser.add_argument('--alpha', default=0.3, type=float,
                     help='alpha param for pruning')
 parser.add_argument('--static-topo', default=0, type=int, help='if 1, use random sparsity topo and remain static')
+parser.add_argument('--stop-on-divergence', default=1, type=int, help='if 1, stop training as soon as the loss, PAGNN state or gradient norm blows up (NaN/inf)')
+parser.add_argument('--shuffle-buffer', default=10000, type=int,
+                    help='shuffle buffer size when reading pre-decoded shards (see pagnn/utils/shards.py)')
 parser.add_argument('-j', '--workers', default=4, type=int, metavar='N',
                     help='number of data loading workers (default: 4)')
 parser.add_argument('--epochs', default=90, type=int, metavar='N',
@@ -115,6 +127,16 @@ parser.add_argument('--seed', default=None, type=int,
                     help='seed for initializing training. ')
 parser.add_argument('--gpu', default=None, type=int,
                     help='GPU id to use.')
+parser.add_argument('--bf16', default=0, type=int,
+                    help='if 1, run forward passes under bfloat16 autocast (weights, optimizer & PAGNN state stay fp32)')
+parser.add_argument('--channels-last', default=0, type=int,
+                    help='if 1, use the channels_last memory format for the model & images (faster convolutions)')
+parser.add_argument('--compact-head', default=0, type=int,
+                    help='if 1, P-ResNets only allocate (& train) the input -> output block of their PAGNN head '
+                         '(same outputs, ~4.5x smaller head for p_resnet50, still loads full size checkpoints)')
+parser.add_argument('--cpu-processes', default=0, type=int,
+                    help='if > 0, train on CPU w/ this many local processes (gloo backend + DistributedDataParallel), '
+                         'the CPU cores are split evenly between them')
 parser.add_argument('--multiprocessing-distributed', type=bool, default=0,
                     help='Use multi-processing distributed training to launch '
                          'N processes per node, which has N GPUs. This is the '
@@ -155,7 +177,15 @@ def main():
     args.distributed = args.world_size > 1 or args.multiprocessing_distributed
 
     ngpus_per_node = torch.cuda.device_count()
-    if args.multiprocessing_distributed:
+    if args.cpu_processes > 0:
+        # same as multiprocessing distributed, but w/ N CPU processes per node instead of 1 process per GPU
+        args.distributed = True
+        args.dist_backend = 'gloo'
+        args.world_size = args.cpu_processes * max(args.world_size, 1)
+        os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+        os.environ.setdefault('MASTER_PORT', '29500')
+        mp.spawn(main_worker, nprocs=args.cpu_processes, args=(args.cpu_processes, args))
+    elif args.multiprocessing_distributed:
         # Since we have ngpus_per_node processes per node, the total world_size
         # needs to be adjusted accordingly
         args.world_size = ngpus_per_node * args.world_size
@@ -169,7 +199,14 @@ def main():
 
 def main_worker(gpu, ngpus_per_node, args):
     global best_acc1
-    args.gpu = gpu
+    local_rank = gpu
+    if args.cpu_processes > 0:
+        # `gpu` is just the local process index in CPU mode
+        args.gpu = None
+        pin_cpu_threads(local_rank, args.cpu_processes)
+    else:
+        args.gpu = gpu
+    args.use_cuda = torch.cuda.is_available() and args.cpu_processes <= 0
     args.static_topo = bool(args.static_topo)
 
     if args.gpu is not None:
@@ -177,21 +214,24 @@ def main_worker(gpu, ngpus_per_node, args):
 
     if args.distributed:
         # if args.dist_url == "env://" and args.rank == -1:
-        args.rank = args.hosts.index(args.current_host)
+        if args.hosts is not None:
+            args.rank = args.hosts.index(args.current_host)
+        else:
+            args.rank = max(args.rank, 0)
         print('DISTRIBUTED RANK: %i' % args.rank)
 #             args.rank = int(os.environ["RANK"])
 
-        if args.multiprocessing_distributed:
+        if args.multiprocessing_distributed or args.cpu_processes > 0:
             # For multiprocessing distributed training, rank needs to be the
             # global rank among all the processes
-            args.rank = args.rank * ngpus_per_node + gpu
+            args.rank = args.rank * ngpus_per_node + local_rank
 
         dist.init_process_group(backend=args.dist_backend, # init_method=args.dist_url,
                                 world_size=args.world_size, rank=args.rank)
     # create model
     if args.arch.lower().startswith('p_'):
         print('=> using a P-ResNet (integrated PAGNN into ResNet)')
-        model = p_resnet.__dict__[args.arch](pretrained=args.pretrained)
+        model = p_resnet.__dict__[args.arch](pretrained=args.pretrained, compact_head=bool(args.compact_head))
     elif args.pretrained:
         print("=> using pre-trained model '{}'".format(args.arch))
         model = models.__dict__[args.arch](pretrained=True)
@@ -199,7 +239,15 @@ def main_worker(gpu, ngpus_per_node, args):
         print("=> creating model '{}'".format(args.arch))
         model = models.__dict__[args.arch]()
 
-    if not torch.cuda.is_available():
+    if args.channels_last:
+        model = model.to(memory_format=torch.channels_last)
+
+    if args.cpu_processes > 0:
+        # each process gets it's share of the batch, DDP all-reduces the gradients over gloo
+        args.batch_size = int(args.batch_size / args.cpu_processes)
+        args.workers = int((args.workers + args.cpu_processes - 1) / args.cpu_processes)
+        model = torch.nn.parallel.DistributedDataParallel(model)
+    elif not torch.cuda.is_available():
         print('using CPU, this will be slow')
     elif args.distributed:
         # For multiprocessing distributed, DistributedDataParallel constructor
@@ -231,11 +279,18 @@ def main_worker(gpu, ngpus_per_node, args):
             model = torch.nn.DataParallel(model).cuda()
 
     # define loss function (criterion) and optimizer
-    criterion = nn.CrossEntropyLoss().cuda(args.gpu)
-
-    optimizer = torch.optim.SGD(model.parameters(), args.lr,
-                                momentum=args.momentum,
-                                weight_decay=args.weight_decay)
+    criterion = nn.CrossEntropyLoss()
+    if args.use_cuda:
+        criterion = criterion.cuda(args.gpu)
+
+    if args.sparse_optimizer_state:
+        optimizer = SparseStateOptimizer(torch.optim.SGD, model.parameters(), lr=args.lr,
+                                         momentum=args.momentum,
+                                         weight_decay=args.weight_decay)
+    else:
+        optimizer = torch.optim.SGD(model.parameters(), args.lr,
+                                    momentum=args.momentum,
+                                    weight_decay=args.weight_decay)
 
     # optionally resume from a checkpoint
     pruner_state_dict = None
@@ -254,7 +309,7 @@ def main_worker(gpu, ngpus_per_node, args):
             args.start_epoch = checkpoint['epoch']
             best_acc1 = checkpoint['best_acc1']
             pruner_state_dict = checkpoint['pruner']
-            if args.gpu is not None:
+            if args.gpu is not None and torch.is_tensor(best_acc1):
                 # best_acc1 may be from a checkpoint from a different GPU
                 best_acc1 = best_acc1.to(args.gpu)
             model.load_state_dict(checkpoint['state_dict'])
@@ -272,31 +327,54 @@ def main_worker(gpu, ngpus_per_node, args):
     normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                      std=[0.229, 0.224, 0.225])
 
-    train_dataset = datasets.ImageFolder(
-        traindir,
-        transforms.Compose([
-            transforms.RandomResizedCrop(224),
-            transforms.RandomHorizontalFlip(),
+    if is_sharded(traindir):
+        # pre-decoded shards (see pagnn/utils/shards.py), images are already uint8 tensors resized to 256x256
+        print('=> using pre-decoded shards')
+        train_dataset = ShardedImageDataset(
+            traindir,
+            transforms.Compose([
+                transforms.RandomResizedCrop(224),
+                transforms.RandomHorizontalFlip(),
+                transforms.ConvertImageDtype(torch.float),
+                normalize,
+            ]), shuffle_buffer=args.shuffle_buffer, seed=0 if args.seed is None else args.seed)
+        val_dataset = ShardedImageDataset(
+            valdir,
+            transforms.Compose([
+                transforms.CenterCrop(224),
+                transforms.ConvertImageDtype(torch.float),
+                normalize,
+            ]), shuffle=False, rank=0, world_size=1) # every rank validates on the full set, like the ImageFolder path
+        # the train shards are split between the ranks by the dataset itself
+        train_sampler = None
+    else:
+        train_dataset = datasets.ImageFolder(
+            traindir,
+            transforms.Compose([
+                transforms.RandomResizedCrop(224),
+                transforms.RandomHorizontalFlip(),
+                transforms.ToTensor(),
+                normalize,
+            ]))
+        val_dataset = datasets.ImageFolder(valdir, transforms.Compose([
+            transforms.Resize(256),
+            transforms.CenterCrop(224),
             transforms.ToTensor(),
             normalize,
         ]))
 
-    if args.distributed:
-        train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset)
-    else:
-        train_sampler = None
+        if args.distributed:
+            train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset)
+        else:
+            train_sampler = None
 
+    iterable = isinstance(train_dataset, torch.utils.data.IterableDataset)
     train_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=args.batch_size, shuffle=(train_sampler is None),
+        train_dataset, batch_size=args.batch_size, shuffle=(train_sampler is None and not iterable),
         num_workers=args.workers, pin_memory=True, sampler=train_sampler)
 
     val_loader = torch.utils.data.DataLoader(
-        datasets.ImageFolder(valdir, transforms.Compose([
-            transforms.Resize(256),
-            transforms.CenterCrop(224),
-            transforms.ToTensor(),
-            normalize,
-        ])),
+        val_dataset,
         batch_size=args.batch_size, shuffle=False,
         num_workers=args.workers, pin_memory=True)
 
@@ -311,14 +389,33 @@ def main_worker(gpu, ngpus_per_node, args):
         pruner = RigLScheduler(model, optimizer, dense_allocation=args.dense_allocation, T_end=T_end, delta=args.delta, alpha=args.alpha, static_topo=args.static_topo, grad_accumulation_n=args.grad_accumulation_n, state_dict=pruner_state_dict)
         print('pruning with dense allocation: %f & T_end=%i' % (args.dense_allocation, T_end))
         print(pruner)
+    elif args.nm_sparsity is not None:
+        n, m = [int(v) for v in args.nm_sparsity.split(':')]
+        T_end = int(0.75 * args.epochs * len(train_loader))
+        pruner = NMSparsityScheduler(model, optimizer, n=n, m=m, delta=args.delta, T_end=T_end, static_topo=args.static_topo, state_dict=pruner_state_dict)
+        print(pruner)
+
+    if pruner is not None and args.sparse_optimizer_state:
+        optimizer.mask_fn = lambda: pruner_masks(pruner)
+
+    watchdog = None
+    if args.stop_on_divergence:
+        # grad norm & spectral radius only when the divergence flag is checked (w/ the progress print)
+        watchdog = DivergenceWatchdog(model, check_freq=args.print_freq)
+
+    checkpointer = AsyncCheckpointer()
 
     for epoch in range(args.start_epoch, args.epochs):
-        if args.distributed:
+        if train_sampler is not None:
             train_sampler.set_epoch(epoch)
+        if hasattr(train_dataset, 'set_epoch'):
+            train_dataset.set_epoch(epoch)
         adjust_learning_rate(optimizer, epoch, args)
 
         # train for one epoch
-        train(train_loader, model, criterion, optimizer, epoch, args, pruner=pruner)
+        if not train(train_loader, model, criterion, optimizer, epoch, args, pruner=pruner, watchdog=watchdog):
+            print('=> training diverged ({}), stopping early'.format(watchdog.reason))
+            break
 
         # evaluate on validation set
         acc1 = validate(val_loader, model, criterion, args)
@@ -327,8 +424,8 @@ def main_worker(gpu, ngpus_per_node, args):
         is_best = acc1 > best_acc1
         best_acc1 = max(acc1, best_acc1)
 
-        if not args.multiprocessing_distributed or (args.multiprocessing_distributed
-                and args.rank % ngpus_per_node == 0):
+        multiprocessing = args.multiprocessing_distributed or args.cpu_processes > 0
+        if not multiprocessing or (multiprocessing and args.rank % ngpus_per_node == 0):
             obj = {
                 'epoch': epoch + 1,
                 'arch': args.arch,
@@ -337,23 +434,50 @@ def main_worker(gpu, ngpus_per_node, args):
                 'optimizer' : optimizer.state_dict(),
                 'pruner': None if pruner is None else pruner.state_dict()
             }
+            # snapshotted once, written (atomically) in the background while the next epoch trains
+            targets = []
             if not is_best and args.checkpoint_dir is not None:
-                save_checkpoint(obj, is_best, parent_dir=args.checkpoint_dir)
-            save_checkpoint(obj, is_best, parent_dir=args.output_dir)
+                targets.append(checkpoint_paths(is_best, parent_dir=args.checkpoint_dir))
+            targets.append(checkpoint_paths(is_best, parent_dir=args.output_dir))
+            checkpointer.save(obj, targets)
+
+    checkpointer.close()
 
 
-def train(train_loader, model, criterion, optimizer, epoch, args, pruner=None):
+def autocast(args):
+    """bf16 autocast for the forward pass when `--bf16` is on. bf16 has fp32's range, so unlike fp16 no loss scaling
+    is needed & the parameters (the fp32 master weights) are never cast."""
+
+    return torch.autocast('cuda' if args.use_cuda else 'cpu', dtype=torch.bfloat16, enabled=bool(args.bf16))
+
+
+def pin_cpu_threads(local_rank, processes):
+    """Give each of the `processes` local processes it's own slice of the CPU cores (& as many torch threads)."""
+
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    per_process = max(1, len(cores) // processes)
+    torch.set_num_threads(per_process)
+
+    mine = cores[local_rank * per_process:(local_rank + 1) * per_process]
+    if hasattr(os, 'sched_setaffinity') and len(mine) > 0:
+        os.sched_setaffinity(0, mine)
+    print('=> process %i: %i threads on cores %s' % (local_rank, per_process, mine))
+
+
+def train(train_loader, model, criterion, optimizer, epoch, args, pruner=None, watchdog=None):
+    """Returns False if `watchdog` caught the model diverging (the epoch is cut short)."""
+
     if pruner is None:
         pruner = lambda: True
 
     batch_time = AverageMeter('Time', ':6.3f')
     data_time = AverageMeter('Data', ':6.3f')
-    losses = AverageMeter('Loss', ':.4e')
-    top1 = AverageMeter('Acc@1', ':6.2f')
-    top5 = AverageMeter('Acc@5', ':6.2f')
+    throughput = AverageMeter('Img/s', ':6.1f')
+    # loss & accuracies stay on the device, they're only synced when printed
+    metrics = MetricAccumulator(topk=(1, 5))
     progress = ProgressMeter(
         len(train_loader),
-        [batch_time, data_time, losses, top1, top5],
+        [batch_time, data_time, throughput, metrics],
         prefix="Epoch: [{}]".format(epoch))
 
     # switch to train mode
@@ -366,44 +490,66 @@ def train(train_loader, model, criterion, optimizer, epoch, args, pruner=None):
 
         if args.gpu is not None:
             images = images.cuda(args.gpu, non_blocking=True)
-        if torch.cuda.is_available():
+        if args.use_cuda:
             target = target.cuda(args.gpu, non_blocking=True)
+        if args.channels_last:
+            images = images.contiguous(memory_format=torch.channels_last)
 
         # compute output
-        output = model(images)
-        loss = criterion(output, target)
+        with autocast(args):
+            output = model(images)
+            loss = criterion(output, target)
 
         # measure accuracy and record loss
-        acc1, acc5 = accuracy(output, target, topk=(1, 5))
-        losses.update(loss.item(), images.size(0))
-        top1.update(acc1[0], images.size(0))
-        top5.update(acc5[0], images.size(0))
+        metrics.update(output, target, loss)
 
         # compute gradient and do SGD step
         optimizer.zero_grad()
         loss.backward()
 
+        if watchdog is not None:
+            watchdog.observe(loss)
+
         if pruner():
             optimizer.step()
 
         # measure elapsed time
         batch_time.update(time.time() - end)
+        throughput.update(images.size(0) / max(batch_time.val, 1e-9))
         end = time.time()
 
         if i % args.print_freq == 0:
             progress.display(i)
+            if watchdog is not None and diverged(watchdog, args):
+                print(watchdog)
+                return False
 
+    print(' * {:.1f} images/s'.format(metrics.count / max(batch_time.sum, 1e-9)))
     print(pruner) # every epoch print pruner
+    return watchdog is None or not diverged(watchdog, args)
+
+
+def diverged(watchdog, args):
+    """True if the model diverged on any rank. Every rank has to call this at the same batch, so they all stop
+    together (a rank stopping on it's own would leave the others hanging in their next all-reduce)."""
+
+    flag = watchdog.diverged()
+    if args.distributed:
+        device = torch.device('cuda' if args.use_cuda else 'cpu', args.gpu if args.use_cuda else None)
+        flags = torch.tensor([float(flag)], device=device)
+        dist.all_reduce(flags, op=dist.ReduceOp.MAX)
+        if flags.item() > 0 and not flag:
+            watchdog.reason = 'diverged on another rank'
+            flag = True
+    return flag
 
 
 def validate(val_loader, model, criterion, args):
     batch_time = AverageMeter('Time', ':6.3f')
-    losses = AverageMeter('Loss', ':.4e')
-    top1 = AverageMeter('Acc@1', ':6.2f')
-    top5 = AverageMeter('Acc@5', ':6.2f')
+    metrics = MetricAccumulator(topk=(1, 5))
     progress = ProgressMeter(
         len(val_loader),
-        [batch_time, losses, top1, top5],
+        [batch_time, metrics],
         prefix='Test: ')
 
     # switch to evaluate mode
@@ -414,18 +560,18 @@ def validate(val_loader, model, criterion, args):
         for i, (images, target) in enumerate(val_loader):
             if args.gpu is not None:
                 images = images.cuda(args.gpu, non_blocking=True)
-            if torch.cuda.is_available():
+            if args.use_cuda:
                 target = target.cuda(args.gpu, non_blocking=True)
+            if args.channels_last:
+                images = images.contiguous(memory_format=torch.channels_last)
 
             # compute output
-            output = model(images)
-            loss = criterion(output, target)
+            with autocast(args):
+                output = model(images)
+                loss = criterion(output, target)
 
             # measure accuracy and record loss
-            acc1, acc5 = accuracy(output, target, topk=(1, 5))
-            losses.update(loss.item(), images.size(0))
-            top1.update(acc1[0], images.size(0))
-            top5.update(acc5[0], images.size(0))
+            metrics.update(output, target, loss)
 
             # measure elapsed time
             batch_time.update(time.time() - end)
@@ -435,21 +581,22 @@ def validate(val_loader, model, criterion, args):
                 progress.display(i)
 
         # TODO: this should also be done with the ProgressMeter
-        print(' * Acc@1 {top1.avg:.3f} Acc@5 {top5.avg:.3f}'
-              .format(top1=top1, top5=top5))
+        results = metrics.compute()
+        print(' * Acc@1 {:.3f} Acc@5 {:.3f}'.format(results['acc1'], results['acc5']))
 
-    return top1.avg
+    return results['acc1']
 
 
-def save_checkpoint(state, is_best, parent_dir=None, filename='checkpoint.pth.tar'):
+def checkpoint_paths(is_best, parent_dir=None, filename='checkpoint.pth.tar'):
+    filename_best = 'model_best.pth.tar'
     if parent_dir is not None:
         filename = os.path.join(parent_dir, filename)
-    torch.save(state, filename)
-    if is_best:
-        filename_best = 'model_best.pth.tar'
-        if parent_dir is not None:
-            filename_best = os.path.join(parent_dir, 'model_best.pth.tar')
-        shutil.copyfile(filename, filename_best)
+        filename_best = os.path.join(parent_dir, filename_best)
+    return filename, filename_best if is_best else None
+
+
+def save_checkpoint(state, is_best, parent_dir=None, filename='checkpoint.pth.tar'):
+    save_atomic(state, *checkpoint_paths(is_best, parent_dir=parent_dir, filename=filename))
 
 
 class AverageMeter(object):
@@ -487,6 +634,11 @@ class ProgressMeter(object):
         entries += [str(meter) for meter in self.meters]
         print('\t'.join(entries))
 
+        # windowed meters (`MetricAccumulator`) start a new window after every display
+        for meter in self.meters:
+            if hasattr(meter, 'reset_window'):
+                meter.reset_window()
+
     def _get_batch_fmtstr(self, num_batches):
         num_digits = len(str(num_batches // 1))
         fmt = '{:' + str(num_digits) + 'd}'
@@ -510,22 +662,5 @@ def adjust_learning_rate(optimizer, epoch, args):
         param_group['lr'] = lr
 
 
-def accuracy(output, target, topk=(1,)):
-    """Computes the accuracy over the k top predictions for the specified values of k"""
-    with torch.no_grad():
-        maxk = max(topk)
-        batch_size = target.size(0)
-
-        _, pred = output.topk(maxk, 1, True, True)
-        pred = pred.t()
-        correct = pred.eq(target.view(1, -1).expand_as(pred))
-
-        res = []
-        for k in topk:
-            correct_k = correct[:k].reshape(-1).float().sum(0, keepdim=True)
-            res.append(correct_k.mul_(100.0 / batch_size))
-        return res
-
-
 if __name__ == '__main__':
     main()